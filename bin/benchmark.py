@@ -0,0 +1,77 @@
+#!/bin/env python
+# -*- coding: utf8 -*-
+
+""" Measures how many uploads an hour fedimg can get through, by running
+    the real upload pipeline against a simulated EC2 (see
+    fedimg/simulation.py). Nothing is sent to AWS or to the message bus. """
+
+import argparse
+import logging
+
+import fedimg.simulation
+
+
+def pair(value, convert=float):
+    name, _, number = value.partition('=')
+    if not name or not number:
+        raise argparse.ArgumentTypeError(
+            'expected name=value, got {0!r}'.format(value))
+    return name, convert(number)
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--composes', type=int, default=10,
+                    help='number of composes to upload (default: 10)')
+parser.add_argument('--images', type=int, default=2,
+                    help='images in each compose (default: 2)')
+parser.add_argument('--regions', type=int, default=8,
+                    help='regions to copy AMIs to (default: 8)')
+parser.add_argument('--time-scale', type=float, default=0.001,
+                    help='real seconds per simulated second '
+                         '(default: 0.001)')
+parser.add_argument('--workers', type=int, default=4,
+                    help='pipeline engine worker threads (default: 4)')
+parser.add_argument('--max-jobs', type=int, default=8,
+                    help='uploads to run at once (default: 8)')
+parser.add_argument('--util-pool', type=int, default=0,
+                    help='utility nodes to keep booted between uploads '
+                         '(default: 0, no pool)')
+parser.add_argument('--util-volumes', type=int, default=1,
+                    help='images to write at once on each utility node '
+                         '(default: 1)')
+parser.add_argument('--latency', type=pair, action='append', default=[],
+                    metavar='NAME=SECONDS',
+                    help='override a simulated latency, such as copy=600')
+parser.add_argument('--failure-rate', type=pair, action='append',
+                    default=[], metavar='NAME=RATE',
+                    help='make a call fail at a rate between 0 and 1, '
+                         'such as copy_image=0.05')
+parser.add_argument('--seed', type=int, default=None,
+                    help='seed for the injected failures')
+parser.add_argument('-v', '--verbose', action='store_true',
+                    help='log what the uploads are doing')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+report = fedimg.simulation.run_benchmark(
+    composes=args.composes, images=args.images, regions=args.regions,
+    time_scale=args.time_scale, workers=args.workers,
+    max_jobs=args.max_jobs, latencies=dict(args.latency),
+    failure_rates=dict(args.failure_rate), seed=args.seed,
+    util_pool=args.util_pool, util_volumes=args.util_volumes)
+
+print 'Jobs:              {jobs} ({completed} completed, {failed} ' \
+    'failed)'.format(**report)
+print 'Real time:         {seconds:.1f}s'.format(**report)
+print 'Simulated time:    {0:.1f}h'.format(report['simulated_seconds'] /
+                                           3600.0)
+print 'Jobs per hour:     {jobs_per_hour:.1f}'.format(**report)
+print 'Peak threads:      {peak_threads}'.format(**report)
+print 'SSH handshakes:    {ssh_handshakes}'.format(**report)
+print 'API calls:'
+for method, count in sorted(report['api_calls'].items()):
+    print '  {0:<28} {1}'.format(method, count)
+print 'Messages:'
+for (topic, status), count in sorted(report['messages'].items()):
+    print '  {0:<28} {1}'.format('{0} {1}'.format(topic, status), count)
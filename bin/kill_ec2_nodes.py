@@ -4,13 +4,9 @@
 import logging
 logging.basicConfig()
 
-from libcloud.compute.types import Provider
-from libcloud.compute.providers import get_driver
 import datetime
 import fedimg
-
-EC2_ACCESS_ID = fedimg.AWS_ACCESS_ID
-EC2_SECRET_KEY = fedimg.AWS_SECRET_KEY
+from fedimg.drivers import ec2_driver
 
 def kill_all_instances(region):
     """
@@ -18,21 +14,20 @@ def kill_all_instances(region):
 
     :param region: AWS region
     """
-    cls = get_driver(region)
-    driver = cls(EC2_ACCESS_ID, EC2_SECRET_KEY)
+    driver = ec2_driver(region)
     nodes = driver.list_nodes()
     for n in nodes:
         d1 = datetime.datetime.strptime(n.extra['launch_time'], '%Y-%m-%dT%H:%M:%S.000Z')
         d2 =  datetime.datetime.utcnow()
         delta = d2 - d1
         if delta.total_seconds() > 7200: # If more than 2 hours of up time.
-            n.destroy()
+            driver.destroy_node(n)
 
 
 if __name__ == '__main__':
-    regions = [Provider.EC2_AP_NORTHEAST, Provider.EC2_AP_SOUTHEAST,
-                Provider.EC2_AP_SOUTHEAST2, Provider.EC2_EU_WEST,
-                Provider.EC2_SA_EAST, Provider.EC2_US_EAST,
-                Provider.EC2_US_WEST, Provider.EC2_US_WEST_OREGON]
+    regions = ['ap-northeast-1', 'ap-southeast-1',
+               'ap-southeast-2', 'eu-west-1',
+               'sa-east-1', 'us-east-1',
+               'us-west-1', 'us-west-2']
     for region in regions:
         kill_all_instances(region)
@@ -0,0 +1,89 @@
+#!/bin/env python
+# -*- coding: utf8 -*-
+
+""" Records compose status messages from datagrepper, and replays them
+    through the fedimg consumer faster than they were sent, with the
+    compose metadata and uploads stubbed out. Reports how long consume()
+    took, how deep the queues got and how memory grew. """
+
+import argparse
+import logging
+import sys
+
+import fedimg.replay
+
+
+def do_record(args):
+    with open(args.file, 'w') as f:
+        count = fedimg.replay.record(
+            f, fedimg.replay.fetch_messages(args.days))
+    print 'Recorded {0} messages to {1}'.format(count, args.file)
+
+
+def do_replay(args):
+    if args.file:
+        with open(args.file) as f:
+            messages = fedimg.replay.load(f)
+    else:
+        messages = fedimg.replay.synthetic_messages(args.synthetic,
+                                                    seed=args.seed)
+
+    report = fedimg.replay.replay(
+        messages, speed=args.speed, images=args.images,
+        upload_seconds=args.upload_seconds,
+        metadata_seconds=args.metadata_seconds)
+
+    mb = 1024.0 * 1024
+    print 'Messages:          {messages} over {0:.1f} days in ' \
+        '{seconds:.1f}s'.format(report['simulated_seconds'] / 86400.0,
+                                **report)
+    print 'consume() latency: mean {mean:.3f}ms, p50 {p50:.3f}ms, ' \
+        'p99 {p99:.3f}ms, max {max:.3f}ms'.format(**report['consume_ms'])
+    print 'Fell behind by:    {max_lag:.1f}s at most'.format(**report)
+    print 'Peak depth:        {max_pending} coalescing, {max_queued} ' \
+        'queued, {max_running} running, {peak_threads} ' \
+        'threads'.format(**report)
+    print 'Jobs:              {submitted} submitted, {rejected} refused, ' \
+        '{completed} completed, {failed} failed, {superseded} ' \
+        'superseded'.format(**report['jobs'])
+    print 'Resident memory:   {0:.1f}MB at start, {1:.1f}MB at peak, ' \
+        '{2:.1f}MB at end ({3:+.1f}MB)'.format(
+            report['rss_start'] / mb, report['rss_peak'] / mb,
+            report['rss_end'] / mb,
+            (report['rss_end'] - report['rss_start']) / mb)
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('-v', '--verbose', action='store_true',
+                    help='log what the consumer is doing')
+subparsers = parser.add_subparsers()
+
+record = subparsers.add_parser('record', help='record messages to a file')
+record.add_argument('file', help='file to write the messages to')
+record.add_argument('-d', '--days', type=int, default=30,
+                    help='days of history to record (default: 30)')
+record.set_defaults(func=do_record)
+
+replay = subparsers.add_parser('replay', help='replay messages')
+source = replay.add_mutually_exclusive_group(required=True)
+source.add_argument('file', nargs='?', help='recorded messages to replay')
+source.add_argument('--synthetic', type=int, metavar='DAYS',
+                    help='replay DAYS days of made up messages instead')
+replay.add_argument('--seed', type=int, default=None,
+                    help='seed for the made up messages')
+replay.add_argument('--speed', type=float, default=86400.0,
+                    help='how many times faster than real time '
+                         '(default: 86400, a day a second)')
+replay.add_argument('--images', type=int, default=2,
+                    help='.raw.xz images in each compose (default: 2)')
+replay.add_argument('--upload-seconds', type=float, default=5400,
+                    help='how long each upload takes (default: 5400)')
+replay.add_argument('--metadata-seconds', type=float, default=5,
+                    help='how long compose metadata takes to fetch '
+                         '(default: 5)')
+replay.set_defaults(func=do_replay)
+
+args = parser.parse_args()
+logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                    stream=sys.stderr)
+args.func(args)
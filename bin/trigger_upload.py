@@ -2,17 +2,18 @@
 # -*- coding: utf8 -*-
 
 """ Triggers an upload process with the specified raw.xz URL. Useful for
-    manually triggering Fedimg jobs. """
+    manually triggering Fedimg jobs. If an earlier upload of the same URL
+    was cut short, it is resumed from the journal. """
 
 import logging
 import logging.config
-import multiprocessing.pool
 import sys
 
 import fedmsg
 import fedmsg.config
 
 import fedimg
+import fedimg.pipeline
 import fedimg.services
 from fedimg.services.ec2 import EC2Service, EC2ServiceException
 import fedimg.uploader
@@ -25,8 +26,8 @@ if len(sys.argv) != 2:
 logging.config.dictConfig(fedmsg.config.load_config()['logging'])
 log = logging.getLogger('fedmsg')
 
-upload_pool = multiprocessing.pool.ThreadPool(processes=4)
+upload_engine = fedimg.pipeline.PipelineEngine(workers=4)
 
 url = sys.argv[1]
 
-fedimg.uploader.upload(upload_pool, [url])
+fedimg.uploader.upload(upload_engine, [url], {})
@@ -27,8 +27,53 @@ import ConfigParser
 config = ConfigParser.RawConfigParser()
 config.read('/etc/fedimg.cfg')
 
+
+def _get(section, option, default):
+    """ Like `config.get`, but falls back to `default` for newer options
+    that existing configuration files may not set yet. """
+    if config.has_option(section, option):
+        return config.get(section, option)
+    return default
+
+
 CLEAN_UP_ON_FAILURE = config.get('general', 'clean_up_on_failure')
 DELETE_IMAGES_ON_FAILURE = config.get('general', 'delete_images_on_failure')
+# SQLite database that upload jobs are journaled to, so they can be resumed
+# after a restart. Journaling is disabled if this is empty.
+JOURNAL_PATH = _get('general', 'journal_path', '')
+# Directory that downloaded image files are cached in, and the most GiB they
+# may take up there. Caching is disabled if the directory is empty, as it is
+# by default.
+CACHE_DIR = _get('general', 'cache_dir', '')
+CACHE_SIZE = int(_get('general', 'cache_size', 20))
+# Most upload jobs the consumer runs at once, and the most it keeps queued
+# behind them before refusing new ones.
+MAX_JOBS = int(_get('general', 'max_jobs', 8))
+JOB_QUEUE_SIZE = int(_get('general', 'job_queue_size', 100))
+# Most threads that jobs' blocking calls, such as cloud API requests, SSH
+# probes and image transfers, run on at once.
+BLOCKING_THREADS = int(_get('general', 'blocking_threads', 32))
+# Seconds to gather messages about the same compose for before acting once
+# on all of them.
+COALESCE_WINDOW = float(_get('general', 'coalesce_window', 10))
+# Seconds that the images listed in a compose's metadata are cached for.
+METADATA_TTL = float(_get('general', 'metadata_ttl', 3600))
+# Most fedmsgs kept waiting to be published, the file that any more are
+# spilled to, and the most bytes it may grow to. Messages are dropped
+# instead if no file is given, or once it is full.
+MESSAGE_QUEUE_SIZE = int(_get('general', 'message_queue_size', 1000))
+MESSAGE_SPILL_PATH = _get('general', 'message_spill_path', '')
+MESSAGE_SPILL_SIZE = int(_get('general', 'message_spill_size',
+                              64 * 1024 ** 2))
+# Local port that metrics are served on for Prometheus, and the statsd server
+# they are sent to. Either is disabled if left empty.
+METRICS_PORT = int(_get('general', 'metrics_port', 0) or 0)
+STATSD_HOST = _get('general', 'statsd_host', '')
+STATSD_PORT = int(_get('general', 'statsd_port', 8125))
+# Most SSH connections set up at once, and the seconds an SSH connection is
+# kept open for without being used.
+SSH_MAX_HANDSHAKES = int(_get('general', 'ssh_max_handshakes', 4))
+SSH_IDLE_TIMEOUT = float(_get('general', 'ssh_idle_timeout', 300))
 
 # koji_server is the location of the Koji hub that should be used
 # to initialize the Koji connection.
@@ -48,8 +93,41 @@ AWS_PUBKEYPATH = config.get('aws', 'pubkeypath')
 AWS_UTIL_VOL_SIZE = config.get('aws', 'util_volume_size')
 AWS_TEST_VOL_SIZE = config.get('aws', 'test_volume_size')
 AWS_TEST = config.get('aws', 'test')
+# Checks run at once on test instances, one name|hard|command or
+# name|soft|command per line. The `test` command is the only check if none
+# are given.
+AWS_TEST_CHECKS = _get('aws', 'test_checks', '')
 AWS_AMIS = config.get('aws', 'amis')
 AWS_IAM_PROFILE = config.get('aws', 'iam_profile')
+# Most AMI copies that may be in progress at once into any one region
+AWS_COPY_CONCURRENCY = int(_get('aws', 'copy_concurrency', 5))
+# How images get into a snapshot: 'utility' writes them to a volume from a
+# utility instance, 'direct' sends them with the EBS direct APIs
+AWS_INGESTION = _get('aws', 'ingestion', 'utility')
+# Overrides the EBS direct APIs endpoint, e.g. to test against a stand-in
+AWS_EBS_ENDPOINT = _get('aws', 'ebs_endpoint', '')
+# Most blocks sent at once per image in 'direct' mode
+AWS_EBS_WORKERS = int(_get('aws', 'ebs_workers', 16))
+# Most EC2 API calls a second that fedimg makes per region: describing
+# resources, changing them, and launching instances or creating AMIs
+AWS_DESCRIBE_RATE = float(_get('aws', 'describe_rate', 10))
+AWS_MUTATE_RATE = float(_get('aws', 'mutate_rate', 2))
+AWS_INTENSIVE_RATE = float(_get('aws', 'intensive_rate', 1))
+# Most EBS direct API calls a second that send blocks of snapshot data
+AWS_EBS_BLOCK_RATE = float(_get('aws', 'ebs_block_rate', 500))
+# Seconds fedimg waits for an EC2 resource to reach a state before giving up
+AWS_WAIT_TIMEOUT = float(_get('aws', 'wait_timeout', 7200))
+# Seconds fedimg waits for a booted instance to accept SSH connections
+AWS_SSH_TIMEOUT = float(_get('aws', 'ssh_timeout', 600))
+# Most utility instances kept booted in the origin region between uploads,
+# and the seconds they are kept idle for. Pooling is disabled if the size
+# is 0.
+AWS_UTIL_POOL_SIZE = int(_get('aws', 'util_pool_size', 0))
+AWS_UTIL_POOL_IDLE_TIMEOUT = float(_get('aws', 'util_pool_idle_timeout',
+                                        1800))
+# Most images written side by side on one utility instance, each to a volume
+# of its own. Above 1, utility instances are pooled even with no pool size.
+AWS_UTIL_NODE_VOLUMES = min(int(_get('aws', 'util_node_volumes', 1)), 15)
 
 # RACKSPACE
 RACKSPACE_USER = config.get('rackspace', 'username')
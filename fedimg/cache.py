@@ -0,0 +1,169 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+A local, content-addressed cache of .raw.xz image files.
+
+Files are stored under the sha256 of their contents, which is worked out
+while they download rather than in a second pass. When the compose metadata
+gives the expected checksum, the download is checked against it, and a
+cached copy is found without any network traffic at all. Files are evicted,
+least recently used first, once the cache grows past its size limit.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import hashlib
+import os
+import tempfile
+import threading
+
+import requests
+
+import fedimg
+
+CHUNK_SIZE = 1024 * 1024
+SUFFIX = '.raw.xz'
+
+
+class ImageCacheException(Exception):
+    """ A file could not be downloaded, or didn't match its checksum. """
+    pass
+
+
+class ImageCache(object):
+    """ Keeps downloaded image files in `directory`, evicting the least
+    recently used once they take up more than `max_bytes`. One cache may be
+    shared by all the threads of a process; concurrent requests for the
+    same file wait for a single download. """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + SUFFIX)
+
+    def _alias(self, url):
+        # Files whose checksum wasn't known up front are also found by URL
+        return self._path('url-' + hashlib.sha256(url).hexdigest())
+
+    def open(self, url, sha256=None):
+        """ Returns the file at `url`, opened for reading from the cache,
+        downloading it first if it isn't cached yet. The download is
+        checked against `sha256` if it is given. An open file stays
+        readable even if it is evicted in the meantime. """
+        key = sha256.lower() if sha256 else self._alias(url)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            if sha256:
+                path = self._path(key)
+            else:
+                path = os.path.realpath(self._alias(url))
+
+            try:
+                os.utime(path, None)  # mark as recently used
+                image = open(path, 'rb')
+                log.info('Using cached copy of {0}'.format(url))
+            except (IOError, OSError):
+                path = self._download(url, key if sha256 else None)
+                image = open(path, 'rb')
+
+        self._evict()
+        return image
+
+    def _download(self, url, sha256):
+        """ Downloads `url` into the cache and returns its path. """
+        log.info('Downloading {0} into the cache'.format(url))
+        digest = hashlib.sha256()
+        part = tempfile.NamedTemporaryFile(dir=self.directory,
+                                           suffix='.part', delete=False)
+        try:
+            with part:
+                response = requests.get(url, stream=True, timeout=60)
+                response.raise_for_status()
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    digest.update(chunk)
+                    part.write(chunk)
+
+            if sha256 and digest.hexdigest() != sha256:
+                raise ImageCacheException(
+                    "{0} has sha256 {1}, expected {2}".format(
+                        url, digest.hexdigest(), sha256))
+            path = self._path(digest.hexdigest())
+            os.rename(part.name, path)
+        except Exception:
+            if os.path.exists(part.name):
+                os.unlink(part.name)
+            raise
+
+        if not sha256:
+            alias = self._alias(url)
+            if os.path.lexists(alias):
+                os.unlink(alias)
+            os.symlink(os.path.basename(path), alias)
+        return path
+
+    def _evict(self):
+        """ Removes the least recently used files until the cache fits. """
+        with self._lock:
+            files = []
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name.endswith(SUFFIX) and not os.path.islink(path):
+                    stat = os.stat(path)
+                    files.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                log.info('Evicting {0} from the cache'.format(path))
+                os.unlink(path)
+                total -= size
+
+            # Drop aliases of evicted files
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if os.path.islink(path) and not os.path.exists(path):
+                    os.unlink(path)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """ Returns the process-wide image cache, or None if the `cache_dir`
+    option is empty and caching is disabled. """
+    global _cache
+    with _cache_lock:
+        if _cache is None and fedimg.CACHE_DIR:
+            _cache = ImageCache(fedimg.CACHE_DIR,
+                                fedimg.CACHE_SIZE * 1024 ** 3)
+        return _cache
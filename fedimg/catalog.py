@@ -0,0 +1,127 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+The catalog of AWS AMIs from the `amis` option of the configuration file,
+parsed once and shared by every EC2Service.
+"""
+
+import threading
+
+import fedimg
+
+# Utility instances need EBS, and no EBS-enabled instance types offer a
+# 32 bit architecture, so they must be x86_64.
+UTILITY_ARCH = 'x86_64'
+
+
+class AMIEntry(object):
+    """ One line of the AMI catalog. Entries are immutable. """
+
+    __slots__ = ('region', 'os', 'ver', 'arch', 'ami', 'aki')
+
+    def __init__(self, region, arch, ami, aki, os=None, ver=None):
+        set_ = super(AMIEntry, self).__setattr__
+        set_('region', region)
+        set_('os', os)
+        set_('ver', ver)
+        set_('arch', arch)
+        set_('ami', ami)
+        set_('aki', aki)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("AMIEntry is immutable")
+
+    def __repr__(self):
+        return '<AMIEntry {0} {1} {2}>'.format(self.region, self.arch,
+                                               self.ami)
+
+    @classmethod
+    def from_line(cls, line):
+        """ Parses one line of the `amis` option, or returns None if it
+        isn't an AMI line. The line's pipe-delimited attrs are either:
+
+        region|os|version|arch|ami|aki  (old configuration), or
+        region|arch|ami|aki             (new configuration) """
+
+        # strip line to avoid any newlines or spaces from sneaking in
+        attrs = line.strip().split('|')
+
+        if len(attrs) == 6:
+            region, os, ver, arch, ami, aki = attrs
+            return cls(region, arch, ami, aki, os=os, ver=ver)
+        elif len(attrs) == 4:
+            region, arch, ami, aki = attrs
+            return cls(region, arch, ami, aki)
+        return None
+
+
+class AMICatalog(object):
+    """ The AMI entries, indexed by (region, arch) and by role. """
+
+    def __init__(self, entries):
+        self.entries = tuple(entries)
+
+        self._by_region_arch = {}
+        by_arch = {}
+        for entry in self.entries:
+            self._by_region_arch.setdefault((entry.region, entry.arch),
+                                            entry)
+            by_arch.setdefault(entry.arch, []).append(entry)
+        self._by_arch = dict((arch, tuple(entries))
+                             for arch, entries in by_arch.items())
+
+    @classmethod
+    def parse(cls, text):
+        """ Builds a catalog from the text of the `amis` option. """
+        entries = [AMIEntry.from_line(line) for line in text.split('\n')]
+        return cls(e for e in entries if e is not None)
+
+    def get(self, region, arch):
+        """ Returns the entry for `region` and `arch`, or None. """
+        return self._by_region_arch.get((region, arch))
+
+    def aki(self, region, arch):
+        """ Returns the kernel image for `region` and `arch`. """
+        return self._by_region_arch[(region, arch)].aki
+
+    def utility_amis(self):
+        """ Returns the entries utility instances can be started from. """
+        return self._by_arch.get(UTILITY_ARCH, ())
+
+    def test_amis(self, arch):
+        """ Returns the entries for images of architecture `arch`, which
+        also name every region such images are distributed to. """
+        return self._by_arch.get(arch, ())
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """ Returns the catalog built from the configuration file, building it
+    on first use. """
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = AMICatalog.parse(fedimg.AWS_AMIS)
+        return _catalog
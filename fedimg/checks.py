@@ -0,0 +1,190 @@
+# This file is part of fedimg.
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+The checks run on test instances, from the `test_checks` option of the
+configuration file. They all run at once, in one script on one SSH session,
+whose output tags every line with the check it came from.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import pipes
+import re
+
+import fedimg
+
+# Marks the line a check's script prints when the check is done
+RESULT_MARK = '@@fedimg'
+
+_NAME = re.compile(r'^[\w.-]+$')
+
+# Runs every check in the background, each through `fedimg_check`, which
+# prefixes each line of its output with its name, and reports how it exited
+# and how long it took. With job control on, each check runs in a process
+# group of its own, so that once a hard check fails the rest can be killed.
+_SCRIPT = """\
+set -m
+exec 2> /dev/null  # job control notices; checks send stderr to stdout
+fedimg_check() {{
+    local start=$SECONDS
+    bash -c "$3" < /dev/null 2>&1 | sed -u "s/^/$1: /"
+    local status=${{PIPESTATUS[0]}}
+    echo "{mark} $1 $status $((SECONDS - start))"
+    [ "$status" -eq 0 ] || [ "$2" = soft ]
+}}
+pids=()
+{checks}
+status=0
+while true; do
+    wait -n
+    case $? in
+        0) ;;
+        127) break ;;  # no checks left
+        *)
+            status=1
+            for job in $(jobs -p); do
+                kill -TERM -- -$job
+            done 2> /dev/null
+            break
+            ;;
+    esac
+done
+# wait -n may miss a check that was reaped on its own, but waiting on its
+# PID still gives its status
+for pid in "${{pids[@]}}"; do
+    wait "$pid" || status=1
+done
+exit $status
+"""
+
+
+class CheckException(Exception):
+    """ Raised for a malformed line in the `test_checks` option. """
+    pass
+
+
+class Check(object):
+    """ A command run on test instances. Unless it is soft, the AMI fails
+    its tests if the command fails. """
+
+    def __init__(self, name, command, hard=True):
+        self.name = name
+        self.command = command
+        self.hard = hard
+
+    def __repr__(self):
+        return '<Check {0}>'.format(self.name)
+
+    @classmethod
+    def from_line(cls, line):
+        """ Parses one line of the `test_checks` option, or returns None if
+        it is blank. The line's attrs are name|hard|command, or
+        name|soft|command; the command may contain pipes itself. """
+        line = line.strip()
+        if not line:
+            return None
+        attrs = line.split('|', 2)
+        if (len(attrs) != 3 or not _NAME.match(attrs[0]) or
+                attrs[1] not in ('hard', 'soft') or not attrs[2].strip()):
+            raise CheckException('Bad test check: {0!r}'.format(line))
+        name, kind, command = attrs
+        return cls(name, command.strip(), hard=(kind == 'hard'))
+
+
+def parse_checks(text, default=None):
+    """ Returns the checks in the text of the `test_checks` option. With
+    none given, `default` is the only, hard, check. """
+    checks = [Check.from_line(line) for line in text.split('\n')]
+    checks = [c for c in checks if c is not None]
+    if not checks and default:
+        checks = [Check('test', default)]
+    names = [c.name for c in checks]
+    if len(set(names)) != len(names):
+        raise CheckException('Test check names must be unique')
+    return checks
+
+
+def get_checks():
+    """ Returns the checks from the configuration file. """
+    return parse_checks(fedimg.AWS_TEST_CHECKS, fedimg.AWS_TEST)
+
+
+def suite_command(checks):
+    """ Returns the shell command that runs `checks` at once, and exits
+    with status 0 only if every hard check passes. """
+    lines = ['fedimg_check {0} {1} {2} & pids+=($!)'.format(
+        c.name, 'hard' if c.hard else 'soft', pipes.quote(c.command))
+        for c in checks]
+    script = _SCRIPT.format(mark=RESULT_MARK, checks='\n'.join(lines))
+    return 'bash -c {0}'.format(pipes.quote(script))
+
+
+class CheckOutput(object):
+    """ Follows the output of `suite_command` as it is read, logging each
+    line and each check's result as they come. """
+
+    def __init__(self, label, checks):
+        self.label = label
+        self.checks = checks
+        self.results = {}  # check name -> (exit status, seconds)
+        self._partial = ''
+
+    def feed(self, chunk):
+        """ Takes the next `chunk` of output. """
+        lines = (self._partial + chunk).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._line(line.rstrip('\r'))
+
+    def close(self):
+        """ Takes the end of the output. """
+        if self._partial:
+            self._line(self._partial.rstrip('\r'))
+            self._partial = ''
+
+    def _line(self, line):
+        if line.startswith(RESULT_MARK + ' '):
+            try:
+                name, status, seconds = line.split()[1:]
+                self.results[name] = (int(status), int(seconds))
+            except ValueError:
+                pass
+            else:
+                log.info('{0} check {1}: {2}'.format(
+                    self.label, name, self._describe(name)))
+                return
+        if line:
+            log.info('{0} {1}'.format(self.label, line))
+
+    def _describe(self, name):
+        if name not in self.results:
+            return 'aborted'
+        status, seconds = self.results[name]
+        return '{0} in {1}s'.format(
+            'passed' if status == 0 else 'failed (exit status {0})'.format(
+                status), seconds)
+
+    def summary(self):
+        """ Returns a line per check, saying how it went. """
+        return '\n'.join('{0}: {1}'.format(c.name, self._describe(c.name))
+                         for c in self.checks)
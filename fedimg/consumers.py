@@ -22,14 +22,24 @@
 import logging
 log = logging.getLogger("fedmsg")
 
-import multiprocessing.pool
+import socket
+import threading
+import time
 
 import fedmsg.consumers
 import fedmsg.encoding
-import fedfind.release
 
+import fedimg
+import fedimg.metadata
+import fedimg.metrics
+import fedimg.pipeline
+import fedimg.services.ec2
 import fedimg.uploader
-from fedimg.util import get_rawxz_urls, safeget
+from fedimg.util import get_rawxz_checksums, get_rawxz_urls, parse_compose_id
+
+# Seconds before a compose is expected to finish that utility nodes start
+# booting for its uploads
+PREWARM_LEAD = 600
 
 
 class FedimgConsumer(fedmsg.consumers.FedmsgConsumer):
@@ -50,8 +60,39 @@ class FedimgConsumer(fedmsg.consumers.FedmsgConsumer):
     def __init__(self, *args, **kwargs):
         super(FedimgConsumer, self).__init__(*args, **kwargs)
 
-        # threadpool for upload jobs
-        self.upload_pool = multiprocessing.pool.ThreadPool(processes=4)
+        # serve metrics, if configured; uploads matter more than metrics,
+        # so carry on without the endpoint if its port is taken
+        try:
+            fedimg.metrics.start()
+        except socket.error:
+            log.exception('Cannot serve metrics on port {0}'.format(
+                fedimg.METRICS_PORT))
+
+        # engine for upload jobs; its few worker threads are only busy
+        # while a job is actually doing something, not while it waits
+        self.upload_engine = fedimg.pipeline.PipelineEngine(workers=4)
+
+        # upload jobs are queued here, so that consume() never waits on them
+        self.uploader = fedimg.uploader.Uploader(
+            self.upload_engine,
+            max_running=fedimg.MAX_JOBS,
+            max_queued=fedimg.JOB_QUEUE_SIZE)
+
+        # pick up any uploads that were cut short by a restart
+        self.uploader.resume()
+
+        # the cloud images in compose metadata, fetched in the background
+        self.metadata = fedimg.metadata.MetadataCache(fedimg.METADATA_TTL)
+
+        # compose ID -> location, for composes waiting out the
+        # coalesce_window
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+        # release -> (compose ID, time) of its latest compose to start, and
+        # how long its last compose took, for warming up utility nodes
+        self._started = {}
+        self._durations = {}
 
         log.info("Super happy fedimg ready and reporting for duty.")
 
@@ -63,17 +104,67 @@ class FedimgConsumer(fedmsg.consumers.FedmsgConsumer):
         STATUS_F = ('FINISHED_INCOMPLETE', 'FINISHED',)
 
         msg_info = msg['body']['msg']
+        if msg_info['status'] == 'STARTED':
+            self._compose_started(msg_info['compose_id'])
         if msg_info['status'] not in STATUS_F:
             return
 
         location = msg_info['location']
         compose_id = msg_info['compose_id']
-        cmetadata = fedfind.release.get_release_cid(compose_id).metadata
+        self._compose_finished(compose_id)
+
+        # start fetching the metadata now, so it's ready by the time the
+        # compose is processed
+        self.metadata.prefetch(compose_id, location)
 
-        images_meta = safeget(cmetadata, 'images', 'payload', 'images',
-                              'CloudImages', 'x86_64')
+        with self._pending_lock:
+            coalesced = compose_id in self._pending
+            self._pending[compose_id] = location
+        if coalesced:
+            log.info("Coalescing message for compose id: %s" % compose_id)
+            return
 
-        if images_meta is None:
+        timer = threading.Timer(fedimg.COALESCE_WINDOW, self._flush,
+                                (compose_id,))
+        timer.daemon = True
+        timer.start()
+
+    def _compose_started(self, compose_id):
+        """ Gets utility nodes booting in time for the uploads from a
+        compose that has just started, going by how long the previous
+        compose of its release took. """
+        if fedimg.AWS_UTIL_POOL_SIZE <= 0:
+            return
+        release = (parse_compose_id(compose_id) or (compose_id,))[0]
+        self._started[release] = (compose_id, time.time())
+        delay = max(0, self._durations.get(release, 0) - PREWARM_LEAD)
+        timer = threading.Timer(delay,
+                                fedimg.services.ec2.prewarm_utility_nodes)
+        timer.daemon = True
+        timer.start()
+
+    def _compose_finished(self, compose_id):
+        """ Notes how long a compose took, from its start. """
+        release = (parse_compose_id(compose_id) or (compose_id,))[0]
+        started = self._started.get(release)
+        if started is not None and started[0] == compose_id:
+            del self._started[release]
+            self._durations[release] = time.time() - started[1]
+
+    def _flush(self, compose_id):
+        """ Acts on the messages gathered about a compose. """
+        with self._pending_lock:
+            location = self._pending.pop(compose_id)
+        try:
+            self._process(compose_id, location)
+        except Exception:
+            log.exception("Failed to process compose id: %s" % compose_id)
+
+    def _process(self, compose_id, location):
+        """ Queues uploads of the cloud images of a finished compose. """
+        images_meta = self.metadata.get(compose_id, location)
+
+        if not images_meta:
             return
 
         self.upload_urls = get_rawxz_urls(location, images_meta)
@@ -83,6 +174,10 @@ class FedimgConsumer(fedmsg.consumers.FedmsgConsumer):
 
         if len(self.upload_urls) > 0:
             log.info("Processing compose id: %s" % compose_id)
-            fedimg.uploader.upload(self.upload_pool,
-                                   self.upload_urls,
-                                   compose_meta)
+            try:
+                self.uploader.submit(self.upload_urls,
+                                     compose_meta,
+                                     get_rawxz_checksums(location,
+                                                         images_meta))
+            except fedimg.uploader.UploadQueueFull as e:
+                log.error("Not uploading compose %s: %s" % (compose_id, e))
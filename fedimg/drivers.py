@@ -0,0 +1,186 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+A process-wide pool of libcloud drivers.
+
+Building a driver and opening its connection to a region is not free, and
+libcloud drivers are not safe to share between threads, since each request
+updates state on the connection object. The pool keeps idle drivers (and
+with them their kept-alive connections) per (provider, region,
+credentials), and lends each one to one caller at a time. The provider is
+a libcloud provider constant, or a driver class such as
+`fedimg.ebs.EBSDriver`.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import contextlib
+import threading
+import time
+
+from libcloud.compute.providers import get_driver
+from libcloud.compute.types import Provider
+
+import fedimg
+import fedimg.metrics
+import fedimg.ratelimit
+from fedimg.pipeline import Return
+
+
+class DriverPool(object):
+    """ Lends out libcloud drivers, keeping up to `max_idle` idle drivers
+    per key and dropping any that have been idle for `idle_timeout`
+    seconds. """
+
+    def __init__(self, max_idle=4, idle_timeout=300):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.created = 0  # drivers built so far, for the curious
+        self._lock = threading.Lock()
+        self._idle = {}  # key -> list of (time returned, driver)
+
+    @contextlib.contextmanager
+    def lease(self, provider, region, key, secret, **kwargs):
+        """ Lends out a driver for the duration of a `with` block. Any
+        keyword arguments are passed on to the driver class, and are part
+        of the key drivers are pooled under. """
+        pool_key = (provider, region, key, secret,
+                    tuple(sorted(kwargs.items())))
+        driver = self._checkout(pool_key)
+        try:
+            yield driver
+        finally:
+            self._checkin(pool_key, driver)
+
+    def clear(self):
+        """ Drops every idle driver. """
+        with self._lock:
+            self._idle = {}
+
+    def _checkout(self, pool_key):
+        with self._lock:
+            self._evict(time.time())
+            idle = self._idle.get(pool_key)
+            if idle:
+                # The most recently used driver has the warmest connection
+                return idle.pop()[1]
+            self.created += 1
+
+        provider, region, key, secret, kwargs = pool_key
+        log.debug('Connecting to {0} in {1}'.format(provider, region))
+        cls = provider if isinstance(provider, type) else \
+            get_driver(provider)
+        return cls(key, secret, region=region, **dict(kwargs))
+
+    def _checkin(self, pool_key, driver):
+        with self._lock:
+            idle = self._idle.setdefault(pool_key, [])
+            idle.append((time.time(), driver))
+            if len(idle) > self.max_idle:
+                idle.pop(0)
+
+    def _evict(self, now):
+        for pool_key in list(self._idle):
+            idle = [(t, d) for t, d in self._idle[pool_key]
+                    if now - t < self.idle_timeout]
+            if idle:
+                self._idle[pool_key] = idle
+            else:
+                del self._idle[pool_key]
+
+
+class PooledDriver(object):
+    """ Stands in for a libcloud driver. Every method call borrows a driver
+    from the pool for just that call, so one `PooledDriver` can be used
+    from any number of threads and jobs. Calls are rate limited per
+    account and region. Jobs on the pipeline engine should make their calls
+    with `job()`, so that neither waiting on the rate limit nor the call
+    itself holds up a worker thread. Use `lease()` to hold on to a single
+    driver across several calls. """
+
+    def __init__(self, pool, provider, region, key, secret, **kwargs):
+        self.pool = pool
+        self.provider = provider
+        self.region = region
+        self._key = (provider, region, key, secret)
+        self._kwargs = kwargs
+
+    def lease(self):
+        return self.pool.lease(*self._key, **self._kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            return self.limited_call(
+                name, lambda driver: getattr(driver, name)(*args, **kwargs))
+        call.__name__ = name
+        return call
+
+    def limited_call(self, method, fn):
+        """ Calls `fn` with a leased driver, within the rate limit of the
+        API method `method` (see `fedimg.ratelimit`), and returns what it
+        returns. Calls that are throttled are tried again. """
+        try:
+            return fedimg.ratelimit.limiter.call(
+                self._key[2], self.region, method, self._attempt(method, fn))
+        except Exception:
+            fedimg.metrics.inc('fedimg_api_errors_total',
+                               region=self.region, method=method)
+            raise
+
+    def job(self, method, *args, **kwargs):
+        """ Calls the driver method `method` like `limited_call` does, as a
+        generator job that hands back what the method returns. The call is
+        made with `run_in_thread`. """
+        fn = lambda driver: getattr(driver, method)(*args, **kwargs)
+        try:
+            result = yield fedimg.ratelimit.limiter.job(
+                self._key[2], self.region, method, self._attempt(method, fn))
+        except Exception:
+            fedimg.metrics.inc('fedimg_api_errors_total',
+                               region=self.region, method=method)
+            raise
+        raise Return(result)
+
+    def _attempt(self, method, fn):
+        def attempt():
+            fedimg.metrics.inc('fedimg_api_calls_total', region=self.region,
+                               method=method)
+            with self.lease() as driver:
+                return fn(driver)
+        return attempt
+
+    def __repr__(self):
+        return '<PooledDriver {0} {1}>'.format(self.provider, self.region)
+
+
+pool = DriverPool()
+
+
+def ec2_driver(region):
+    """ Returns a pooled EC2 driver for `region` using fedimg's AWS
+    credentials. """
+    return PooledDriver(pool, Provider.EC2, region,
+                        fedimg.AWS_ACCESS_ID, fedimg.AWS_SECRET_KEY)
@@ -0,0 +1,333 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+Writing images straight into EBS snapshots with the EBS direct APIs.
+
+This needs no utility instance: the image is downloaded and decompressed
+locally, and its blocks are sent to a new snapshot with many
+PutSnapshotBlock calls in parallel. Blocks that are all zeros are skipped,
+since unwritten blocks of a snapshot read as zeros anyway.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import base64
+import hashlib
+import json
+import Queue
+import subprocess
+import threading
+import time
+import urlparse
+import uuid
+
+from libcloud.common.aws import AWSDriver, SignedAWSConnection
+from libcloud.common.base import JsonResponse
+from libcloud.compute.base import VolumeSnapshot
+
+import fedimg
+import fedimg.metrics
+from fedimg.drivers import DriverPool, PooledDriver, ec2_driver
+
+EBS_VERSION = '2019-11-02'
+EBS_HOST = 'ebs.%s.amazonaws.com'
+
+# Attempts made at each API call before giving up on the upload
+ATTEMPTS = 5
+
+GiB = 1024 ** 3
+
+
+class EBSUploadException(Exception):
+    """ The image could not be written to a snapshot. """
+    pass
+
+
+class EBSResponse(JsonResponse):
+
+    def parse_error(self):
+        try:
+            message = json.loads(self.body).get('Message', self.body)
+        except ValueError:
+            message = self.body
+        return '{0}: {1}'.format(
+            self.headers.get('x-amzn-errortype', self.status), message)
+
+
+class EBSConnection(SignedAWSConnection):
+    version = EBS_VERSION
+    host = EBS_HOST
+    responseCls = EBSResponse
+    service_name = 'ebs'
+
+
+class EBSDriver(AWSDriver):
+    """ Talks to the EBS direct APIs in one region, or to `endpoint` (a
+    URL such as 'http://localhost:8080') if given. Like any libcloud
+    driver, one instance must only be used by one thread at a time. """
+
+    name = 'Amazon EBS direct APIs'
+    website = 'https://aws.amazon.com/ebs/'
+    connectionCls = EBSConnection
+
+    def __init__(self, key, secret, region, endpoint=None):
+        if endpoint:
+            url = urlparse.urlparse(endpoint)
+            secure = url.scheme == 'https'
+            host = url.hostname
+            port = url.port or (443 if secure else 80)
+        else:
+            secure, host, port = True, EBS_HOST % region, 443
+        self.region_name = region
+        super(EBSDriver, self).__init__(key, secret, secure=secure,
+                                        host=host, port=port, region=region)
+
+    def _ex_connection_class_kwargs(self):
+        kwargs = super(EBSDriver, self)._ex_connection_class_kwargs()
+        kwargs['signature_version'] = '4'
+        return kwargs
+
+    def start_snapshot(self, volume_size, description, client_token,
+                       timeout=60):
+        """ Starts a snapshot of `volume_size` GiB, and returns the
+        StartSnapshot response. Calls with the same `client_token` start
+        only the one snapshot, so the call can safely be retried. The
+        snapshot errors out unless it is completed within `timeout`
+        minutes of the last block written. """
+        data = json.dumps({'VolumeSize': int(volume_size),
+                           'Description': description,
+                           'ClientToken': client_token,
+                           'Timeout': timeout})
+        return self.connection.request(
+            '/snapshots', method='POST', data=data,
+            headers={'Content-Type': 'application/json'}).object
+
+    def put_snapshot_block(self, snapshot_id, index, data, digest):
+        """ Writes block `index` of a snapshot; `digest` is the SHA256
+        digest of `data`. """
+        headers = {'x-amz-Data-Length': str(len(data)),
+                   'x-amz-Checksum': base64.b64encode(digest),
+                   'x-amz-Checksum-Algorithm': 'SHA256',
+                   'Content-Type': 'application/octet-stream'}
+        self.connection.request(
+            '/snapshots/{0}/blocks/{1}'.format(snapshot_id, index),
+            method='PUT', data=data, headers=headers)
+
+    def complete_snapshot(self, snapshot_id, changed_blocks, digest):
+        """ Seals a snapshot once all `changed_blocks` have been written.
+        `digest` is the SHA256 digest of the written blocks' digests,
+        concatenated in block order. """
+        headers = {'x-amz-ChangedBlocksCount': str(changed_blocks),
+                   'x-amz-Checksum': base64.b64encode(digest),
+                   'x-amz-Checksum-Algorithm': 'SHA256',
+                   'x-amz-Checksum-Aggregation-Method': 'LINEAR'}
+        return self.connection.request(
+            '/snapshots/completion/{0}'.format(snapshot_id),
+            method='POST', headers=headers).object
+
+
+# EBS direct API drivers are pooled apart from the EC2 ones, so that enough
+# are kept idle for the block writers of a whole upload
+pool = DriverPool(max_idle=fedimg.AWS_EBS_WORKERS)
+
+
+def ebs_driver(region, endpoint=None):
+    """ Returns a pooled, rate limited EBS direct API driver for `region`
+    using fedimg's AWS credentials. """
+    return PooledDriver(pool, EBSDriver, region, fedimg.AWS_ACCESS_ID,
+                        fedimg.AWS_SECRET_KEY, endpoint=endpoint)
+
+
+def _retry(fn, *args):
+    """ Calls `fn`, retrying with backoff if it raises. """
+    for attempt in range(ATTEMPTS):
+        try:
+            return fn(*args)
+        except Exception:
+            if attempt == ATTEMPTS - 1:
+                raise
+            log.debug('Retrying {0}'.format(fn.__name__))
+            time.sleep(2 ** attempt)
+
+
+def _read_exactly(stream, size):
+    """ Reads `size` bytes from `stream`, or fewer at its end. """
+    chunks = []
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _name(image):
+    return getattr(image, 'name', image)
+
+
+def image_blocks(image, block_size):
+    """ Decompresses a .raw.xz image, yielding its contents in blocks of
+    `block_size` bytes. The last block is padded with zeros. `image` is
+    either an open file, or a URL to download the file from. """
+    processes = []
+    if isinstance(image, basestring):
+        curl = subprocess.Popen(['curl', '--silent', '--fail', '--location',
+                                 image], stdout=subprocess.PIPE)
+        processes.append(curl)
+        source = curl.stdout
+    else:
+        source = image
+    xz = subprocess.Popen(['xz', '--decompress', '--stdout'],
+                          stdin=source, stdout=subprocess.PIPE)
+    processes.insert(0, xz)
+    if processes[1:]:
+        source.close()  # so that curl notices if xz goes away
+    try:
+        while True:
+            block = _read_exactly(xz.stdout, block_size)
+            if not block:
+                break
+            yield block.ljust(block_size, '\0')
+
+        statuses = [process.wait() for process in processes]
+        if any(statuses):
+            raise EBSUploadException(
+                "Reading {0} failed: exit statuses {1}".format(
+                    _name(image), statuses))
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+
+class SnapshotUploader(object):
+    """ Writes images into new snapshots in one region, sending up to
+    `workers` blocks at once. """
+
+    def __init__(self, region, workers=16, endpoint=None):
+        self.region = region
+        self.workers = workers
+        self.driver = ebs_driver(region, endpoint)
+
+    def upload(self, image, volume_size, description):
+        """ Writes `image` (an open .raw.xz file, or its URL) into a new
+        snapshot of `volume_size` GiB and returns the snapshot's ID once
+        every block has been sent. The snapshot may still be 'pending' for
+        a while. If the upload fails, the snapshot is deleted. """
+        started = time.time()
+        snapshot = _retry(self.driver.start_snapshot, volume_size,
+                          description, str(uuid.uuid4()))
+        snapshot_id = snapshot['SnapshotId']
+        completed = False
+        try:
+            self._write(snapshot, image, volume_size)
+            completed = True
+        finally:
+            if not completed:
+                self._delete_snapshot(snapshot_id)
+        fedimg.metrics.observe('fedimg_write_seconds', time.time() - started,
+                               region=self.region, ingestion='direct')
+        return snapshot_id
+
+    def _write(self, snapshot, image, volume_size):
+        """ Sends the blocks of `image` to the started `snapshot`, and
+        completes it. """
+        snapshot_id = snapshot['SnapshotId']
+        block_size = snapshot['BlockSize']
+        max_blocks = int(volume_size) * GiB // block_size
+        zeros = '\0' * block_size
+        log.info('Writing {0} to snapshot {1}'.format(_name(image),
+                                                       snapshot_id))
+
+        # Bounded, so that reading can't run far ahead of the uploads
+        blocks = Queue.Queue(maxsize=self.workers * 2)
+        errors = []
+        threads = [threading.Thread(target=self._put_blocks,
+                                    args=(snapshot_id, blocks, errors),
+                                    name='fedimg-ebs-{0}'.format(i))
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        digests = {}  # block index -> SHA256 digest of written blocks
+        reader = image_blocks(image, block_size)
+        try:
+            for index, block in enumerate(reader):
+                if errors:
+                    break
+                if index >= max_blocks:
+                    raise EBSUploadException(
+                        "{0} is larger than {1} GiB".format(
+                            _name(image), volume_size))
+                if block == zeros:
+                    continue
+                digests[index] = hashlib.sha256(block).digest()
+                blocks.put((index, block, digests[index]))
+        finally:
+            reader.close()
+            for thread in threads:
+                blocks.put(None)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+
+        log.info('Wrote {0} blocks to snapshot {1}'.format(len(digests),
+                                                            snapshot_id))
+        digest = hashlib.sha256(
+            ''.join(digests[i] for i in sorted(digests))).digest()
+        _retry(self.driver.complete_snapshot, snapshot_id, len(digests),
+               digest)
+        fedimg.metrics.inc('fedimg_bytes_written_total',
+                           len(digests) * block_size, region=self.region,
+                           ingestion='direct')
+
+    def _delete_snapshot(self, snapshot_id):
+        """ Deletes the snapshot of a failed upload, logging rather than
+        raising if it can't, so the upload's own error is what is seen. """
+        log.info('Deleting snapshot {0}'.format(snapshot_id))
+        try:
+            ec2_driver(self.region).destroy_volume_snapshot(
+                VolumeSnapshot(snapshot_id, None))
+        except Exception:
+            log.exception('Could not delete snapshot {0}; it errors out '
+                          'once its timeout passes'.format(snapshot_id))
+
+    def _put_blocks(self, snapshot_id, blocks, errors):
+        while True:
+            item = blocks.get()
+            if item is None:
+                return
+            if errors:
+                continue  # drain the queue so the reader isn't stuck
+            index, block, digest = item
+            try:
+                _retry(self.driver.put_snapshot_block, snapshot_id, index,
+                       block, digest)
+            except Exception as e:
+                log.exception('Writing block {0} of {1} failed'.format(
+                    index, snapshot_id))
+                errors.append(e)
@@ -0,0 +1,230 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+A durable journal of upload jobs, kept in a local SQLite database.
+
+Every job records the output of each of its stages (the IDs of the nodes,
+volumes, snapshots and AMIs it made) as it goes. If the process dies part
+way through, the job can be picked up again from its last checkpoint
+instead of starting over with a new utility instance and download.
+
+The journal also indexes every AMI variant of every compose's images by
+whether it is being or has been uploaded, so that the same compose is
+never uploaded twice over.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import fedimg
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_key TEXT PRIMARY KEY,
+    raw_url TEXT NOT NULL,
+    compose_meta TEXT NOT NULL,
+    state TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    job_key TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    completed INTEGER NOT NULL,
+    outputs TEXT NOT NULL,
+    PRIMARY KEY (job_key, stage)
+);
+CREATE TABLE IF NOT EXISTS variants (
+    compose_id TEXT NOT NULL,
+    raw_url TEXT NOT NULL,
+    virt_type TEXT NOT NULL,
+    vol_type TEXT NOT NULL,
+    state TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (compose_id, raw_url, virt_type, vol_type)
+);
+"""
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Journal(object):
+    """ The job journal stored at `path`. One journal may be shared by all
+    the threads of a process. """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.executescript(SCHEMA)
+
+    def start(self, job_key, raw_url, compose_meta):
+        """ Records that a job is running, and returns True if it is picking
+        up where an earlier, unfinished run of the same job left off. A
+        job that had finished before starts over from scratch. """
+        with self._lock, self._db:
+            row = self._db.execute(
+                'SELECT state FROM jobs WHERE job_key = ?',
+                (job_key,)).fetchone()
+            resuming = row is not None and row[0] == RUNNING
+            if not resuming:
+                self._db.execute(
+                    'DELETE FROM checkpoints WHERE job_key = ?', (job_key,))
+            self._db.execute(
+                'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?)',
+                (job_key, raw_url, json.dumps(compose_meta), RUNNING,
+                 time.time()))
+        return resuming
+
+    def queue(self, job_key, raw_url, compose_meta):
+        """ Records that a job is waiting to run, so that it still runs
+        after a restart if it hadn't started. A job that is running
+        already is left as it is. """
+        with self._lock, self._db:
+            row = self._db.execute(
+                'SELECT state FROM jobs WHERE job_key = ?',
+                (job_key,)).fetchone()
+            if row is not None and row[0] == RUNNING:
+                return
+            self._db.execute(
+                'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?)',
+                (job_key, raw_url, json.dumps(compose_meta), QUEUED,
+                 time.time()))
+
+    def unqueue(self, job_key):
+        """ Forgets a queued job that is not going to run after all. """
+        with self._lock, self._db:
+            self._db.execute(
+                'DELETE FROM jobs WHERE job_key = ? AND state = ?',
+                (job_key, QUEUED))
+
+    def checkpoint(self, job_key, stage, outputs, completed=True):
+        """ Records the outputs of `stage` so far. Stages that are still
+        in progress record `completed=False`. """
+        with self._lock, self._db:
+            # Replacing a row gives it a new rowid, so rows stay in the
+            # order they were last written.
+            self._db.execute(
+                'INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)',
+                (job_key, stage, int(completed), json.dumps(outputs)))
+            self._db.execute(
+                'UPDATE jobs SET updated = ? WHERE job_key = ?',
+                (time.time(), job_key))
+
+    def checkpoints(self, job_key):
+        """ Returns the (stage, completed, outputs) checkpoints of a job,
+        oldest first. """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT stage, completed, outputs FROM checkpoints '
+                'WHERE job_key = ? ORDER BY rowid', (job_key,)).fetchall()
+        return [(stage, bool(completed), json.loads(outputs))
+                for stage, completed, outputs in rows]
+
+    def finish(self, job_key, state):
+        """ Marks a job as DONE or FAILED. The checkpoints of a failed job
+        are dropped, since cleaning up after it removes what they name. """
+        with self._lock, self._db:
+            if state == FAILED:
+                self._db.execute(
+                    'DELETE FROM checkpoints WHERE job_key = ?', (job_key,))
+            self._db.execute(
+                'UPDATE jobs SET state = ?, updated = ? WHERE job_key = ?',
+                (state, time.time(), job_key))
+
+    def claim(self, compose_id, raw_url, variants):
+        """ Marks each (virt_type, vol_type) of `variants` of an image from
+        a compose as RUNNING, unless it is running or DONE already, and
+        returns the ones that were marked: those still to be uploaded. """
+        claimed = []
+        with self._lock, self._db:
+            for virt_type, vol_type in variants:
+                key = (compose_id, raw_url, virt_type, vol_type)
+                row = self._db.execute(
+                    'SELECT state FROM variants WHERE compose_id = ? AND '
+                    'raw_url = ? AND virt_type = ? AND vol_type = ?',
+                    key).fetchone()
+                if row is not None and row[0] in (RUNNING, DONE):
+                    continue
+                self._db.execute(
+                    'INSERT OR REPLACE INTO variants '
+                    'VALUES (?, ?, ?, ?, ?, ?)', key + (RUNNING, time.time()))
+                claimed.append((virt_type, vol_type))
+        return claimed
+
+    def claimed(self, compose_id, raw_url):
+        """ Returns the variants of an image from a compose that are
+        marked RUNNING. """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT virt_type, vol_type FROM variants WHERE '
+                'compose_id = ? AND raw_url = ? AND state = ? ORDER BY rowid',
+                (compose_id, raw_url, RUNNING)).fetchall()
+        return [tuple(row) for row in rows]
+
+    def settle(self, compose_id, raw_url, variants, state):
+        """ Marks `variants` of an image as DONE, or as FAILED so that they
+        can be claimed again. """
+        with self._lock, self._db:
+            for virt_type, vol_type in variants:
+                self._db.execute(
+                    'UPDATE variants SET state = ?, updated = ? WHERE '
+                    'compose_id = ? AND raw_url = ? AND virt_type = ? AND '
+                    'vol_type = ?',
+                    (state, time.time(), compose_id, raw_url, virt_type,
+                     vol_type))
+
+    def unfinished(self):
+        """ Returns (raw_url, compose_meta) for every job that was still
+        queued or running when it was last heard from. """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT raw_url, compose_meta FROM jobs WHERE state IN '
+                '(?, ?) ORDER BY updated', (QUEUED, RUNNING)).fetchall()
+        return [(raw_url, json.loads(meta)) for raw_url, meta in rows]
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    """ Returns the process-wide journal, or None if the `journal_path`
+    option is empty and journaling is disabled. """
+    global _journal
+    with _journal_lock:
+        if _journal is None and fedimg.JOURNAL_PATH:
+            _journal = Journal(fedimg.JOURNAL_PATH)
+        return _journal
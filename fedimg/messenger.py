@@ -1,5 +1,5 @@
 # This file is part of fedimg.
-# Copyright (C) 2014 Red Hat, Inc.
+# Copyright (C) 2014-2015 Red Hat, Inc.
 #
 # fedimg is free software: you can redistribute it and/or modify
 # it under the terms of the GNU Affero General Public License as
@@ -19,26 +19,184 @@
 # Authors:  David Gay <dgay@redhat.com>
 #
 
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import atexit
+import json
+import os
+import Queue
+import threading
+
 import fedmsg
 
+import fedimg
+
 """
 The latest Fedmsg meta code for Fedimg fedmsgs (what a mouthful!):
 https://github.com/fedora-infra/fedmsg_meta_fedora_infrastructure/blob/develop/fedmsg_meta_fedora_infrastructure/fedimg.py
+
+Messages are handed to a single background publisher thread, so the threads
+running uploads never wait on fedmsg, and fedmsg only needs one endpoint.
 """
 
 
+class Publisher(object):
+    """ Publishes fedmsgs from a thread of its own. Messages wait in a queue
+    of at most `max_queued`; once it is full, further messages are appended
+    to the file `spill_path`, or dropped if there is no `spill_path` or the
+    file has grown to `max_spilled` bytes. While any messages are spilled,
+    new ones are spilled after them, so that messages are published in the
+    order they came in. Messages spilled by an earlier run are published
+    before any new ones. """
+
+    def __init__(self, max_queued=1000, spill_path=None,
+                 max_spilled=64 * 1024 ** 2):
+        self.spill_path = spill_path
+        self.max_spilled = max_spilled
+        self.dropped = 0
+        self._queue = Queue.Queue(max_queued)
+        self._spill_lock = threading.Lock()
+        self._caught_up = threading.Condition(self._spill_lock)
+        self._spilled = 0  # bytes in the spill file
+        self._spilling = False
+        if spill_path:
+            if os.path.exists(spill_path):
+                self._spilled = os.path.getsize(spill_path)
+            self._spilling = (bool(self._spilled) or
+                              os.path.exists(spill_path + '.replay'))
+        self._thread = threading.Thread(target=self._run,
+                                        name='fedimg-publisher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def publish(self, topic, msg):
+        """ Queues a message for publishing, without ever blocking. """
+        with self._spill_lock:
+            if not self._spilling:
+                try:
+                    self._queue.put_nowait((topic, msg))
+                    return
+                except Queue.Full:
+                    pass
+            self._spill(topic, msg)
+
+    def flush(self, timeout=None):
+        """ Waits up to `timeout` seconds for the queued and spilled
+        messages to be published. Returns True if they all were. """
+        finished = threading.Event()
+
+        def _wait():
+            self._queue.join()
+            with self._spill_lock:
+                while self._spilling:
+                    self._caught_up.wait()
+            finished.set()
+
+        waiter = threading.Thread(target=_wait)
+        waiter.daemon = True
+        waiter.start()
+        return finished.wait(timeout)
+
+    def _spill(self, topic, msg):
+        """ Appends a message to the spill file. Only call this holding
+        `_spill_lock`. """
+        try:
+            line = json.dumps({'topic': topic, 'msg': msg}) + '\n'
+        except (TypeError, ValueError):
+            # Such as check output that isn't valid UTF-8
+            self.dropped += 1
+            log.exception('Cannot spill %r message; dropped it' % topic)
+            return
+        if not self.spill_path or self._spilled + len(line) > self.max_spilled:
+            self.dropped += 1
+            log.warn('Message queue is full; dropped %r message' % topic)
+            return
+        with open(self.spill_path, 'a') as f:
+            f.write(line)
+        self._spilled += len(line)
+        self._spilling = True
+
+    def _replay(self):
+        """ Publishes the spilled messages, oldest first, and stops
+        spilling once there are none left. A restart part of the way
+        through publishes the rest again from the start. """
+        replay = self.spill_path + '.replay'
+        with self._spill_lock:
+            if not os.path.exists(replay):
+                if not os.path.exists(self.spill_path):
+                    self._spilling = False
+                    self._caught_up.notify_all()
+                    return
+                os.rename(self.spill_path, replay)
+                self._spilled = 0
+        with open(replay) as f:
+            for line in f:
+                try:
+                    spilled = json.loads(line)
+                except ValueError:
+                    log.error('Skipped unreadable spilled message %r' % line)
+                    continue
+                self._send(spilled['topic'], spilled['msg'])
+        os.remove(replay)
+
+    def _send(self, topic, msg):
+        try:
+            fedmsg.publish(topic=topic, modname='fedimg', msg=msg)
+        except Exception:
+            log.exception('Failed to publish %r message' % topic)
+
+    def _run(self):
+        while True:
+            # New messages are spilled, not queued, until the spilled ones
+            # are out
+            if self._spilling and self._queue.empty():
+                try:
+                    self._replay()
+                except Exception:
+                    # Publish new messages rather than stop altogether;
+                    # the spill file is left for the next run
+                    log.exception('Failed to read spilled messages')
+                    with self._spill_lock:
+                        self._spilling = False
+                        self._caught_up.notify_all()
+                continue
+
+            topic, msg = self._queue.get()
+            self._send(topic, msg)
+            self._queue.task_done()
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    """ Returns the process-wide publisher, starting it if need be. Queued
+    messages are given a few seconds to go out when the process exits. """
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = Publisher(fedimg.MESSAGE_QUEUE_SIZE,
+                                   fedimg.MESSAGE_SPILL_PATH,
+                                   fedimg.MESSAGE_SPILL_SIZE)
+            atexit.register(_publisher.flush, 5)
+        return _publisher
+
+
 def message(topic, image_url, dest, status, compose, extra=None):
     """ Takes a message topic, image name, an upload destination (ex.
     "EC2-eu-west-1"), and a status (ex. "failed"). Can also take an optional
     dictionary of addiitonal bits of information, such as an AMI ID for an
-    image registered to AWS EC2. Emits a fedmsg appropriate
+    image registered to AWS EC2. Queues a fedmsg appropriate
     for each image task (an upload or a test). """
 
     extra = extra or dict()
 
     image_name = image_url.split('/')[-1].replace('.raw.xz', '')
 
-    fedmsg.publish(topic=topic, modname='fedimg', msg={
+    get_publisher().publish(topic, {
         'image_url': image_url,
         'image_name': image_name,
         'destination': dest,
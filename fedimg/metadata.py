@@ -0,0 +1,117 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+"""
+Lookups of the images in a compose's metadata.
+
+Only the compose's images.json is fetched, rather than all of its metadata.
+When ijson is installed, the file is parsed as it streams in and only the
+images asked for are kept. Results are cached per compose for a while, and
+can be fetched in the background before they are needed.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import collections
+import json
+import threading
+import time
+
+import fedfind.release
+import requests
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+from fedimg.pipeline import run_in_thread
+from fedimg.util import safeget
+
+
+def extract_images(fileobj, variant='CloudImages', arch='x86_64'):
+    """ Returns the list of `variant` images for `arch` in the images.json
+    file open as `fileobj`. """
+    if ijson is not None:
+        prefix = 'payload.images.{0}.{1}.item'.format(variant, arch)
+        return list(ijson.items(fileobj, prefix))
+    images = json.load(fileobj)
+    return safeget(images, 'payload', 'images', variant, arch) or []
+
+
+def fetch_images(compose_id, location, variant='CloudImages', arch='x86_64'):
+    """ Returns the list of `variant` images for `arch` in the compose
+    `compose_id` at `location`. If its images.json can't be fetched, the
+    metadata is looked up with fedfind instead. """
+    url = '{0}/metadata/images.json'.format(location)
+    try:
+        response = requests.get(url, stream=True, timeout=60)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        log.warn('Could not fetch %s (%s); asking fedfind' % (url, e))
+        metadata = fedfind.release.get_release_cid(compose_id).metadata
+        return safeget(metadata, 'images', 'payload', 'images', variant,
+                       arch) or []
+
+    try:
+        response.raw.decode_content = True
+        return extract_images(response.raw, variant, arch)
+    finally:
+        response.close()
+
+
+class MetadataCache(object):
+    """ Caches the cloud images of up to `max_entries` composes, for `ttl`
+    seconds each, evicting the least recently used first. Lookups of a
+    compose that is still being fetched wait on that same fetch. """
+
+    def __init__(self, ttl, max_entries=32):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # compose ID -> (expiry time, future), least recently used first
+        self._entries = collections.OrderedDict()
+
+    def prefetch(self, compose_id, location):
+        """ Starts fetching the images of a compose in the background,
+        unless they are cached already, and returns a `Future` for them. """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(compose_id, None)
+            if entry is not None:
+                expires, future = entry
+                failed = future.done() and future.exception() is not None
+                if expires > now and not failed:
+                    self._entries[compose_id] = entry
+                    return future
+
+            future = run_in_thread(fetch_images, compose_id, location)
+            self._entries[compose_id] = (now + self.ttl, future)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return future
+
+    def get(self, compose_id, location, timeout=None):
+        """ Returns the images of a compose, waiting for them to be fetched
+        if need be. """
+        return self.prefetch(compose_id, location).result(timeout)
@@ -0,0 +1,250 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+"""
+Counters, gauges and timing histograms for the upload process.
+
+Each metric is labelled, for instance by region, virt_type and vol_type. The
+current values can be scraped from a local HTTP endpoint in the Prometheus
+text format, and every update can also be sent on to statsd.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import BaseHTTPServer
+import contextlib
+import socket
+import threading
+import time
+
+import fedimg
+
+# Upper bounds of the histogram buckets, in seconds. Uploads spend anything
+# from a second on an API call to an hour on an AMI copy.
+BUCKETS = (0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+
+
+class StatsdSink(object):
+    """ Sends metric updates to statsd at `host`:`port` over UDP. statsd has
+    no labels, so label values are appended to the metric name. """
+
+    def __init__(self, host, port=8125, prefix='fedimg'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _name(self, name, labels):
+        parts = [self.prefix, name] + [
+            str(value).replace('.', '_').replace(':', '_')
+            for _, value in labels]
+        return '.'.join(parts)
+
+    def _send(self, line):
+        try:
+            self._sock.sendto(line, self.address)
+        except socket.error:
+            pass  # metrics are not worth failing an upload over
+
+    def inc(self, name, labels, value):
+        self._send('{0}:{1}|c'.format(self._name(name, labels), value))
+
+    def gauge(self, name, labels, value):
+        self._send('{0}:{1}|g'.format(self._name(name, labels), value))
+
+    def observe(self, name, labels, value):
+        self._send('{0}:{1}|ms'.format(self._name(name, labels),
+                                       int(value * 1000)))
+
+
+class Registry(object):
+    """ Holds the current value of every metric, keyed by name and by the
+    sorted (label, value) pairs of each series. One registry may be shared
+    by all the threads of a process. """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.sinks = []
+        self._lock = threading.Lock()
+        self._counters = {}  # name -> {labels: value}
+        self._gauges = {}
+        self._histograms = {}  # name -> {labels: [bucket counts, sum]}
+
+    def inc(self, name, value=1, **labels):
+        """ Adds `value` to a counter. """
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+        for sink in self.sinks:
+            sink.inc(name, labels, value)
+
+    def gauge(self, name, value, **labels):
+        """ Sets a gauge to `value`. """
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            self._gauges.setdefault(name, {})[labels] = value
+        for sink in self.sinks:
+            sink.gauge(name, labels, value)
+
+    def observe(self, name, value, **labels):
+        """ Adds `value` to a histogram. """
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if labels not in series:
+                series[labels] = _Histogram(self.buckets)
+            series[labels].observe(value)
+        for sink in self.sinks:
+            sink.observe(name, labels, value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """ Adds the time spent in a `with` block to a histogram of
+        seconds, even if the block raises. """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def value(self, name, **labels):
+        """ Returns the current value of a counter or gauge, or the number
+        of observations in a histogram; None if there is no such series. """
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            for metrics in (self._counters, self._gauges):
+                if labels in metrics.get(name, {}):
+                    return metrics[name][labels]
+            if labels in self._histograms.get(name, {}):
+                return self._histograms[name][labels].count
+        return None
+
+    def render(self):
+        """ Returns every metric in the Prometheus text format. """
+        lines = []
+        with self._lock:
+            for kind, metrics in (('counter', self._counters),
+                                  ('gauge', self._gauges)):
+                for name in sorted(metrics):
+                    lines.append('# TYPE {0} {1}'.format(name, kind))
+                    for labels, value in sorted(metrics[name].items()):
+                        lines.append('{0}{1} {2}'.format(
+                            name, _format_labels(labels), value))
+            for name in sorted(self._histograms):
+                lines.append('# TYPE {0} histogram'.format(name))
+                for labels, hist in sorted(self._histograms[name].items()):
+                    bounds = [str(b) for b in self.buckets] + ['+Inf']
+                    for bound, count in zip(bounds,
+                                            hist.counts + [hist.count]):
+                        lines.append('{0}_bucket{1} {2}'.format(
+                            name, _format_labels(labels + (('le', bound),)),
+                            count))
+                    lines.append('{0}_sum{1} {2}'.format(
+                        name, _format_labels(labels), hist.total))
+                    lines.append('{0}_count{1} {2}'.format(
+                        name, _format_labels(labels), hist.count))
+        return '\n'.join(lines) + '\n'
+
+
+class _Histogram(object):
+    """ Cumulative counts of observations per bucket, as Prometheus has
+    them. """
+
+    __slots__ = ('buckets', 'counts', 'count', 'total')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.total += value
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(key, str(value).replace('\\', '\\\\')
+                           .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels) + '}'
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves the registry on /metrics. """
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes every few seconds would drown out the log
+
+
+def serve(port, host='127.0.0.1'):
+    """ Serves the metrics on http://`host`:`port`/metrics from a
+    background thread, and returns the server. """
+    server = BaseHTTPServer.HTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='fedimg-metrics')
+    thread.daemon = True
+    thread.start()
+    log.info('Serving metrics on {0}:{1}'.format(*server.server_address))
+    return server
+
+
+registry = Registry()
+inc = registry.inc
+gauge = registry.gauge
+observe = registry.observe
+timer = registry.timer
+
+_started = False
+_started_lock = threading.Lock()
+
+
+def start():
+    """ Starts the metrics endpoint and statsd sink that are configured,
+    once per process. """
+    global _started
+    with _started_lock:
+        if _started:
+            return
+        _started = True
+    if fedimg.STATSD_HOST:
+        registry.sinks.append(StatsdSink(fedimg.STATSD_HOST,
+                                         fedimg.STATSD_PORT))
+    if fedimg.METRICS_PORT:
+        serve(fedimg.METRICS_PORT)
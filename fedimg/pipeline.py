@@ -0,0 +1,394 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+An event-driven engine for running long, mostly-idle upload jobs.
+
+Jobs are plain generators. Whenever a job would otherwise block, it yields
+one of the following to the engine and is resumed later:
+
+-   a number: resume after that many seconds,
+-   a `Future`: resume once it is done, receiving its result,
+-   a generator: run it as a sub-step, resuming once it finishes,
+-   a list of any of those: resume once all of them are done.
+
+A job (or sub-step) hands a value back to its caller by raising `Return`.
+Only the short stretches of work between two yields occupy one of the
+engine's worker threads, so a handful of threads can drive hundreds of
+concurrent jobs. Blocking calls, such as cloud API requests and file
+transfers, are handed to a bounded pool of threads with `run_in_thread`.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import collections
+import heapq
+import itertools
+import threading
+import time
+import types
+
+import fedimg
+
+
+class Return(Exception):
+    """ Raised by a job or sub-step to hand `value` back to its caller. """
+
+    def __init__(self, value=None):
+        super(Return, self).__init__()
+        self.value = value
+
+
+class Future(object):
+    """ The eventual result of something running in the background. """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self, timeout=None):
+        """ Blocks until the future is done and returns its result, raising
+        its exception instead if there was one. """
+        with self._cond:
+            if timeout is None:
+                while not self._done:
+                    self._cond.wait()
+            elif not self._done:
+                self._cond.wait(timeout)
+            if not self._done:
+                raise RuntimeError("Timed out waiting for future")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """ Calls `fn(future)` once the future is done. """
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        self._finish(None, exception)
+
+    def _finish(self, result, exception):
+        with self._cond:
+            if self._done:
+                return
+            self._result = result
+            self._exception = exception
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, []
+            self._cond.notify_all()
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                log.exception("Exception in future callback")
+
+
+def gather(futures):
+    """ Returns a future that is done once all `futures` are. Its result is
+    the list of their results; if any of them failed, the first exception
+    is raised instead, but only after all of them have finished. """
+    combined = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def _one_done(future):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        for f in futures:
+            if f.exception() is not None:
+                combined.set_exception(f.exception())
+                return
+        combined.set_result([f.result() for f in futures])
+
+    if not futures:
+        combined.set_result([])
+    for future in futures:
+        future.add_done_callback(_one_done)
+    return combined
+
+
+class Semaphore(object):
+    """ Limits how many jobs may hold a slot at once. Waiting for a slot
+    is done by yielding `acquire()`, so it never blocks a thread. """
+
+    def __init__(self, value):
+        self._lock = threading.Lock()
+        self._value = value
+        self._waiters = collections.deque()
+
+    def acquire(self):
+        """ Returns a future that is done once a slot has been granted. """
+        future = Future()
+        with self._lock:
+            if self._value > 0:
+                self._value -= 1
+                granted = True
+            else:
+                self._waiters.append(future)
+                granted = False
+        if granted:
+            future.set_result(None)
+        return future
+
+    def release(self):
+        """ Gives a slot back, handing it straight to the next waiter. """
+        with self._lock:
+            if self._waiters:
+                future = self._waiters.popleft()
+            else:
+                self._value += 1
+                future = None
+        if future is not None:
+            future.set_result(None)
+
+
+class Task(Future):
+    """ A job being driven by a `PipelineEngine`. It is a `Future` for the
+    value the job's generator hands back with `Return`. """
+
+    def __init__(self, engine, gen, name=None):
+        super(Task, self).__init__()
+        self.engine = engine
+        self.name = name or getattr(gen, '__name__', 'job')
+        self._stack = [gen]
+
+    def _advance(self, value=None, exception=None):
+        """ Runs the job until it yields something to wait for, or ends. """
+        while True:
+            gen = self._stack[-1]
+            try:
+                if exception is not None:
+                    yielded = gen.throw(exception)
+                else:
+                    yielded = gen.send(value)
+            except (StopIteration, Return) as e:
+                self._stack.pop()
+                value = getattr(e, 'value', None)
+                exception = None
+                if not self._stack:
+                    self.set_result(value)
+                    return
+                continue
+            except Exception as e:
+                self._stack.pop()
+                value = None
+                exception = e
+                if not self._stack:
+                    log.debug("Job %s failed: %r" % (self.name, e))
+                    self.set_exception(e)
+                    return
+                continue
+
+            value = exception = None
+            if isinstance(yielded, types.GeneratorType):
+                # Run the sub-step in place, on top of the current one
+                self._stack.append(yielded)
+                continue
+
+            try:
+                future = self.engine.to_future(yielded)
+            except Exception as e:
+                exception = e
+                continue
+            future.add_done_callback(self._resume)
+            return
+
+    def _resume(self, future):
+        self.engine._schedule(self, future)
+
+
+class PipelineEngine(object):
+    """ Drives many generator jobs on a small, fixed set of worker threads.
+    Waiting jobs cost no thread at all; a timer heap and future callbacks
+    put them back on the run queue when they can make progress. """
+
+    def __init__(self, workers=4, name='fedimg-pipeline'):
+        self._cond = threading.Condition()
+        self._ready = collections.deque()  # (task, future) pairs to run
+        self._timers = []  # heap of (deadline, seq, future)
+        self._seq = itertools.count()
+        self._running = True
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work,
+                                      name='{0}-{1}'.format(name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, gen, name=None):
+        """ Starts running the generator `gen` and returns its `Task`. """
+        task = Task(self, gen, name=name)
+        self._schedule(task, None)
+        return task
+
+    def sleep(self, seconds):
+        """ Returns a future that is done after `seconds`. """
+        future = Future()
+        with self._cond:
+            heapq.heappush(self._timers, (time.time() + seconds,
+                                          next(self._seq), future))
+            self._cond.notify()
+        return future
+
+    def to_future(self, yielded):
+        """ Turns anything a job may yield into a `Future`. """
+        if isinstance(yielded, Future):
+            return yielded
+        if isinstance(yielded, (int, long, float)):
+            return self.sleep(yielded)
+        if isinstance(yielded, types.GeneratorType):
+            return self.submit(yielded)
+        if isinstance(yielded, (list, tuple)):
+            return gather([self.to_future(y) for y in yielded])
+        raise TypeError("Cannot wait on %r" % (yielded,))
+
+    def shutdown(self, wait=False):
+        """ Stops the worker threads once they are idle, waiting for them
+        to exit if `wait` is set. """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _schedule(self, task, future):
+        with self._cond:
+            self._ready.append((task, future))
+            self._cond.notify()
+
+    def _work(self):
+        while True:
+            due = []
+            job = None
+            with self._cond:
+                while self._running:
+                    now = time.time()
+                    while self._timers and self._timers[0][0] <= now:
+                        due.append(heapq.heappop(self._timers)[2])
+                    if self._ready:
+                        job = self._ready.popleft()
+                    if due or job:
+                        break
+                    timeout = None
+                    if self._timers:
+                        timeout = self._timers[0][0] - now
+                    self._cond.wait(timeout)
+                if not (due or job):
+                    return
+
+            # Resolve timers outside the lock, since their callbacks
+            # schedule the waiting tasks again.
+            for future in due:
+                future.set_result(None)
+
+            if job:
+                task, future = job
+                if future is None:
+                    task._advance()
+                elif future.exception() is not None:
+                    task._advance(exception=future.exception())
+                else:
+                    task._advance(value=future.result())
+
+
+class ThreadPool(object):
+    """ Runs blocking calls on up to `size` threads, which are started as
+    they are needed. Calls beyond that wait in turn for a free thread. """
+
+    def __init__(self, size, name='fedimg-blocking'):
+        self.size = size
+        self.name = name
+        self._cond = threading.Condition()
+        self._calls = collections.deque()
+        self._threads = 0
+        self._idle = 0  # threads waiting for a call and not yet woken
+
+    def submit(self, fn, *args, **kwargs):
+        """ Calls `fn` on one of the pool's threads and returns a `Future`
+        for its result. """
+        future = Future()
+        with self._cond:
+            self._calls.append((future, fn, args, kwargs))
+            if self._idle:
+                self._idle -= 1
+                self._cond.notify()
+            elif self._threads < self.size:
+                thread = threading.Thread(
+                    target=self._work,
+                    name='{0}-{1}'.format(self.name, self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads += 1
+        return future
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._calls:
+                    self._idle += 1
+                    self._cond.wait()
+                future, fn, args, kwargs = self._calls.popleft()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+
+blocking_pool = ThreadPool(fedimg.BLOCKING_THREADS)
+
+
+def run_in_thread(fn, *args, **kwargs):
+    """ Calls `fn` on a thread of `blocking_pool` and returns a `Future` for
+    its result, so that jobs can wait on long blocking work without holding
+    up one of the engine's workers. """
+    return blocking_pool.submit(fn, *args, **kwargs)
+
+
+def run_sync(gen):
+    """ Runs the generator job `gen` to completion on a private engine and
+    returns its result. Useful for callers that want to block. """
+    engine = PipelineEngine(workers=1, name='fedimg-sync')
+    try:
+        return engine.submit(gen).result()
+    finally:
+        engine.shutdown(wait=True)
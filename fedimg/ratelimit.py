@@ -0,0 +1,202 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+Process-wide limits on the rate of cloud API calls.
+
+EC2 meters requests per account and region with token buckets, one for each
+family of API actions, and refuses calls beyond them with
+RequestLimitExceeded. Every job polling and mutating on its own would run
+into that quickly, so all driver calls take a token from a bucket of ours
+first, per (account, region, family). When EC2 throttles a call anyway, the
+bucket's rate is halved and the call retried; calls that go through win the
+rate back a little at a time.
+
+Jobs on the pipeline engine make their calls through `RateLimiter.job`,
+which hands the waits for a token or a retry to the engine, and the calls
+themselves to `run_in_thread`, so that they don't hold up a worker thread.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import random
+import threading
+import time
+
+import fedimg
+import fedimg.metrics
+from fedimg.pipeline import Return, run_in_thread
+
+# How often a throttled call is tried before giving up
+ATTEMPTS = 6
+
+# Driver methods that launch instances or create AMIs, which EC2 meters
+# most strictly
+INTENSIVE = frozenset(['create_node', 'copy_image', 'ex_register_image'])
+
+# EBS direct API methods that send snapshot data, which have a far higher
+# quota of their own
+BLOCKS = frozenset(['put_snapshot_block'])
+
+
+def family_of(method):
+    """ Returns the family of API actions that the driver method `method`
+    belongs to: 'describe', 'mutate', 'intensive' or 'blocks'. """
+    if method in INTENSIVE:
+        return 'intensive'
+    if method in BLOCKS:
+        return 'blocks'
+    if method.startswith(('list_', 'describe_', 'get_', 'ex_list_',
+                          'ex_describe_', 'ex_get_')):
+        return 'describe'
+    return 'mutate'
+
+
+def is_throttling(exception):
+    """ Whether `exception` is the cloud refusing a call for being over its
+    rate limit. """
+    message = str(getattr(exception, 'message', '') or exception)
+    return any(code in message for code in (
+        'RequestLimitExceeded', 'Throttling', 'RequestThrottled',
+        'TooManyRequests'))
+
+
+class TokenBucket(object):
+    """ Hands out `rate` tokens a second, up to `burst` at once. Each
+    throttling response halves the rate, down to `min_rate`, and each call
+    that goes through wins back a twentieth of the configured rate. """
+
+    def __init__(self, rate, burst, min_rate=None):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.min_rate = min_rate or self.max_rate / 16
+        self.tokens = self.burst
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """ Takes a token, and returns how many seconds to wait before
+        using it. Tokens can be taken ahead of time, so callers are served
+        in turn. """
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate,
+                                self.rate + self.max_rate / 20)
+
+
+class RateLimiter(object):
+    """ Keeps a `TokenBucket` per (account, region, family of API actions).
+    `rates` maps each family to its (rate, burst). Throttled calls are
+    retried after `base_backoff` seconds, doubling each time up to
+    `max_backoff`, with jitter. """
+
+    def __init__(self, rates, base_backoff=1, max_backoff=30):
+        self.rates = rates
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def bucket(self, account, region, family):
+        key = (account, region, family)
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(*self.rates[family])
+            return self._buckets[key]
+
+    def call(self, account, region, method, fn, *args, **kwargs):
+        """ Like `job`, but calls `fn` on the calling thread, sleeps through
+        the waits and returns what `fn` returns, for callers that aren't jobs
+        on the pipeline engine. """
+        attempts = self._attempts(account, region, method, False, fn, args,
+                                  kwargs)
+        try:
+            while True:
+                time.sleep(next(attempts))
+        except Return as r:
+            return r.value
+
+    def job(self, account, region, method, fn, *args, **kwargs):
+        """ Calls `fn`, for the API method `method`, once its bucket has a
+        token for it. If the call is throttled, it is tried again with
+        backoff up to `ATTEMPTS` times. This is a generator job, which
+        yields the seconds it has to wait and the call itself, run with
+        `run_in_thread`, and hands back what `fn` returns. """
+        return self._attempts(account, region, method, True, fn, args, kwargs)
+
+    def _attempts(self, account, region, method, in_thread, fn, args, kwargs):
+        family = family_of(method)
+        bucket = self.bucket(account, region, family)
+        for attempt in range(ATTEMPTS):
+            waited = bucket.reserve()
+            if waited:
+                fedimg.metrics.observe('fedimg_api_limit_wait_seconds',
+                                       waited, region=region, family=family)
+                yield waited
+            try:
+                if in_thread:
+                    result = yield run_in_thread(fn, *args, **kwargs)
+                else:
+                    result = fn(*args, **kwargs)
+            except Exception as e:
+                if not is_throttling(e) or attempt == ATTEMPTS - 1:
+                    raise
+                bucket.throttled()
+                fedimg.metrics.inc('fedimg_api_throttled_total',
+                                   region=region, family=family)
+                log.warn('{0} throttled in {1}, now limited to {2:.2f} '
+                         'calls/s'.format(method, region, bucket.rate))
+                delay = min(self.max_backoff,
+                            self.base_backoff * 2 ** attempt)
+                yield random.uniform(delay / 2.0, delay)
+                continue
+            bucket.succeeded()
+            raise Return(result)
+
+
+def default_rates():
+    """ Returns the (rate, burst) of each family, as configured. Bursts are
+    five seconds' worth of calls. """
+    return dict((family, (rate, max(1, rate * 5))) for family, rate in (
+        ('describe', fedimg.AWS_DESCRIBE_RATE),
+        ('mutate', fedimg.AWS_MUTATE_RATE),
+        ('intensive', fedimg.AWS_INTENSIVE_RATE),
+        ('blocks', fedimg.AWS_EBS_BLOCK_RATE),
+    ))
+
+
+limiter = RateLimiter(default_rates())
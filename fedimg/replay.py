@@ -0,0 +1,346 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+"""
+Replays compose status messages through the consumer, faster than they
+were sent, to measure the ingestion path: how long `consume` takes, how
+deep the coalescing and upload queues get, and how memory grows.
+
+Messages can be recorded from datagrepper with `fetch_messages()` and
+`record()`, or made up with `synthetic_messages()`. `replay()` feeds them
+to a `FedimgConsumer` whose compose metadata and uploads are stubbed out.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import collections
+import datetime
+import functools
+import gc
+import hashlib
+import json
+import random
+import resource
+import threading
+import time
+
+import requests
+
+import fedimg
+import fedimg.consumers
+import fedimg.metadata
+import fedimg.pipeline
+import fedimg.uploader
+from fedimg.pipeline import Return
+from fedimg.simulation import ScaledEngine, patched
+
+TOPIC = 'org.fedoraproject.prod.pungi.compose.status.change'
+DATAGREPPER_URL = 'https://apps.fedoraproject.org/datagrepper/raw'
+
+
+def fetch_messages(days, url=DATAGREPPER_URL):
+    """ Yields the compose status messages of the last `days` days from
+    datagrepper, oldest first. """
+    delta = int(datetime.timedelta(days=days).total_seconds())
+    page, pages = 1, 1
+    while page <= pages:
+        log.debug("Getting page %i of %i", page, pages)
+        response = requests.get(url, timeout=60, params=dict(
+            topic=TOPIC,
+            delta=delta,
+            page=page,
+            rows_per_page=100,
+            order='asc',
+        ))
+        response.raise_for_status()
+        data = response.json()
+        pages = data['pages']
+        for message in data['raw_messages']:
+            yield message
+        page += 1
+
+
+def record(fileobj, messages):
+    """ Writes `messages` to `fileobj`, one JSON document per line, and
+    returns how many there were. """
+    count = 0
+    for message in messages:
+        fileobj.write(json.dumps(message) + '\n')
+        count += 1
+    return count
+
+
+def load(fileobj):
+    """ Returns the messages recorded in `fileobj`, oldest first. """
+    messages = [json.loads(line) for line in fileobj if line.strip()]
+    return sorted(messages, key=lambda message: message['timestamp'])
+
+
+def synthetic_messages(days=30, seed=None, start=None):
+    """ Makes up `days` days of compose status messages, starting at the
+    timestamp `start`: a rawhide and a branched nightly every day, some of
+    them doomed, respun or announced twice, and a release candidate every
+    week. Returns them oldest first. """
+    rng = random.Random(seed)
+    start = start or time.mktime(datetime.date(2017, 7, 1).timetuple())
+    messages = []
+
+    def compose(release, compose_id, started):
+        location = ('https://kojipkgs.fedoraproject.org/compose/{0}/'
+                    'compose'.format(compose_id))
+        finished = started + rng.uniform(5, 10) * 3600
+        statuses = [(started, 'STARTED')]
+        if rng.random() < 0.1:
+            statuses.append((finished, 'DOOMED'))
+        else:
+            status = ('FINISHED_INCOMPLETE' if rng.random() < 0.3
+                      else 'FINISHED')
+            statuses.append((finished, status))
+            if rng.random() < 0.2:
+                # announced again moments later
+                statuses.append((finished + rng.uniform(0, 5), status))
+        for timestamp, status in statuses:
+            messages.append({
+                'topic': TOPIC,
+                'timestamp': timestamp,
+                'msg_id': '{0}-{1}'.format(
+                    time.gmtime(timestamp).tm_year,
+                    hashlib.sha1(repr((compose_id, timestamp))).hexdigest()),
+                'msg': {
+                    'compose_id': compose_id,
+                    'location': location,
+                    'release_short': release.split('-')[0],
+                    'status': status,
+                },
+            })
+
+    for day in range(days):
+        midnight = start + day * 86400
+        date = time.strftime('%Y%m%d', time.gmtime(midnight))
+        for release in ('Fedora-Rawhide', 'Fedora-27'):
+            compose(release, '{0}-{1}.n.0'.format(release, date),
+                    midnight + rng.uniform(0, 2) * 3600)
+            if rng.random() < 0.15:
+                compose(release, '{0}-{1}.n.1'.format(release, date),
+                        midnight + rng.uniform(12, 14) * 3600)
+        if day % 7 == 6:
+            compose('Fedora-27', 'Fedora-27-{0}.0'.format(date),
+                    midnight + 16 * 3600)
+
+    return sorted(messages, key=lambda message: message['timestamp'])
+
+
+def images_for(compose_id, count=2):
+    """ Makes up the CloudImages metadata of a compose with `count`
+    .raw.xz images, and a qcow2 image for each that is not uploaded. """
+    images = []
+    for n in range(count):
+        name = 'Fedora-Cloud-Base-{0}-{1}.x86_64'.format(n, compose_id)
+        for fmt in ('raw.xz', 'qcow2'):
+            path = 'CloudImages/x86_64/images/{0}.{1}'.format(name, fmt)
+            images.append({
+                'path': path,
+                'format': fmt,
+                'checksums': {'sha256': hashlib.sha256(path).hexdigest()},
+            })
+    return images
+
+
+class _FakeUpload(object):
+    """ Stands in for `EC2Service` in the uploader. Every upload simply
+    takes `seconds`, and succeeds unless it is cancelled. """
+
+    def __init__(self, seconds, raw_url, journal=None, checksum=None):
+        self.seconds = seconds
+        self.raw_url = raw_url
+        self.build_name = raw_url.split('/')[-1].replace('.raw.xz', '')
+        self.variants = [(virt, vol) for virt in ('hvm', 'paravirtual')
+                         for vol in ('standard', 'gp2')]
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def pipeline(self, compose_meta):
+        yield self.seconds
+        raise Return(1 if self.cancelled else 0)
+
+
+class _Hub(object):
+    """ Just enough of a fedmsg hub to construct the consumer with. """
+    config = {}
+
+    def subscribe(self, *args, **kwargs):
+        pass
+
+
+def _rss():
+    """ Returns how many bytes of memory the process has resident. """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, ValueError, IndexError):
+        # not Linux: settle for the peak so far, in kilobytes
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def replay(messages, speed=86400.0, images=2, upload_seconds=5400,
+           metadata_seconds=5, drain_timeout=60, sample_interval=0.01):
+    """ Feeds `messages`, oldest first, through `FedimgConsumer.consume`,
+    `speed` times faster than they were sent. Each compose has `images`
+    images, its metadata takes `metadata_seconds` to fetch and each upload
+    takes `upload_seconds`, all in the time of the messages; the coalesce
+    window and metadata TTL are scaled the same way. Afterwards, waits up
+    to `drain_timeout` real seconds for the uploads to finish.
+
+    Returns a dict of figures: messages replayed, real and simulated
+    seconds taken, consume latencies in milliseconds, how far the replay
+    fell behind the messages' schedule, the most composes waiting out the
+    coalesce window, jobs queued and running, and threads alive at once,
+    the uploader's stats, and resident memory in bytes before, at its
+    peak and after. """
+    messages = list(messages)
+    if not messages:
+        raise ValueError("No messages to replay")
+    scale = 1.0 / speed
+
+    def fetch_images(compose_id, location, *args, **kwargs):
+        time.sleep(metadata_seconds * scale)
+        return images_for(compose_id, images)
+
+    peaks = collections.Counter()
+    finished = threading.Event()
+    gc.collect()
+    rss_start = _rss()
+
+    replacements = [
+        (fedimg.pipeline, 'PipelineEngine',
+         functools.partial(ScaledEngine, scale)),
+        (fedimg.metadata, 'fetch_images', fetch_images),
+        (fedimg.uploader, 'EC2Service',
+         functools.partial(_FakeUpload, upload_seconds)),
+        (fedimg.uploader, 'get_journal', lambda: None),
+        (fedimg, 'COALESCE_WINDOW', fedimg.COALESCE_WINDOW * scale),
+        (fedimg, 'METADATA_TTL', fedimg.METADATA_TTL * scale),
+        (fedimg, 'METRICS_PORT', 0),
+        (fedimg, 'STATSD_HOST', ''),
+    ]
+    with patched(replacements):
+        consumer = fedimg.consumers.FedimgConsumer(_Hub())
+        uploader = consumer.uploader
+
+        # Composes out of the coalesce window whose uploads aren't queued
+        # yet count as pending too, or draining could stop short
+        flushing = [0]
+        flush = consumer._flush
+
+        def tracked_flush(compose_id):
+            with consumer._pending_lock:
+                flushing[0] += 1
+            try:
+                flush(compose_id)
+            finally:
+                with consumer._pending_lock:
+                    flushing[0] -= 1
+
+        consumer._flush = tracked_flush
+
+        def sample():
+            # Composes only move on from pending to the uploader, so
+            # counting them in that order never misses one in between
+            with consumer._pending_lock:
+                pending = len(consumer._pending) + flushing[0]
+            stats = uploader.stats()
+            for name, value in (('pending', pending),
+                                ('queued', stats['queued']),
+                                ('running', stats['running']),
+                                ('threads', threading.active_count()),
+                                ('rss', _rss())):
+                peaks[name] = max(peaks[name], value)
+            return pending + stats['queued'] + stats['running']
+
+        def sampler():
+            while not finished.wait(sample_interval):
+                sample()
+
+        thread = threading.Thread(target=sampler,
+                                  name='fedimg-replay-sampler')
+        thread.daemon = True
+        thread.start()
+
+        latencies = []
+        lag = 0.0
+        first = messages[0]['timestamp']
+        start = time.time()
+        try:
+            for message in messages:
+                due = start + (message['timestamp'] - first) * scale
+                now = time.time()
+                if due > now:
+                    time.sleep(due - now)
+                else:
+                    lag = max(lag, now - due)
+                before = time.time()
+                consumer.consume({'topic': message['topic'],
+                                  'body': message})
+                latencies.append(time.time() - before)
+
+            deadline = time.time() + drain_timeout
+            while sample() and time.time() < deadline:
+                time.sleep(sample_interval)
+            elapsed = time.time() - start
+        finally:
+            finished.set()
+            thread.join()
+            consumer.upload_engine.shutdown(wait=True)
+
+    gc.collect()
+    rss_end = _rss()
+    milliseconds = [latency * 1000 for latency in latencies]
+    return {
+        'messages': len(messages),
+        'seconds': elapsed,
+        'simulated_seconds': messages[-1]['timestamp'] - first,
+        'consume_ms': {
+            'mean': sum(milliseconds) / len(milliseconds),
+            'p50': _percentile(milliseconds, 0.5),
+            'p99': _percentile(milliseconds, 0.99),
+            'max': max(milliseconds),
+        },
+        'max_lag': lag / scale,
+        'max_pending': peaks['pending'],
+        'max_queued': peaks['queued'],
+        'max_running': peaks['running'],
+        'peak_threads': peaks['threads'],
+        'jobs': uploader.stats(),
+        'rss_start': rss_start,
+        'rss_peak': max(peaks['rss'], rss_start, rss_end),
+        'rss_end': rss_end,
+    }
@@ -23,20 +23,32 @@
 import logging
 log = logging.getLogger("fedmsg")
 
-from time import sleep
-
-import paramiko
-from libcloud.compute.base import NodeImage
-from libcloud.compute.deployment import MultiStepDeployment
-from libcloud.compute.deployment import ScriptDeployment, SSHKeyDeployment
-from libcloud.compute.providers import get_driver
-from libcloud.compute.types import DeploymentException
+import atexit
+import collections
+import threading
+import time
+import types
+
+from libcloud.compute.base import Node, NodeImage, StorageVolume
+from libcloud.compute.base import VolumeSnapshot
+from libcloud.compute.drivers.ec2 import EC2NodeLocation
+from libcloud.compute.drivers.ec2 import ExEC2AvailabilityZone
 from libcloud.compute.types import KeyPairDoesNotExistError
 
 import fedimg
 import fedimg.messenger
-from fedimg.util import get_file_arch
-from fedimg.util import region_to_driver, ssh_connection_works
+import fedimg.metrics
+from fedimg.cache import get_cache
+from fedimg.catalog import get_catalog
+from fedimg.checks import CheckOutput, get_checks, suite_command
+from fedimg.drivers import ec2_driver
+from fedimg.ebs import SnapshotUploader
+from fedimg.journal import DONE, FAILED
+from fedimg.pipeline import Future, PipelineEngine, Return, Semaphore
+from fedimg.pipeline import run_in_thread, run_sync
+from fedimg.util import get_file_arch, parse_dd_stats, parse_decoder
+from fedimg.util import get_ssh_sessions, port_is_open, virt_types_from_url
+from fedimg.waiters import WaiterException, get_waiter
 
 
 class EC2ServiceException(Exception):
@@ -55,22 +67,512 @@ class EC2AMITestException(EC2ServiceException):
     pass
 
 
+class EC2CancelledException(EC2ServiceException):
+    """ The upload was cancelled before its AMIs were published. """
+    pass
+
+
+# Copy slots for each destination region, shared by every upload job in
+# the process so that no region gets more than AWS_COPY_CONCURRENCY copies
+# at once.
+_copy_slots = {}
+_copy_slots_lock = threading.Lock()
+
+
+def region_copy_slots(region):
+    """ Returns the semaphore that bounds AMI copies into `region`. """
+    with _copy_slots_lock:
+        if region not in _copy_slots:
+            _copy_slots[region] = Semaphore(fedimg.AWS_COPY_CONCURRENCY)
+        return _copy_slots[region]
+
+
+# Utility nodes are terminated rather than given another job once they have
+# been up this long, so that bin/kill_ec2_nodes.py, which terminates every
+# node that has been up for two hours, doesn't catch one mid-job.
+UTIL_NODE_MAX_AGE = 90 * 60
+
+# Devices that pooled utility nodes take jobs' volumes at, in the order they
+# are handed out. Xen-based instances such as m1.xlarge show each /dev/sdX
+# to the system as /dev/xvdX.
+UTIL_DEVICES = ['/dev/sd' + letter for letter in 'bcdefghijklmnop']
+
+# The oldest xz that decompresses on more than one core; older ones take
+# -T0 but quietly use one. pixz decompresses on every core in any version,
+# so it is used instead where the utility AMI has it.
+XZ_PARALLEL_VERSION = (5, 4)
+_PICK_DECODER = ('if command -v pixz > /dev/null; then '
+                 'decode="pixz -d"; echo "fedimg decoder: pixz"; '
+                 'else decode="xz -T0 -dc"; '
+                 'echo "fedimg decoder: $(xz --version | head -n 1)"; fi')
+
+# dd only takes conv=sparse from GNU coreutils 8.16, which is newer than
+# the RHEL 6 utility AMIs have, so a dd without it writes every block
+_PICK_DD_CONV = ('if dd if=/dev/null of=/dev/null conv=sparse 2> /dev/null; '
+                 'then conv=conv=sparse; '
+                 'else conv=; echo "fedimg dd: not sparse"; fi')
+
+
+def kernel_device(device):
+    """ Returns the name a utility node's system knows `device` by. """
+    return device.replace('/dev/sd', '/dev/xvd', 1)
+
+
+class _PooledNode(object):
+    """ A node in a `UtilityPool`, and the devices its jobs have taken. """
+
+    def __init__(self, node, born):
+        self.node = node
+        self.born = born
+        self.released = born  # when it last had no jobs
+        self.busy = set()  # devices that jobs have volumes attached at
+        self.retired = False  # takes no more jobs once set
+
+
+class UtilityPool(object):
+    """ Keeps up to `size` utility nodes booted, with SSH running, in
+    `region`, for upload jobs to write their images on. Each node takes up
+    to `slots` jobs at once, each with a volume of its own attached at a
+    device of its own, so that the images of a compose are written side by
+    side on one node. A job takes a node and a device with `acquire()`, and
+    gives them back with `release()` once its volume is detached again, or
+    with `discard()` if it failed. `warm()` boots nodes ahead of demand.
+    Nodes left idle for `idle_timeout` seconds, and any that would take the
+    pool beyond `size` idle nodes, are terminated. Boots and idle timeouts
+    run as jobs on `engine`. """
+
+    def __init__(self, region, size, idle_timeout, engine, slots=1):
+        self.region = region
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.engine = engine
+        self.devices = UTIL_DEVICES[:max(slots, 1)]
+        self.booted = 0  # nodes booted so far, for the curious
+        self._lock = threading.Lock()
+        self._nodes = {}  # node ID -> _PooledNode
+        self._booting = 0  # nodes on their way up
+        self._created = {}  # node ID -> when a node on its way was created
+        self._waiting = collections.deque()  # futures of jobs awaiting nodes
+
+    def acquire(self):
+        """ Returns a future for a (node, device) tuple: a ready utility
+        node, and the device to attach a volume at on it. Both are the
+        caller's until it releases or discards them. """
+        future = Future()
+        with self._lock:
+            slot = self._take(time.time())
+            if slot is None:
+                self._waiting.append(future)
+                # Boot a node for this job, unless one that is already on
+                # its way has a slot to spare
+                boot = len(self._waiting) > self._booting * len(self.devices)
+                if boot:
+                    self._booting += 1
+        if slot is not None:
+            future.set_result(slot)
+        elif boot:
+            self._boot()
+        return future
+
+    def release(self, node, device):
+        """ Takes back `device` on `node` from a job that has detached its
+        volume from it. """
+        self._give_back(node, device, retire=False)
+
+    def discard(self, node, device):
+        """ Takes back `device` on `node` from a job that failed. The node
+        takes no more jobs, and is terminated once the jobs still on it are
+        done. """
+        self._give_back(node, device, retire=True)
+
+    def adopt(self, node, device):
+        """ Takes in `node`, which a job from before a restart has a volume
+        attached to at `device`. It takes no more jobs, since which others
+        it had is unknown, and is terminated once those that return are
+        done. """
+        with self._lock:
+            if node.id not in self._nodes:
+                self._nodes[node.id] = _PooledNode(node, time.time())
+            pooled = self._nodes[node.id]
+            pooled.busy.add(device)
+            pooled.retired = True
+
+    def warm(self, count=None):
+        """ Boots nodes, without waiting for them, until `count` of them
+        (by default, and at most, `size`) are idle or on their way up. """
+        count = self.size if count is None else min(count, self.size)
+        with self._lock:
+            idle = [pooled for pooled in self._nodes.values()
+                    if not pooled.busy and not pooled.retired]
+            # Waiting jobs take up the slots of nodes on their way up
+            taken = -(-len(self._waiting) // len(self.devices))
+            needed = max(0, count - (len(idle) + self._booting - taken))
+            self._booting += needed
+        if needed:
+            log.info('Warming up {0} utility nodes in {1}'.format(
+                needed, self.region))
+        for i in range(needed):
+            self._boot()
+
+    def drain(self, timeout=60):
+        """ Terminates every idle node, waiting up to `timeout` seconds for
+        the calls to go through. """
+        with self._lock:
+            idle = [pooled.node for pooled in self._nodes.values()
+                    if not pooled.busy]
+            for node in idle:
+                del self._nodes[node.id]
+        for task in [self._terminate(node) for node in idle]:
+            try:
+                task.result(timeout)
+            except Exception:
+                pass
+
+    def _take(self, now):
+        """ Takes a free device for a job, on the busiest node that has
+        one, so that idle nodes stay idle and time out. Returns a (node,
+        device) tuple, or None if every node is full. Called with the lock
+        held. """
+        nodes = [pooled for pooled in self._nodes.values()
+                 if self._usable(pooled, now) and self._free(pooled)]
+        if not nodes:
+            return None
+        pooled = max(nodes, key=lambda pooled: (len(pooled.busy),
+                                                pooled.released))
+        device = self._free(pooled)[0]
+        pooled.busy.add(device)
+        return pooled.node, device
+
+    def _free(self, pooled):
+        return [device for device in self.devices
+                if device not in pooled.busy]
+
+    def _usable(self, pooled, now):
+        return (not pooled.retired and
+                now - pooled.born < UTIL_NODE_MAX_AGE)
+
+    def _give_back(self, node, device, retire):
+        now = time.time()
+        with self._lock:
+            if node.id not in self._nodes:
+                # A node the pool lost track of takes no more jobs
+                self._nodes[node.id] = _PooledNode(node, now)
+                retire = True
+            pooled = self._nodes[node.id]
+            pooled.busy.discard(device)
+            pooled.retired = pooled.retired or retire
+            handed, fate = self._settle(pooled, now)
+        self._carry_out(pooled.node, handed, fate)
+
+    def _settle(self, pooled, now):
+        """ Hands the free devices of `pooled` to waiting jobs, then works
+        out what becomes of it: 'busy' if it has jobs, 'idle' if it is kept
+        without any, or 'gone' if it is to be terminated. Returns the
+        (future, slot) pairs handed out and that fate. Called with the lock
+        held. """
+        handed = []
+        if self._usable(pooled, now):
+            for device in self._free(pooled)[:len(self._waiting)]:
+                pooled.busy.add(device)
+                handed.append((self._waiting.popleft(),
+                               (pooled.node, device)))
+        if pooled.busy:
+            return handed, 'busy'
+        idle = [other for other in self._nodes.values()
+                if other is not pooled and not other.busy]
+        if self._usable(pooled, now) and len(idle) < self.size:
+            pooled.released = now
+            return handed, 'idle'
+        del self._nodes[pooled.node.id]
+        return handed, 'gone'
+
+    def _carry_out(self, node, handed, fate):
+        for future, slot in handed:
+            future.set_result(slot)
+        if fate == 'idle':
+            self.engine.sleep(self.idle_timeout).add_done_callback(
+                lambda _: self._reap())
+        elif fate == 'gone':
+            self._terminate(node)
+
+    def _boot(self):
+        task = self.engine.submit(self._boot_node(),
+                                  name='utility-node-{0}'.format(self.region))
+        task.add_done_callback(self._booted)
+
+    def _boot_node(self):
+        """ Starts a utility node and waits for SSH on it. """
+        driver = ec2_driver(self.region)
+        ami = [a for a in get_catalog().utility_amis()
+               if a.region == self.region][0]
+        sizes = yield driver.job('list_sizes')
+        size = [s for s in sizes if s.id == 'm1.xlarge'][0]
+        node = yield create_node(driver, 'fedimg-utility-pool',
+                                 name='Fedimg AMI builder',
+                                 image=NodeImage(id=ami.ami, name=None,
+                                                 driver=driver),
+                                 size=size, kernel_id=ami.aki,
+                                 ex_ebs_optimized=True)
+        with self._lock:
+            self._created[node.id] = time.time()
+        try:
+            node = yield wait_until_running(self.region, node)
+            yield wait_for_ssh(self.region, fedimg.AWS_UTIL_USER, node)
+        except Exception:
+            with self._lock:
+                self._created.pop(node.id, None)
+            self._terminate(node)
+            raise
+        self.booted += 1
+        raise Return(node)
+
+    def _booted(self, task):
+        exception = task.exception()
+        now = time.time()
+        failed, handed, fate, node = [], [], None, None
+        with self._lock:
+            self._booting -= 1
+            if exception is not None:
+                # A failed boot only fails the jobs that no other boot has
+                # slots for
+                slots = self._booting * len(self.devices)
+                while len(self._waiting) > slots:
+                    failed.append(self._waiting.popleft())
+            else:
+                node = task.result()
+                pooled = self._nodes[node.id] = _PooledNode(
+                    node, self._created.pop(node.id, now))
+                handed, fate = self._settle(pooled, now)
+        if exception is not None:
+            log.error('Could not boot a utility node in {0}: {1}'.format(
+                self.region, exception))
+            for waiter in failed:
+                waiter.set_exception(exception)
+        else:
+            self._carry_out(node, handed, fate)
+
+    def _reap(self):
+        """ Terminates nodes that have been idle for too long. """
+        now = time.time()
+        with self._lock:
+            expired = [pooled.node for pooled in self._nodes.values()
+                       if not pooled.busy and
+                       (now - pooled.released >= self.idle_timeout or
+                        not self._usable(pooled, now))]
+            for node in expired:
+                del self._nodes[node.id]
+        for node in expired:
+            self._terminate(node)
+
+    def _terminate(self, node):
+        """ Terminates `node` on the pool's engine, and returns the task
+        doing it. """
+        return self.engine.submit(
+            self._terminate_node(node),
+            name='terminate-utility-node-{0}'.format(node.id))
+
+    def _terminate_node(self, node):
+        log.info('Terminating utility node {0}'.format(node.id))
+        close_ssh(node)
+        try:
+            yield ec2_driver(self.region).job('destroy_node', node)
+        except Exception:
+            log.exception('Could not terminate utility node {0}'.format(
+                node.id))
+
+
+# Utility node pools for each origin region, and the engine they boot nodes
+# on, created on first use
+_util_pools = {}
+_util_pools_lock = threading.Lock()
+_util_pool_engine = []
+
+
+def get_utility_pool(region):
+    """ Returns the pool of utility nodes in `region`, or None if utility
+    nodes are neither pooled nor shared. """
+    if fedimg.AWS_UTIL_POOL_SIZE <= 0 and fedimg.AWS_UTIL_NODE_VOLUMES <= 1:
+        return None
+    with _util_pools_lock:
+        if region not in _util_pools:
+            if not _util_pool_engine:
+                _util_pool_engine.append(
+                    PipelineEngine(workers=1, name='fedimg-util-pool'))
+                atexit.register(drain_utility_pools)
+            _util_pools[region] = UtilityPool(
+                region, fedimg.AWS_UTIL_POOL_SIZE,
+                fedimg.AWS_UTIL_POOL_IDLE_TIMEOUT, _util_pool_engine[0],
+                slots=fedimg.AWS_UTIL_NODE_VOLUMES)
+        return _util_pools[region]
+
+
+def drain_utility_pools():
+    """ Terminates every idle utility node, such as before exiting. """
+    with _util_pools_lock:
+        pools = list(_util_pools.values())
+    for pool in pools:
+        pool.drain()
+
+
+def prewarm_utility_nodes():
+    """ Boots utility nodes in the origin region ahead of the uploads of a
+    compose, if pooling is enabled. """
+    if fedimg.AWS_INGESTION != 'utility':
+        return
+    pool = get_utility_pool(get_catalog().utility_amis()[0].region)
+    if pool is not None:
+        pool.warm()
+
+
+def create_node(driver, build_name, **kwargs):
+    """ Starts a node without waiting for it, installing the keypair or
+    security group first if the driver's region is missing them. Hands
+    back the node. """
+    while True:
+        try:
+            node = yield driver.job(
+                'create_node',
+                ex_keyname=fedimg.AWS_KEYNAME,
+                ex_security_groups=['ssh'],
+                ex_metadata={'build': build_name},
+                **kwargs)
+
+        except KeyPairDoesNotExistError:
+            # The keypair is missing from the current region.
+            # Let's install it and try again.
+            log.exception('Adding missing keypair to region')
+            yield driver.job('ex_import_keypair', fedimg.AWS_KEYNAME,
+                             fedimg.AWS_PUBKEYPATH)
+            continue
+
+        except Exception as e:
+            # We might have an invalid security group, aka the 'ssh'
+            # security group doesn't exist in the current region. The
+            # reason this is caught here is because the related
+            # exception that prints`InvalidGroup.NotFound is, for
+            # some reason, a base exception.
+            if 'InvalidGroup.NotFound' in e.message:
+                log.exception('Adding missing security'
+                              'group to region')
+                # Create the ssh security group
+                yield driver.job('ex_create_security_group', 'ssh',
+                                 'ssh only')
+                yield driver.job('ex_authorize_security_group',
+                                 'ssh', '22', '22', '0.0.0.0/0')
+                continue
+            else:
+                raise
+        else:
+            raise Return(node)
+
+
+def wait_until_running(region, node):
+    """ Waits until `node` in `region` is running, then hands back the
+    refreshed node. """
+    node = yield get_waiter(region).wait_for('node', node.id, ['running'])
+    raise Return(node)
+
+
+def wait_for_ssh(region, username, node, timeout=None):
+    """ Waits until `node` in `region` accepts SSH connections for
+    `username`. An SSH handshake is only tried once EC2's status checks
+    pass or port 22 accepts TCP connections, whichever comes first; an
+    instance that fails its status checks raises a `WaiterException`. The
+    connection is kept for the commands run on the node afterwards. Both
+    probes block, so they run in threads of their own. A node that can't
+    be reached within `timeout` seconds, `AWS_SSH_TIMEOUT` by default,
+    raises a `WaiterException` too. """
+    if timeout is None:
+        timeout = fedimg.AWS_SSH_TIMEOUT
+    deadline = time.time() + timeout
+    ip = node.public_ips[0]
+    status = get_waiter(region).wait_for('status', node.id, ['ok'])
+    while True:
+        if status.exception() is not None:
+            raise status.exception()
+        if time.time() >= deadline:
+            raise WaiterException(
+                "node {0} did not accept SSH connections for {1} within "
+                "{2:.0f}s".format(node.id, username, timeout))
+        if status.done() or (yield run_in_thread(port_is_open, ip)):
+            ready = yield run_in_thread(get_ssh_sessions().probe,
+                                        username, ip)
+            if ready:
+                return
+        yield 5
+
+
+# Most bytes of a command's output that are kept, from the end
+COMMAND_OUTPUT_LIMIT = 32 * 1024
+
+
+def close_ssh(node):
+    """ Closes the SSH connections to `node`, which is going away. """
+    for ip in node.public_ips or []:
+        get_ssh_sessions().close(ip)
+
+
 class EC2Service(object):
     """ An object for interacting with an EC2 upload process.
-        Takes a URL to a raw.xz image. """
-
-    def __init__(self, raw_url, virt_type='hvm', vol_type='standard'):
+        Takes a URL to a raw.xz image.
+
+        The image is downloaded and snapshotted only once. Every requested
+        virtualization type/volume type combination is then registered as
+        its own AMI from that single snapshot.
+
+        The upload is split into stages, each a generator method run by a
+        `fedimg.pipeline.PipelineEngine`. Everything a later stage needs is
+        kept on the object, so a job can pick up after its last completed
+        stage. Given a `fedimg.journal.Journal`, the job checkpoints its
+        progress there and resumes from it after a restart. """
+
+    # Stages that build and test the AMIs in the origin region
+    BUILD_STAGES = ('deploy', 'ssh_ready', 'write', 'snapshot', 'register',
+                    'test')
+    # The same, when the image is written straight into a snapshot
+    DIRECT_BUILD_STAGES = ('upload', 'register', 'test')
+    # Stages that publish the tested AMIs and distribute them to every
+    # other region
+    DISTRIBUTE_STAGES = ('publicize', 'copy')
+
+    def __init__(self, raw_url, virt_types=None, vol_types=None,
+                 journal=None, ingestion=None, checksum=None):
 
         self.raw_url = raw_url
-        self.virt_type = virt_type
-        self.vol_type = vol_type
+        self.checksum = checksum  # sha256 from the compose metadata
+        self.journal = journal
+        # 'utility' or 'direct'; see the `ingestion` option
+        self.ingestion = ingestion or fedimg.AWS_INGESTION
+        if self.ingestion == 'direct':
+            self.build_stages = self.DIRECT_BUILD_STAGES
+        else:
+            self.build_stages = self.BUILD_STAGES
+        self.virt_types = virt_types or virt_types_from_url(raw_url)
+        self.vol_types = vol_types or ['standard', 'gp2']
+        # Every combination we register an AMI for, as (virt, vol) tuples
+        self.variants = [(virt, vol) for virt in self.virt_types
+                         for vol in self.vol_types]
         # All of these are set to appropriate values throughout
         # the upload process.
+        self.driver = None
+        self.region = None  # the origin region
+        self.sizes = []
+        self.stage = None
+        self.completed_stages = []
+        self.cancelled = False
+        self.util_pool = None  # see UtilityPool
         self.util_node = None
+        self.util_device = '/dev/sdb'  # where the volume is attached
         self.util_volume = None
+        self.util_volume_id = None
         self.images = []
+        self.image_variants = {}  # image ID -> (virt_type, vol_type)
+        self.copied_images = []  # (ami, image, image copy) tuples
+        self.region_status = {}  # region -> progress of its copies
         self.snapshot = None
-        self.test_node = None
+        self.test_nodes = {}  # virt_type -> its test node, while it runs
+        self.test_results = {}  # 'snapshot/virt_type' -> whether it passed
+        self.write_stats = None  # what dd reported for the image write
 
         self.destination = ''
 
@@ -78,49 +580,6 @@ class EC2Service(object):
         self.test_success = False
         self.dup_count = 0  # counter: helps avoid duplicate AMI names
 
-        # Will be lists of dicts containing AMI info
-        self.util_amis = []
-        self.test_amis = []
-
-        # Populate list of AMIs by reading the AMI details from the config file
-        for line in fedimg.AWS_AMIS.split('\n'):
-            """ AWS_AMIS lines have pipe-delimited attrs at these indicies:
-            0: region (ex. eu-west-1)
-            1: OS (ex. RHEL)
-            2: version (ex. 5.7)
-            3: arch (ex. x86_64)
-            4: ami name (ex. ami-68e3d32d) """
-
-            # strip line to avoid any newlines or spaces from sneaking in
-            attrs = line.strip().split('|')
-
-            # old configuration
-            if len(attrs)==6:
-
-                info = {'region': attrs[0],
-                        'driver': region_to_driver(attrs[0]),
-                        'os': attrs[1],
-                        'ver': attrs[2],
-                        'arch': attrs[3],
-                        'ami': attrs[4],
-                        'aki': attrs[5]}
-
-            # new configuration
-            elif len(attrs)==4:
-
-                info = {'region': attrs[0],
-                        'driver': region_to_driver(attrs[0]),
-                        'arch': attrs[1],
-                        'ami': attrs[2],
-                        'aki': attrs[3]}
-
-
-
-            # For now, read in all AMIs to these lists, and narrow
-            # down later. TODO: This could be made a bit nicer...
-            self.util_amis.append(info)
-            self.test_amis.append(info)
-
         # Get file name, build name, a description, and the image arch
         # all from the .raw.xz file name.
         self.file_name = self.raw_url.split('/')[-1]
@@ -128,272 +587,782 @@ class EC2Service(object):
         self.image_desc = "Created from build {0}".format(self.build_name)
         self.image_arch = get_file_arch(self.file_name)
 
-        # Filter the AMI lists appropriately
-        # (no EBS-enabled instance types offer a 32 bit architecture, and we
-        # need EBS for registration on the utility instance, so they must be
-        # x86_64)
-        self.util_amis = [a for a in self.util_amis
-                          if a['arch'] == 'x86_64']
-        self.test_amis = [a for a in self.test_amis
-                          if a['arch'] == self.image_arch]
+        # The AMIs to start utility instances from, and the AMIs of the
+        # image's arch, which also name the regions it is copied to
+        catalog = get_catalog()
+        self.util_amis = catalog.utility_amis()
+        self.test_amis = catalog.test_amis(self.image_arch)
 
     def _clean_up(self, driver, delete_images=False):
-        """ Cleans up resources via a libcloud driver. """
+        """ Cleans up resources via a libcloud driver. This is a generator,
+        to be run by the pipeline engine. """
         log.info('Cleaning up resources')
         if delete_images and len(self.images) > 0:
             for image in self.images:
-                driver.delete_image(image)
+                yield driver.job('delete_image', image)
 
         if self.snapshot and len(self.images) == 0:
-            driver.destroy_volume_snapshot(self.snapshot)
+            yield driver.job('destroy_volume_snapshot', self.snapshot)
             self.snapshot = None
 
-        if self.util_node:
-            driver.destroy_node(self.util_node)
-            # Wait for node to be terminated
-            while ssh_connection_works(fedimg.AWS_UTIL_USER,
-                                       self.util_node.public_ips[0],
-                                       fedimg.AWS_KEYPATH):
-                sleep(10)
+        if self.util_node and self.util_pool is not None:
+            # Other uploads may be writing on the node, so only this
+            # upload's volume is taken off it, and the pool retires it
+            if self.util_volume_id:
+                try:
+                    yield driver.job(
+                        'detach_volume', self.util_volume or StorageVolume(
+                            self.util_volume_id, None, None, driver),
+                        ex_force=True)
+                except Exception:
+                    log.exception('Could not detach the utility volume')
+                self.util_volume = yield get_waiter(self.region).wait_for(
+                    'volume', self.util_volume_id, ['available'])
+            self.util_pool.discard(self.util_node, self.util_device)
+            self.util_node = None
+        elif self.util_node:
+            close_ssh(self.util_node)
+            yield driver.job('destroy_node', self.util_node)
+            # Wait for node to be terminated, which releases its volume
+            yield self._wait_until_terminated(self.util_node)
             self.util_node = None
         if self.util_volume:
             # Destroy /dev/sdb or whatever
-            driver.destroy_volume(self.util_volume)
+            yield driver.job('destroy_volume', self.util_volume)
             self.util_volume = None
-        if self.test_node:
-            driver.destroy_node(self.test_node)
-            self.test_node = None
+        for node in self.test_nodes.values():
+            close_ssh(node)
+            yield driver.job('destroy_node', node)
+        self.test_nodes = {}
+
+    def _outputs(self):
+        """ Returns the IDs of everything the job has made so far. """
+        return {
+            'util_node': self.util_node.id if self.util_node else None,
+            'util_device': self.util_device,
+            'util_volume': self.util_volume_id,
+            'snapshot': self.snapshot.id if self.snapshot else None,
+            'images': [[image.id] + list(self.image_variants[image.id])
+                       for image in self.images],
+            'test_nodes': [node.id for node in self.test_nodes.values()],
+            'test_results': self.test_results,
+            'test_success': self.test_success,
+            'copies': [[ami.region, image.id, copy.id]
+                       for ami, image, copy in self.copied_images],
+            'region_status': self.region_status,
+            'dup_count': self.dup_count,
+        }
+
+    def _checkpoint(self, stage, completed=True):
+        """ Journals the job's outputs as of `stage`, if it has a journal.
+        Long stages also checkpoint their progress along the way. """
+        if self.journal is not None:
+            self.journal.checkpoint(self.raw_url, stage, self._outputs(),
+                                    completed=completed)
+
+    def _restore(self):
+        """ Picks up the outputs and completed stages of an earlier run of
+        this job from the journal. This is a generator, to be run by the
+        pipeline engine. """
+        checkpoints = self.journal.checkpoints(self.raw_url)
+        if not checkpoints:
+            return
+        log.info('Resuming {0} from the journal'.format(self.build_name))
+
+        self.completed_stages = [stage for stage, completed, _
+                                 in checkpoints if completed]
+        outputs = checkpoints[-1][2]
+        self.util_device = outputs.get('util_device', self.util_device)
+        self.util_volume_id = outputs['util_volume']
+        self.test_success = outputs['test_success']
+        self.test_results = dict(outputs.get('test_results', {}))
+        self.dup_count = outputs['dup_count']
+        self.region_status = dict(outputs['region_status'])
+
+        if outputs['snapshot']:
+            self.snapshot = VolumeSnapshot(outputs['snapshot'],
+                                           driver=self.driver)
+        for image_id, virt_type, vol_type in outputs['images']:
+            self.images.append(NodeImage(id=image_id, name=None,
+                                         driver=self.driver))
+            self.image_variants[image_id] = (virt_type, vol_type)
+
+        # Copies into regions that didn't finish are simply made again
+        images = dict((image.id, image) for image in self.images)
+        amis = dict((ami.region, ami) for ami in self.test_amis)
+        for region, image_id, copy_id in outputs['copies']:
+            if self.region_status.get(region) == 'completed':
+                copy = NodeImage(id=copy_id, name=None,
+                                 driver=ec2_driver(region))
+                self.copied_images.append((amis[region], images[image_id],
+                                           copy))
+
+        if 'test' not in self.completed_stages:
+            # Tests that hadn't finished are run again on new nodes
+            for node_id in outputs.get('test_nodes', []):
+                log.info('Destroying leftover test node')
+                yield self.driver.job('destroy_node', Node(
+                    node_id, None, None, [], [], self.driver))
+
+        if outputs['util_node'] and 'snapshot' not in self.completed_stages:
+            try:
+                nodes = yield self.driver.job(
+                    'list_nodes',
+                    ex_filters={'instance-id': [outputs['util_node']]})
+            except Exception:
+                # EC2 forgets about instances a while after termination
+                nodes = []
+            if nodes and nodes[0].extra.get('status') in ('pending',
+                                                           'running'):
+                self.util_node = nodes[0]
+                if self.util_pool is not None:
+                    self.util_pool.adopt(self.util_node, self.util_device)
+            else:
+                # The utility node is gone, and everything done on it has
+                # to be done again
+                log.warn('Utility node {0} is gone; volume {1} is left '
+                         'behind'.format(outputs['util_node'],
+                                         self.util_volume_id))
+                self.util_volume_id = None
+                self.completed_stages = [
+                    stage for stage in self.completed_stages
+                    if stage not in ('deploy', 'ssh_ready', 'write')]
+
+    def _finish_job(self, state):
+        """ Records in the journal that the job is done or has failed. """
+        if self.journal is not None:
+            self.journal.finish(self.raw_url, state)
+
+    def _size(self, size_id):
+        """ Returns the node size with the ID `size_id`. """
+        # check to make sure we have access to that size node
+        # TODO: Add try/except if for some reason the size isn't
+        # available?
+        return [s for s in self.sizes if s.id == size_id][0]
+
+    def _create_node(self, **kwargs):
+        """ Starts a node in the origin region without waiting for it, and
+        hands it back. """
+        return create_node(self.driver, self.build_name, **kwargs)
+
+    def _wait_until_running(self, node):
+        """ Waits until `node` is running, then hands back the refreshed
+        node. """
+        return wait_until_running(self.region, node)
+
+    def _wait_for_ssh(self, username, node):
+        """ Waits until `node` accepts SSH connections for `username`. """
+        return wait_for_ssh(self.region, username, node)
+
+    def _wait_until_terminated(self, node):
+        """ Returns a future for `node` reaching the terminated state. """
+        return get_waiter(self.region).wait_for('node', node.id,
+                                                ['terminated'])
+
+    def _run_command(self, username, node, cmd, on_output=None):
+        """ Runs `cmd` on `node` over SSH without tying up a worker thread
+        while it runs. Output is read as it comes, and handed to
+        `on_output` if given. Hands back an (exit status, output) tuple,
+        with the last COMMAND_OUTPUT_LIMIT bytes of the output. """
+        data = ''
+        sessions = get_ssh_sessions()
+        # Connect off the worker, should the connection need making again
+        yield run_in_thread(sessions.transport, username, node.public_ips[0])
+        with sessions.session(username, node.public_ips[0]) as chan:
+            chan.get_pty()  # Request a pseudo-term to get around requiretty
+            chan.exec_command(cmd)
 
-    def upload(self, compose_meta):
-        """ Registers the image in each EC2 region. """
+            # Poll for the exit status rather than blocking on it, reading
+            # the output so far each time so that the command never stalls
+            # on a full channel
+            while True:
+                exited = chan.exit_status_ready()
+                while chan.recv_ready():
+                    chunk = chan.recv(COMMAND_OUTPUT_LIMIT)
+                    if not chunk:
+                        break
+                    if on_output is not None:
+                        on_output(chunk)
+                    data = (data + chunk)[-COMMAND_OUTPUT_LIMIT:]
+                if exited:
+                    break
+                yield 10
+            status = chan.recv_exit_status()
+        raise Return((status, data or "(no data)"))
+
+    def _open_image(self):
+        """ Opens the image file from the local cache, downloading it into
+        the cache first if it isn't there yet. Hands back the open file, or
+        None if caching is disabled. """
+        cache = get_cache()
+        if cache is None:
+            raise Return(None)
+        image = yield run_in_thread(cache.open, self.raw_url, self.checksum)
+        raise Return(image)
+
+    def _send_file(self, username, node, image, remote_path):
+        """ Copies the open file `image` to `remote_path` on `node` over
+        SFTP. This blocks, so run it with `run_in_thread`. """
+        with get_ssh_sessions().sftp(username, node.public_ips[0]) as sftp:
+            sftp.putfo(image, remote_path)
+
+    def _remove_file(self, username, node, path):
+        """ Deletes `path` on `node`, logging rather than raising if it
+        can't, as the node may well be unreachable by then. """
+        try:
+            yield self._run_command(username, node,
+                                    'rm -f {0}'.format(path))
+        except Exception:
+            log.exception('Could not remove {0} from {1}'.format(
+                path, node.id))
+
+    def _variant_extra(self, image, **extra):
+        """ Returns the fedmsg 'extra' dict describing `image`. """
+        virt_type, vol_type = self.image_variants[image.id]
+        extra.update({'id': image.id,
+                      'virt_type': virt_type,
+                      'vol_type': vol_type})
+        return extra
+
+    def _image_name(self, region, virt_type, vol_type):
+        """ Returns the name an AMI of the given variant gets in `region`. """
+        if virt_type == 'paravirtual':
+            return "{0}-{1}-PV-{2}-0".format(self.build_name, region,
+                                             vol_type)
+        else:  # HVM
+            return "{0}-{1}-HVM-{2}-0".format(self.build_name, region,
+                                              vol_type)
+
+    def _registration_aki(self, region, virt_type):
+        """ Returns the kernel image a variant is registered with. """
+        if virt_type == 'paravirtual':
+            return get_catalog().aki(region, self.image_arch)
+        # Can't supply a kernel image with HVM
+        return None
+
+    def _deploy(self, compose_meta):
+        """ Starts the utility instance, with a blank volume attached for
+        the image to be written to. With a pool of utility nodes, one of
+        those is borrowed instead. """
+        if self.util_pool is not None:
+            yield self._attach_util_volume()
+            return
+
+        ami = self.util_amis[0]
+        base_image = NodeImage(id=ami.ami, name=None, driver=self.driver)
+
+        # Block device mapping for the utility node
+        # (Requires this second volume to write the image to for
+        # future registration.) The volume type only matters while
+        # writing, since every variant gets its own volume type at
+        # registration time, so use the faster SSD-backed type.
+        mappings = [{'VirtualName': None,  # cannot specify with Ebs
+                     'Ebs': {'VolumeSize': fedimg.AWS_UTIL_VOL_SIZE,
+                             'VolumeType': 'gp2',
+                             'DeleteOnTermination': 'false'},
+                     'DeviceName': '/dev/sdb'}]
+
+        log.info('Deploying utility instance')
+
+        # The keypair passed along here is the one fedimg connects with,
+        # so no further deployment steps are needed on the node.
+        # A node left over from an interrupted run is used as it is
+        if self.util_node is None:
+            self.util_node = yield self._create_node(
+                name='Fedimg AMI builder',
+                image=base_image,
+                size=self._size('m1.xlarge'),
+                kernel_id=ami.aki,
+                ex_ebs_optimized=True,
+                ex_blockdevicemappings=mappings)
+            self._checkpoint('deploy', completed=False)
+        self.util_node = yield self._wait_until_running(self.util_node)
+
+        # Get volume name that image will be written to
+        self.util_volume_id = [
+            x['ebs']['volume_id'] for x in
+            self.util_node.extra['block_device_mapping'] if
+            x['device_name'] == '/dev/sdb'][0]
+
+    def _attach_util_volume(self):
+        """ Borrows a utility node and a device on it from the pool, and
+        attaches a blank volume there for the image to be written to. """
+        if self.util_node is None:
+            log.info('Borrowing a utility instance')
+            self.util_node, self.util_device = \
+                yield self.util_pool.acquire()
+            self._checkpoint('deploy', completed=False)
+
+        waiter = get_waiter(self.region)
+        if self.util_volume_id is None:
+            # The volume has to be in the node's availability zone
+            zone = self.util_node.extra.get('availability')
+            location = None
+            if zone:
+                location = EC2NodeLocation(
+                    zone, zone, None, self.driver,
+                    ExEC2AvailabilityZone(zone, 'available', self.region))
+            self.util_volume = yield self.driver.job(
+                'create_volume', fedimg.AWS_UTIL_VOL_SIZE,
+                'fedimg-{0}'.format(self.build_name),
+                location=location, ex_volume_type='gp2')
+            self.util_volume_id = self.util_volume.id
+            self._checkpoint('deploy', completed=False)
+
+        # A volume from an interrupted run may not have been attached yet
+        volume = yield waiter.wait_for('volume', self.util_volume_id,
+                                       ['available', 'in-use'])
+        if volume.extra.get('state') == 'available':
+            yield self.driver.job('attach_volume', self.util_node, volume,
+                                  self.util_device)
+        self.util_volume = yield waiter.wait_for(
+            'volume', self.util_volume_id, ['in-use'])
+
+    def _ssh_ready(self, compose_meta):
+        """ Waits until the utility node has SSH running. Nodes from the
+        pool have it running already. """
+        if self.util_pool is not None:
+            return
+        yield self._wait_for_ssh(fedimg.AWS_UTIL_USER, self.util_node)
+        log.info('Utility node started with SSH running')
+
+    def _write(self, compose_meta):
+        """ Writes the image to the utility node's blank volume. """
+
+        image = yield self._open_image()
+        if image is None:
+            # Without a cache, curl the .raw.xz file down from the web
+            # (with -L option, so we follow redirects)
+            source = "curl -sS -L {0}".format(self.raw_url)
+        else:
+            # Send our cached copy over instead
+            remote_path = '/tmp/{0}'.format(self.file_name)
+            log.info('Sending cached image to utility instance')
+            sent = False
+            try:
+                yield run_in_thread(self._send_file, fedimg.AWS_UTIL_USER,
+                                    self.util_node, image, remote_path)
+                sent = True
+            finally:
+                image.close()
+                if not sent:
+                    yield self._remove_file(fedimg.AWS_UTIL_USER,
+                                            self.util_node, remote_path)
+            # Pooled nodes take one upload after another, so the copy is
+            # deleted however the write ends, lest it fill their /tmp
+            source = 'trap "rm -f {0}" EXIT; cat {0}'.format(remote_path)
+
+        # Decompress the image and write it to the volume attached for it,
+        # which other uploads may be writing beside on the same node.
+        # pixz, or xz from XZ_PARALLEL_VERSION on, decodes multi-block files
+        # on all of the node's cores, and dd seeks past all-zero blocks
+        # rather than writing them where it can, since the blank volume
+        # reads as zeros anyway. dd's summary on stderr gives the
+        # throughput.
+        cmd = ("sudo bash -c 'set -o pipefail; {0}; {1}; {2} | $decode | "
+               "dd of={3} bs=1M iflag=fullblock $conv'".format(
+                   _PICK_DECODER, _PICK_DD_CONV, source,
+                   kernel_device(self.util_device)))
+
+        log.info('Executing utility script')
+
+        # Run the above command and wait for its exit status
+        status, data = yield self._run_command(fedimg.AWS_UTIL_USER,
+                                               self.util_node, cmd)
+        if status != 0:
+            # There was a problem with the SSH command
+            log.error('Problem writing volume with utility instance')
+
+            fedimg.messenger.message('image.upload', self.raw_url,
+                                     self.destination, 'failed',
+                                     extra={'data': data},
+                                     compose=compose_meta)
 
-        log.info('EC2 upload process started')
+            raise EC2UtilityException(
+                "Problem writing image to utility instance volume. "
+                "Command exited with status {0}.\n"
+                "command: {1}\n"
+                "output: {2}".format(status, cmd, data))
+
+        decoder = parse_decoder(data)
+        if decoder and decoder[0] == 'xz' and \
+                decoder[1] < XZ_PARALLEL_VERSION:
+            log.warning('The utility instance decompressed the image on one '
+                        'core, as its xz is {0}; give its AMI pixz or xz {1} '
+                        'or later'.format(
+                            '.'.join(str(n) for n in decoder[1]) or 'old',
+                            '.'.join(str(n) for n in XZ_PARALLEL_VERSION)))
+        if 'fedimg dd: not sparse' in data:
+            log.warning('The utility instance wrote every block of the '
+                        'image, zeros too, as its dd lacks conv=sparse; '
+                        'give its AMI GNU coreutils 8.16 or later')
+
+        self.write_stats = parse_dd_stats(data)
+        if self.write_stats:
+            log.info('Wrote {0} bytes in {1:.1f}s ({2:.1f} MB/s)'.format(
+                self.write_stats['bytes'], self.write_stats['seconds'],
+                self.write_stats['rate'] / 1e6))
+            fedimg.metrics.inc('fedimg_bytes_written_total',
+                               self.write_stats['bytes'],
+                               region=self.region, ingestion='utility')
+            fedimg.metrics.observe('fedimg_write_seconds',
+                                   self.write_stats['seconds'],
+                                   region=self.region, ingestion='utility')
+
+    def _snapshot(self, compose_meta):
+        """ Snapshots the written volume, once the utility node has let
+        go of it. """
+
+        waiter = get_waiter(self.region)
+        if self.util_pool is not None:
+            log.info('Detaching the written volume')
+
+            # The device goes back to the pool for the next job as soon as
+            # the volume is off it, while other uploads may still be
+            # writing on the node
+            yield self.driver.job(
+                'detach_volume', self.util_volume or StorageVolume(
+                    self.util_volume_id, None, None, self.driver))
+            self.util_volume = yield waiter.wait_for(
+                'volume', self.util_volume_id, ['available'])
+            self.util_pool.release(self.util_node, self.util_device)
+            self.util_node = None
+            terminated = []
+        else:
+            log.info('Destroying utility node')
 
-        # Get a starting utility AMI in some region to use as an origin
-        ami = self.util_amis[0]  # Select the starting AMI to begin
-        self.destination = 'EC2 ({region})'.format(region=ami['region'])
+            # Terminate the utility instance
+            close_ssh(self.util_node)
+            yield self.driver.job('destroy_node', self.util_node)
 
-        fedimg.messenger.message('image.upload', self.raw_url,
-                                 self.destination, 'started',
-                                 compose=compose_meta)
+            terminated = [self._wait_until_terminated(self.util_node)]
 
-        try:
-            # Connect to the region through the appropriate libcloud driver
-            cls = ami['driver']
-            driver = cls(fedimg.AWS_ACCESS_ID, fedimg.AWS_SECRET_KEY)
+            # The volume becomes available as soon as EC2 has detached it,
+            # which can be before the node is fully terminated, so snapshot
+            # it straight away.
+            self.util_volume = yield waiter.wait_for(
+                'volume', self.util_volume_id, ['available'])
+        snap_name = 'fedimg-snap-{0}'.format(self.build_name)
 
-            # select the desired node attributes
-            sizes = driver.list_sizes()
-            reg_size_id = 'm1.xlarge'
+        log.info('Taking a snapshot of the written volume')
 
-            # check to make sure we have access to that size node
-            # TODO: Add try/except if for some reason the size isn't
-            # available?
-            size = [s for s in sizes if s.id == reg_size_id][0]
-            base_image = NodeImage(id=ami['ami'], name=None, driver=driver)
+        self.snapshot = yield self.driver.job(
+            'create_volume_snapshot', self.util_volume, name=snap_name)
+        snap_id = str(self.snapshot.id)
 
-            # Name the utility node
-            name = 'Fedimg AMI builder'
+        results = yield [waiter.wait_for('snapshot', snap_id,
+                                         ['completed'])] + terminated
+        self.snapshot = results[0]
+        self.util_node = None
+
+        log.info('Snapshot taken')
+
+        # Delete the volume now that we've got the snapshot
+        yield self.driver.job('destroy_volume', self.util_volume)
+        # make sure Fedimg knows that the vol is gone
+        self.util_volume = None
+
+        log.info('Destroyed volume')
 
-            # Block device mapping for the utility node
-            # (Requires this second volume to write the image to for
-            # future registration.)
-            mappings = [{'VirtualName': None,  # cannot specify with Ebs
-                         'Ebs': {'VolumeSize': fedimg.AWS_UTIL_VOL_SIZE,
-                                 'VolumeType': self.vol_type,
-                                 'DeleteOnTermination': 'false'},
-                         'DeviceName': '/dev/sdb'}]
+    def _upload(self, compose_meta):
+        """ Writes the image straight into a new snapshot with the EBS
+        direct APIs, without a utility instance. """
+
+        log.info('Writing image directly to a snapshot')
+
+        uploader = SnapshotUploader(self.region,
+                                    workers=fedimg.AWS_EBS_WORKERS,
+                                    endpoint=fedimg.AWS_EBS_ENDPOINT or None)
+        try:
+            image = yield self._open_image()
+            try:
+                snap_id = yield run_in_thread(uploader.upload,
+                                              image or self.raw_url,
+                                              fedimg.AWS_UTIL_VOL_SIZE,
+                                              self.image_desc)
+            finally:
+                if image is not None:
+                    image.close()
+        except Exception as e:
+            fedimg.messenger.message('image.upload', self.raw_url,
+                                     self.destination, 'failed',
+                                     extra={'data': str(e)},
+                                     compose=compose_meta)
+            raise
 
-            # Read in the SSH key
-            with open(fedimg.AWS_PUBKEYPATH, 'rb') as f:
-                key_content = f.read()
+        self.snapshot = yield get_waiter(self.region).wait_for(
+            'snapshot', snap_id, ['completed'])
 
-            # Add key to authorized keys for root user
-            step_1 = SSHKeyDeployment(key_content)
+        log.info('Snapshot taken')
 
-            # Add script for deployment
-            # Device becomes /dev/xvdb on instance
-            script = "touch test"  # this isn't so important for the util inst.
-            step_2 = ScriptDeployment(script)
+    def _register(self, compose_meta):
+        """ Registers every variant of the image from the snapshot. """
+        for virt_type, vol_type in self.variants:
+            if (virt_type, vol_type) not in self.image_variants.values():
+                yield self._register_variant(virt_type, vol_type)
 
-            # Create deployment object (will set up SSH key and run script)
-            msd = MultiStepDeployment([step_1, step_2])
+        log.info('Completed image registration')
 
-            log.info('Deploying utility instance')
+        # Emit success fedmsg
+        # TODO: Can probably move this into the above try/except,
+        # to avoid just dumping all the messages at once.
+        for image in self.images:
+            fedimg.messenger.message('image.upload', self.raw_url,
+                                     self.destination, 'completed',
+                                     extra=self._variant_extra(image),
+                                     compose=compose_meta)
 
+    def _register_variant(self, virt_type, vol_type):
+        """ Registers one variant of the image from the staged snapshot,
+        and hands back the AMI. """
+
+        log.info('Registering image as an {0} {1} AMI'.format(virt_type,
+                                                               vol_type))
+
+        region = self.region
+        image_name = self._image_name(region, virt_type, vol_type)
+        registration_aki = self._registration_aki(region, virt_type)
+        if virt_type == 'paravirtual':
+            reg_root_device_name = '/dev/sda'
+        else:  # HVM
+            reg_root_device_name = '/dev/sda1'
+
+        # For this block device mapping, we have our volume be
+        # based on the snapshot's ID
+        mapping = [{'DeviceName': reg_root_device_name,
+                    'Ebs': {'SnapshotId': str(self.snapshot.id),
+                            'VolumeSize': fedimg.AWS_TEST_VOL_SIZE,
+                            'VolumeType': vol_type,
+                            'DeleteOnTermination': 'true'}}]
+
+        # Avoid duplicate image name by incrementing the number at the
+        # end of the image name if there is already an AMI with that name.
+        # TODO: This process could be written nicer.
+        timer = fedimg.metrics.timer('fedimg_register_seconds',
+                                     region=region, virt_type=virt_type,
+                                     vol_type=vol_type)
+        with timer:
             while True:
                 try:
-                    self.util_node = driver.deploy_node(
-                        name=name,
-                        image=base_image,
-                        size=size,
-                        ssh_username=fedimg.AWS_UTIL_USER,
-                        ssh_alternate_usernames=[''],
-                        ssh_key=fedimg.AWS_KEYPATH,
-                        deploy=msd,
-                        kernel_id=ami['aki'],
-                        ex_metadata={'build':
-                                     self.build_name},
-                        ex_keyname=fedimg.AWS_KEYNAME,
-                        ex_security_groups=['ssh'],
-                        ex_ebs_optimized=True,
-                        ex_blockdevicemappings=mappings)
-
-                except KeyPairDoesNotExistError:
-                    # The keypair is missing from the current region.
-                    # Let's install it and try again.
-                    log.exception('Adding missing keypair to region')
-                    driver.ex_import_keypair(fedimg.AWS_KEYNAME,
-                                             fedimg.AWS_PUBKEYPATH)
-                    continue
-
+                    if self.dup_count > 0:
+                        # Remove trailing '-0' or '-1' or '-2' or...
+                        image_name = '-'.join(image_name.split('-')[:-1])
+                        # Re-add trailing dup number with new count
+                        image_name += '-{0}'.format(self.dup_count)
+                    # Try to register with that name
+                    image = yield self.driver.job(
+                        'ex_register_image', image_name,
+                        description=self.image_desc,
+                        root_device_name=reg_root_device_name,
+                        block_device_mapping=mapping,
+                        virtualization_type=virt_type,
+                        kernel_id=registration_aki,
+                        architecture=self.image_arch)
                 except Exception as e:
-                    # We might have an invalid security group, aka the 'ssh'
-                    # security group doesn't exist in the current region. The
-                    # reason this is caught here is because the related
-                    # exception that prints`InvalidGroup.NotFound is, for
-                    # some reason, a base exception.
-                    if 'InvalidGroup.NotFound' in e.message:
-                        log.exception('Adding missing security'
-                                      'group to region')
-                        # Create the ssh security group
-                        driver.ex_create_security_group('ssh', 'ssh only')
-                        driver.ex_authorize_security_group('ssh', '22', '22',
-                                                           '0.0.0.0/0')
+                    # Check if the problem was a duplicate name
+                    if 'InvalidAMIName.Duplicate' in e.message:
+                        # Keep trying until an unused name is found
+                        self.dup_count += 1
                         continue
                     else:
                         raise
                 break
 
-            # Wait until the utility node has SSH running
-            while not ssh_connection_works(fedimg.AWS_UTIL_USER,
-                                           self.util_node.public_ips[0],
-                                           fedimg.AWS_KEYPATH):
-                sleep(10)
-
-            log.info('Utility node started with SSH running')
-
-            # Connect to the utility node via SSH
-            client = paramiko.SSHClient()
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            client.connect(self.util_node.public_ips[0],
-                           username=fedimg.AWS_UTIL_USER,
-                           key_filename=fedimg.AWS_KEYPATH)
-
-            # Curl the .raw.xz file down from the web, decompressing it
-            # and writing it to the secondary volume defined earlier by
-            # the block device mapping.
-            # curl with -L option, so we follow redirects
-            cmd = "sudo sh -c 'curl -L {0} | xzcat > /dev/xvdb'".format(
-                  self.raw_url)
-            chan = client.get_transport().open_session()
-            chan.get_pty()  # Request a pseudo-term to get around requiretty
+        self.images.append(image)
+        self.image_variants[image.id] = (virt_type, vol_type)
+        self._checkpoint('register', completed=False)
+        raise Return(image)
+
+    def _test_key(self, virt_type):
+        """ Returns the key the test result of the AMIs of `virt_type`
+        registered from the current snapshot is kept under. """
+        return '{0}/{1}'.format(self.snapshot.id, virt_type)
+
+    def _test(self, compose_meta):
+        """ Boots a node from an AMI of each virtualization type, all at
+        once, and checks that each works. The AMIs of a virtualization type
+        differ only in volume type, and are registered from the same
+        snapshot, so one of them is tested for all; the results are kept
+        per snapshot and virtualization type, and what has been tested
+        isn't tested again. """
+        images = collections.OrderedDict()  # virt_type -> AMI to test
+        for image in self.images:
+            images.setdefault(self.image_variants[image.id][0], image)
+        to_test = [(virt_type, image) for virt_type, image in images.items()
+                   if self._test_key(virt_type) not in self.test_results]
+
+        outputs = {}
+        if to_test:
+            checks = get_checks()
+            log.info('Testing {0} AMIs at once'.format(len(to_test)))
+            results = yield [self._test_image(virt_type, image, checks,
+                                              compose_meta)
+                             for virt_type, image in to_test]
+            for (virt_type, _), (passed, data) in zip(to_test, results):
+                self.test_results[self._test_key(virt_type)] = passed
+                outputs[virt_type] = data
+            self._checkpoint('test', completed=False)
+
+        failed = [virt_type for virt_type in images
+                  if not self.test_results[self._test_key(virt_type)]]
+        if failed:
+            raise EC2AMITestException(
+                "Tests on {0} AMIs failed.\noutput: {1}".format(
+                    ', '.join(failed),
+                    '\n'.join(outputs.get(virt_type, '(tested before)')
+                              for virt_type in failed)))
+
+        # Let this EC2Service know that the AMI tests passed, so
+        # it knows how to proceed.
+        self.test_success = True
+
+    def _test_image(self, virt_type, image, checks, compose_meta):
+        """ Boots a test node from `image` and runs `checks` on it. Hands
+        back a (passed, output) tuple. A node that fails is left in
+        `test_nodes` to be cleaned up. """
+        if virt_type == 'paravirtual':
+            test_size_id = 'm1.xlarge'
+        else:  # HVM
+            test_size_id = 'm3.2xlarge'
+        registration_aki = self._registration_aki(self.region, virt_type)
+
+        log.info('Deploying {0} test node'.format(virt_type))
+
+        # Alert the fedmsg bus that an image test is starting
+        fedimg.messenger.message('image.test', self.raw_url,
+                                 self.destination, 'started',
+                                 extra=self._variant_extra(image),
+                                 compose=compose_meta)
 
-            log.info('Executing utility script')
+        # Actually deploy the test instance
+        try:
+            node = yield self._create_node(
+                name='Fedimg AMI tester', image=image,
+                size=self._size(test_size_id), kernel_id=registration_aki)
+            self.test_nodes[virt_type] = node
+            self._checkpoint('test', completed=False)
+            node = yield self._wait_until_running(node)
+            self.test_nodes[virt_type] = node
 
-            # Run the above command and wait for its exit status
-            chan.exec_command(cmd)
-            status = chan.recv_exit_status()
-            if status != 0:
-                # There was a problem with the SSH command
-                log.error('Problem writing volume with utility instance')
+            # Wait until the test node has SSH running
+            yield self._wait_for_ssh(fedimg.AWS_TEST_USER, node)
+        except Exception as e:
+            log.exception('Failed to boot {0} test node'.format(virt_type))
+            fedimg.messenger.message('image.test', self.raw_url,
+                                     self.destination, 'failed',
+                                     extra=self._variant_extra(image),
+                                     compose=compose_meta)
+            raise Return((False, "Failed to boot test node %r." % e))
 
-                data = "(no data)"
-                if chan.recv_ready():
-                    data = chan.recv(1024 * 32)
+        # Run every check at once, logging their output as it comes
+        output = CheckOutput(virt_type, checks)
+        log.info('Running {0} checks on {1} AMI'.format(len(checks),
+                                                       virt_type))
+        try:
+            status, data = yield self._run_command(
+                fedimg.AWS_TEST_USER, node, suite_command(checks),
+                on_output=output.feed)
+        except Exception as e:
+            log.exception('Failed to run AMI test script')
+            status, data = None, "Failed to run the tests %r." % e
+        output.close()
+        data = '{0}\n{1}'.format(output.summary(), data)
+        if status != 0:
+            # There was a problem with the SSH command
+            log.error('Problem testing new {0} AMI'.format(virt_type))
 
-                fedimg.messenger.message('image.upload', self.raw_url,
-                                         self.destination, 'failed',
-                                         extra={'data': data},
-                                         compose=compose_meta)
+            fedimg.messenger.message('image.test', self.raw_url,
+                                     self.destination, 'failed',
+                                     extra=self._variant_extra(
+                                         image, data=data),
+                                     compose=compose_meta)
+            raise Return((False, data))
 
-                raise EC2UtilityException(
-                    "Problem writing image to utility instance volume. "
-                    "Command exited with status {0}.\n"
-                    "command: {1}\n"
-                    "output: {2}".format(status, cmd, data))
+        log.info('{0} AMI test completed'.format(virt_type))
+        fedimg.messenger.message('image.test', self.raw_url,
+                                 self.destination, 'completed',
+                                 extra=self._variant_extra(image),
+                                 compose=compose_meta)
 
-            client.close()
+        log.info('Destroying {0} test node'.format(virt_type))
 
-            # Get volume name that image was written to
-            vol_id = [x['ebs']['volume_id'] for x in
-                      self.util_node.extra['block_device_mapping'] if
-                      x['device_name'] == '/dev/sdb'][0]
+        # Destroy the test node
+        close_ssh(node)
+        yield self.driver.job('destroy_node', node)
+        del self.test_nodes[virt_type]
+        raise Return((True, data))
 
-            log.info('Destroying utility node')
+    def _publicize(self, compose_meta):
+        """ Makes the AMIs in the origin region public. """
 
-            # Terminate the utility instance
-            driver.destroy_node(self.util_node)
+        # Make AMIs public
+        for image in self.images:
+            yield self.driver.job(
+                'ex_modify_image_attribute', image,
+                {'LaunchPermission.Add.1.Group': 'all'})
 
-            # Wait for utility node to be terminated
-            while ssh_connection_works(fedimg.AWS_UTIL_USER,
-                                       self.util_node.public_ips[0],
-                                       fedimg.AWS_KEYPATH):
-                sleep(10)
+    def _copy(self, compose_meta):
+        """ Copies every AMI to every other region, all regions at once. """
 
-            # Wait a little longer since loss of SSH connectivity doesn't mean
-            # that the node's destroyed
-            # TODO: Check instance state rather than this lame sleep thing
-            sleep(45)
+        # Use the AMI list as a way to cycle through the regions
+        # (we don't need the origin region). Each region is its own job
+        # and is tracked separately in `region_status`.
+        yield [self._copy_to_region(ami, compose_meta)
+               for ami in self.test_amis[1:]
+               if self.region_status.get(ami.region) != 'completed']
 
-            # Take a snapshot of the volume the image was written to
-            self.util_volume = [v for v in driver.list_volumes()
-                                if v.id == vol_id][0]
-            snap_name = 'fedimg-snap-{0}'.format(self.build_name)
+    def _copy_to_region(self, ami, compose_meta):
+        """ Copies every AMI into the region of `ami` and makes the copies
+        public once they are available. """
 
-            log.info('Taking a snapshot of the written volume')
+        # Choose an appropriate destination name for the copy
+        alt_dest = 'EC2 ({region})'.format(region=ami.region)
+        self.region_status[ami.region] = 'started'
 
-            self.snapshot = driver.create_volume_snapshot(self.util_volume,
-                                                          name=snap_name)
-            snap_id = str(self.snapshot.id)
+        fedimg.messenger.message('image.upload',
+                                 self.raw_url,
+                                 alt_dest, 'started',
+                                 compose=compose_meta)
 
-            while self.snapshot.extra['state'] != 'completed':
-                # Re-obtain snapshot object to get updates on its state
-                self.snapshot = [s for s in driver.list_snapshots()
-                                 if s.id == snap_id][0]
-                sleep(10)
+        # Get a pooled libcloud EC2 driver for the region we want to
+        # copy into
+        alt_driver = ec2_driver(ami.region)
 
-            log.info('Snapshot taken')
+        log.info('AMI copy to {0} started'.format(ami.region))
 
-            # Delete the volume now that we've got the snapshot
-            driver.destroy_volume(self.util_volume)
-            # make sure Fedimg knows that the vol is gone
-            self.util_volume = None
+        # Run the image copies from the origin region to the current
+        # region, once per variant, in parallel.
+        results = yield [
+            self._copy_image(ami, alt_driver, alt_dest, image, compose_meta)
+            for image in self.images]
 
-            log.info('Destroyed volume')
-
-            # Actually register image
-            log.info('Registering image as an AMI')
-
-            if self.virt_type == 'paravirtual':
-                image_name = "{0}-{1}-PV-{2}-0".format(self.build_name,
-                                                  ami['region'],
-                                                  self.vol_type)
-                test_size_id = 'm1.xlarge'
-                # test_amis will include AKIs of the appropriate arch
-                registration_aki = [a['aki'] for a in self.test_amis
-                                    if a['region'] == ami['region']][0]
-                reg_root_device_name = '/dev/sda'
-            else:  # HVM
-                image_name = "{0}-{1}-HVM-{2}-0".format(self.build_name,
-                                                    ami['region'],
-                                                    self.vol_type)
-                test_size_id = 'm3.2xlarge'
-                # Can't supply a kernel image with HVM
-                registration_aki = None
-                reg_root_device_name = '/dev/sda1'
-
-            # For this block device mapping, we have our volume be
-            # based on the snapshot's ID
-            mapping = [{'DeviceName': reg_root_device_name,
-                        'Ebs': {'SnapshotId': snap_id,
-                                'VolumeSize': fedimg.AWS_TEST_VOL_SIZE,
-                                'VolumeType': self.vol_type,
-                                'DeleteOnTermination': 'true'}}]
-
-            # Avoid duplicate image name by incrementing the number at the
-            # end of the image name if there is already an AMI with that name.
-            # TODO: This process could be written nicer.
+        if all(results):
+            self.region_status[ami.region] = 'completed'
+        else:
+            self.region_status[ami.region] = 'failed'
+        self._checkpoint('copy', completed=False)
+
+    def _copy_image(self, ami, alt_driver, alt_dest, image, compose_meta):
+        """ Copies one AMI into the region of `ami` and makes the copy
+        public. Hands back True on success. Holds one of the region's
+        copy slots for as long as the copy is in progress. """
+
+        virt_type, vol_type = self.image_variants[image.id]
+        slots = region_copy_slots(ami.region)
+        queued = time.time()
+        yield slots.acquire()
+        started = time.time()
+        fedimg.metrics.observe('fedimg_copy_slot_wait_seconds',
+                               started - queued, region=ami.region)
+        try:
+            # Construct the full name for the image copy
+            image_name = self._image_name(ami.region,
+                                          virt_type, vol_type)
+
+            # Avoid duplicate image name by incrementing the number
+            # at the end of the image name if there is already an
+            # AMI with that name.
+            # TODO: Again, this could be written better
             while True:
                 try:
                     if self.dup_count > 0:
@@ -401,311 +1370,176 @@ class EC2Service(object):
                         image_name = '-'.join(image_name.split('-')[:-1])
                         # Re-add trailing dup number with new count
                         image_name += '-{0}'.format(self.dup_count)
-                    # Try to register with that name
-                    self.images.append(driver.ex_register_image(
-                        image_name,
-                        description=self.image_desc,
-                        root_device_name=reg_root_device_name,
-                        block_device_mapping=mapping,
-                        virtualization_type=self.virt_type,
-                        kernel_id=registration_aki,
-                        architecture=self.image_arch))
+
+                    image_copy = yield alt_driver.job(
+                        'copy_image', image,
+                        self.test_amis[0].region,
+                        name=image_name,
+                        description=self.image_desc)
+                    # Add the image copy to a list so we can work
+                    # with it later.
+                    self.copied_images.append((ami, image, image_copy))
+
+                    log.info('AMI {0} copied to AMI {1}'.format(
+                        image, image_name))
+
                 except Exception as e:
                     # Check if the problem was a duplicate name
                     if 'InvalidAMIName.Duplicate' in e.message:
-                        # Keep trying until an unused name is found
+                        # Keep trying until an unused name is found.
+                        # This probably won't trigger, since it seems
+                        # like EC2 doesn't mind duplicate AMI names
+                        # when they are being copied, only registered.
+                        # Strange, but apprently true.
                         self.dup_count += 1
                         continue
                     else:
-                        raise
+                        # TODO: Catch a more specific exception
+                        self._copy_failed(ami, alt_dest, image,
+                                          compose_meta)
+                        raise Return(False)
                 break
 
-            log.info('Completed image registration')
-
-            # Emit success fedmsg
-            # TODO: Can probably move this into the above try/except,
-            # to avoid just dumping all the messages at once.
-            for image in self.images:
-                fedimg.messenger.message('image.upload', self.raw_url,
-                                         self.destination, 'completed',
-                                         extra={'id': image.id,
-                                                'virt_type': self.virt_type,
-                                                'vol_type': self.vol_type},
-                                         compose=compose_meta)
-
-            # Now, we'll spin up a node of the AMI to test:
-
-            # Add script for deployment
-            # Device becomes /dev/xvdb on instance
-            script = "touch test"
-            step_2 = ScriptDeployment(script)
-
-            # Create deployment object
-            msd = MultiStepDeployment([step_1, step_2])
-
-            log.info('Deploying test node')
-
-            # Pick a name for the test instance
-            name = 'Fedimg AMI tester'
-
-            # Select the appropriate size for the instance
-            size = [s for s in sizes if s.id == test_size_id][0]
-
-            # Alert the fedmsg bus that an image test is starting
-            fedimg.messenger.message('image.test', self.raw_url,
-                                     self.destination, 'started',
-                                     extra={'id': self.images[0].id,
-                                            'virt_type': self.virt_type,
-                                            'vol_type': self.vol_type},
-                                     compose=compose_meta)
-
-            # Actually deploy the test instance
             try:
-                self.test_node = driver.deploy_node(
-                    name=name, image=self.images[0], size=size,
-                    ssh_username=fedimg.AWS_TEST_USER,
-                    ssh_alternate_usernames=['root'],
-                    ssh_key=fedimg.AWS_KEYPATH,
-                    deploy=msd,
-                    kernel_id=registration_aki,
-                    ex_metadata={'build': self.build_name},
-                    ex_keyname=fedimg.AWS_KEYNAME,
-                    ex_security_groups=['ssh'],
-                    )
-            except Exception as e:
-                fedimg.messenger.message('image.test', self.raw_url,
-                                         self.destination, 'failed',
-                                         extra={'id': self.images[0].id,
-                                                'virt_type': self.virt_type,
-                                                'vol_type': self.vol_type},
-                                         compose=compose_meta)
-
-                raise EC2AMITestException("Failed to boot test node %r." % e)
-
-            # Wait until the test node has SSH running
-            while not ssh_connection_works(fedimg.AWS_TEST_USER,
-                                           self.test_node.public_ips[0],
-                                           fedimg.AWS_KEYPATH):
-                sleep(10)
-
-            log.info('Starting AMI tests')
-
-            client = paramiko.SSHClient()
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            client.connect(self.test_node.public_ips[0],
-                           username=fedimg.AWS_TEST_USER,
-                           key_filename=fedimg.AWS_KEYPATH)
-
-            # Run /bin/true on the test instance as a simple "does it
-            # work" test
-            cmd = "/bin/true"
-            chan = client.get_transport().open_session()
-            chan.get_pty()  # Request a pseudo-term to get around requiretty
-
-            log.info('Running AMI test script')
-
-            chan.exec_command(cmd)
+                # Need to wait until the copy finishes in order to make
+                # the AMI public.
+                yield get_waiter(ami.region).wait_for(
+                    'image', image_copy.id, ['available'])
 
-            # Again, wait for the test command's exit status
-            if chan.recv_exit_status() != 0:
-                # There was a problem with the SSH command
-                log.error('Problem testing new AMI')
+                # Make the image public
+                yield alt_driver.job(
+                    'ex_modify_image_attribute', image_copy,
+                    {'LaunchPermission.Add.1.Group': 'all'})
+            except Exception:
+                self._copy_failed(ami, alt_dest, image, compose_meta)
+                raise Return(False)
+            fedimg.metrics.observe('fedimg_copy_seconds',
+                                   time.time() - started, region=ami.region,
+                                   virt_type=virt_type, vol_type=vol_type)
+        finally:
+            slots.release()
+
+        log.info('Made {0} public ({1}, {2}, {3})'.format(
+            image_copy.id, self.build_name, virt_type, vol_type))
+
+        fedimg.messenger.message('image.upload',
+                                 self.raw_url,
+                                 alt_dest, 'completed',
+                                 extra={'id': image_copy.id,
+                                        'virt_type': virt_type,
+                                        'vol_type': vol_type},
+                                 compose=compose_meta)
+        raise Return(True)
 
-                data = "(no data)"
-                if chan.recv_ready():
-                    data = chan.recv(1024 * 32)
+    def _copy_failed(self, ami, alt_dest, image, compose_meta):
+        """ Reports that copying `image` into the region of `ami` failed,
+        for the exception being handled. """
+        log.exception('Image copy to {0} failed'.format(ami.region))
+        fedimg.messenger.message('image.upload', self.raw_url,
+                                 alt_dest, 'failed',
+                                 extra=self._variant_extra(image),
+                                 compose=compose_meta)
 
-                fedimg.messenger.message('image.test', self.raw_url,
-                                         self.destination, 'failed',
-                                         extra={'id': self.images[0].id,
-                                                'virt_type': self.virt_type,
-                                                'vol_type': self.vol_type,
-                                                'data': data},
-                                         compose=compose_meta)
+    def cancel(self):
+        """ Asks the upload to stop. It stops before its next build stage
+        and cleans up; once the AMIs are being published, it carries on to
+        the end. """
+        self.cancelled = True
+
+    def _run_stages(self, stages, compose_meta):
+        """ Runs each of `stages` that hasn't completed yet, in order. """
+        for stage in stages:
+            if stage in self.completed_stages:
+                continue
+            if self.cancelled and stage in self.build_stages:
+                raise EC2CancelledException(
+                    'Cancelled before stage {0}'.format(stage))
+            self.stage = stage
+            log.info('{0}: entering stage {1}'.format(self.build_name, stage))
+            with fedimg.metrics.timer('fedimg_stage_seconds', stage=stage,
+                                      region=self.region):
+                step = getattr(self, '_' + stage)(compose_meta)
+                if isinstance(step, types.GeneratorType):
+                    yield step
+            self.completed_stages.append(stage)
+            self._checkpoint(stage)
+
+    def pipeline(self, compose_meta):
+        """ Registers the image in each EC2 region. This is a generator, to
+        be run by a `fedimg.pipeline.PipelineEngine`; it hands back 0 on
+        success and 1 on failure. """
 
-                raise EC2AMITestException("Tests on AMI failed.\n"
-                                          "output: %s" % data)
+        log.info('EC2 upload process started')
 
-            client.close()
+        # Get a starting utility AMI in some region to use as an origin
+        ami = self.util_amis[0]  # Select the starting AMI to begin
+        self.destination = 'EC2 ({region})'.format(region=ami.region)
 
-            log.info('AMI test completed')
-            fedimg.messenger.message('image.test', self.raw_url,
-                                     self.destination, 'completed',
-                                     extra={'id': self.images[0].id,
-                                            'virt_type': self.virt_type,
-                                            'vol_type': self.vol_type},
-                                     compose=compose_meta)
+        fedimg.messenger.message('image.upload', self.raw_url,
+                                 self.destination, 'started',
+                                 compose=compose_meta)
 
-            # Let this EC2Service know that the AMI test passed, so
-            # it knows how to proceed.
-            self.test_success = True
+        try:
+            # Connect to the region through a pooled libcloud driver
+            self.region = ami.region
+            self.driver = ec2_driver(self.region)
+            if self.ingestion == 'utility':
+                self.util_pool = get_utility_pool(self.region)
 
-            log.info('Destroying test node')
+            if self.journal is not None:
+                if self.journal.start(self.raw_url, self.raw_url,
+                                      compose_meta):
+                    yield self._restore()
 
-            # Destroy the test node
-            driver.destroy_node(self.test_node)
+            # select the desired node attributes
+            self.sizes = yield self.driver.job('list_sizes')
 
-            # Make AMIs public
-            for image in self.images:
-                driver.ex_modify_image_attribute(
-                    image,
-                    {'LaunchPermission.Add.1.Group': 'all'})
+            yield self._run_stages(self.build_stages, compose_meta)
 
         except EC2UtilityException as e:
             log.exception("Failure")
             if fedimg.CLEAN_UP_ON_FAILURE:
-                self._clean_up(driver,
-                               delete_images=fedimg.DELETE_IMAGES_ON_FAILURE)
-            return 1
+                yield self._clean_up(
+                    self.driver,
+                    delete_images=fedimg.DELETE_IMAGES_ON_FAILURE)
+            self._finish_job(FAILED)
+            raise Return(1)
 
         except EC2AMITestException as e:
             log.exception("Failure")
             if fedimg.CLEAN_UP_ON_FAILURE:
-                self._clean_up(driver,
-                               delete_images=fedimg.DELETE_IMAGES_ON_FAILURE)
-            return 1
-
-        except DeploymentException as e:
-            log.exception("Problem deploying node: {0}".format(e.value))
-            if fedimg.CLEAN_UP_ON_FAILURE:
-                self._clean_up(driver,
-                               delete_images=fedimg.DELETE_IMAGES_ON_FAILURE)
-            return 1
+                yield self._clean_up(
+                    self.driver,
+                    delete_images=fedimg.DELETE_IMAGES_ON_FAILURE)
+            self._finish_job(FAILED)
+            raise Return(1)
+
+        except EC2CancelledException as e:
+            log.info('{0}: {1}'.format(self.build_name, e))
+            yield self._clean_up(self.driver, delete_images=True)
+            self._finish_job(FAILED)
+            raise Return(1)
 
         except Exception as e:
             # Just give a general failure message.
             log.exception("Unexpected exception")
             if fedimg.CLEAN_UP_ON_FAILURE:
-                self._clean_up(driver,
-                               delete_images=fedimg.DELETE_IMAGES_ON_FAILURE)
-            return 1
+                yield self._clean_up(
+                    self.driver,
+                    delete_images=fedimg.DELETE_IMAGES_ON_FAILURE)
+            self._finish_job(FAILED)
+            raise Return(1)
 
         else:
-            self._clean_up(driver)
+            yield self._clean_up(self.driver)
 
         if self.test_success:
-            # Copy the AMI to every other region if tests passed
-            copied_images = list()  # completed image copies (ami: image)
-
-            # Use the AMI list as a way to cycle through the regions
-            for ami in self.test_amis[1:]:  # we don't need the origin region
-
-                # Choose an appropriate destination name for the copy
-                alt_dest = 'EC2 ({region})'.format(
-                    region=ami['region'])
-
-                fedimg.messenger.message('image.upload',
-                                         self.raw_url,
-                                         alt_dest, 'started',
-                                         compose=compose_meta)
-
-                # Connect to the libcloud EC2 driver for the region we
-                # want to copy into
-                alt_cls = ami['driver']
-                alt_driver = alt_cls(fedimg.AWS_ACCESS_ID,
-                                     fedimg.AWS_SECRET_KEY)
-
-                # Construct the full name for the image copy
-                if self.virt_type == 'paravirtual':
-                    image_name = "{0}-{1}-PV-{2}-0".format(
-                        self.build_name, ami['region'], self.vol_type)
-                else:  # HVM
-                    image_name = "{0}-{1}-HVM-{2}-0".format(
-                        self.build_name, ami['region'], self.vol_type)
-
-                log.info('AMI copy to {0} started'.format(ami['region']))
-
-                # Avoid duplicate image name by incrementing the number at the
-                # end of the image name if there is already an AMI with
-                # that name.
-                # TODO: Again, this could be written better
-                while True:
-                    try:
-                        if self.dup_count > 0:
-                            # Remove trailing '-0' or '-1' or '-2' or...
-                            image_name = '-'.join(image_name.split('-')[:-1])
-                            # Re-add trailing dup number with new count
-                            image_name += '-{0}'.format(self.dup_count)
-
-                        # Actually run the image copy from the origin region
-                        # to the current region.
-                        for image in self.images:
-                            image_copy = alt_driver.copy_image(
-                                image,
-                                self.test_amis[0]['region'],
-                                name=image_name,
-                                description=self.image_desc)
-                            # Add the image copy to a list so we can work with
-                            # it later.
-                            copied_images.append(image_copy)
-
-                            log.info('AMI {0} copied to AMI {1}'.format(
-                                image, image_name))
-
-                    except Exception as e:
-                        # Check if the problem was a duplicate name
-                        if 'InvalidAMIName.Duplicate' in e.message:
-                            # Keep trying until an unused name is found.
-                            # This probably won't trigger, since it seems
-                            # like EC2 doesn't mind duplicate AMI names
-                            # when they are being copied, only registered.
-                            # Strange, but apprently true.
-                            self.dup_count += 1
-                            continue
-                        else:
-                            # TODO: Catch a more specific exception
-                            log.exception(
-                                'Image copy to {0} failed'.format(
-                                    ami['region']))
-                            fedimg.messenger.message('image.upload',
-                                                     self.raw_url,
-                                                     alt_dest, 'failed',
-                                                     compose=compose_meta)
-                    break
-
-            # Now cycle through and make all of the copied AMIs public
-            # once the copy process has completed. Again, use the test
-            # AMI list as a way to have region and arch data:
+            # Copy the AMIs to every other region if tests passed
+            yield self._run_stages(self.DISTRIBUTE_STAGES, compose_meta)
 
-            # We don't need the origin region, since the AMI was made there:
-            self.test_amis = self.test_amis[1:]
+        self._finish_job(DONE)
+        raise Return(0)
 
-            for image in copied_images:
-                ami = self.test_amis[copied_images.index(image)]
-                alt_cls = ami['driver']
-                alt_driver = alt_cls(fedimg.AWS_ACCESS_ID,
-                                     fedimg.AWS_SECRET_KEY)
-
-                # Get an appropriate name for the region in question
-                alt_dest = 'EC2 ({region})'.format(region=ami['region'])
-
-                # Need to wait until the copy finishes in order to make
-                # the AMI public.
-                while True:
-                    try:
-                        # Make the image public
-                        alt_driver.ex_modify_image_attribute(
-                            image,
-                            {'LaunchPermission.Add.1.Group': 'all'})
-                    except Exception as e:
-                        if 'InvalidAMIID.Unavailable' in e.message:
-                            # The copy isn't done, so wait 20 seconds
-                            # and try again.
-                            sleep(20)
-                            continue
-                    break
-
-                log.info('Made {0} public ({1}, {2}, {3})'.format(image.id,
-                                                                  self.build_name,
-                                                                  self.virt_type,
-                                                                  self.vol_type))
-
-                fedimg.messenger.message('image.upload',
-                                         self.raw_url,
-                                         alt_dest, 'completed',
-                                         extra={'id': image.id,
-                                                'virt_type': self.virt_type,
-                                                'vol_type': self.vol_type},
-                                         compose=compose_meta)
-
-            return 0
+    def upload(self, compose_meta):
+        """ Registers the image in each EC2 region, blocking until done. """
+        return run_sync(self.pipeline(compose_meta))
@@ -25,10 +25,11 @@ import subprocess
 from libcloud.compute.base import NodeImage
 from libcloud.compute.deployment import MultiStepDeployment
 from libcloud.compute.deployment import ScriptDeployment, SSHKeyDeployment
-from libcloud.compute.providers import get_driver
 from libcloud.compute.types import Provider, DeploymentException
 
 import fedimg
+import fedimg.drivers
+from fedimg.drivers import PooledDriver
 
 
 class GCEServiceException(Exception):
@@ -46,10 +47,10 @@ class GCEService(object):
         """ Takes a URL to a .raw.xz file and registers it as an image
         in each Rackspace region. """
 
-        cls = get_driver(Provider.GCE)
-        driver = cls(fedimg.GCE_EMAIL, fedimg.GCE_KEYPATH,
-                     project=fedimg.GCE_PROJECT_ID,
-                     datacenter=self.datacenters[0])
+        driver = PooledDriver(fedimg.drivers.pool, Provider.GCE, None,
+                              fedimg.GCE_EMAIL, fedimg.GCE_KEYPATH,
+                              project=fedimg.GCE_PROJECT_ID,
+                              datacenter=self.datacenters[0])
 
         # create image from official Fedora image on GCE
 
@@ -25,10 +25,11 @@ import subprocess
 from libcloud.compute.base import NodeImage
 from libcloud.compute.deployment import MultiStepDeployment
 from libcloud.compute.deployment import ScriptDeployment, SSHKeyDeployment
-from libcloud.compute.providers import get_driver
 from libcloud.compute.types import Provider, DeploymentException
 
 import fedimg
+import fedimg.drivers
+from fedimg.drivers import PooledDriver
 
 
 class HPServiceException(Exception):
@@ -46,10 +47,10 @@ class HPService(object):
         """ Takes a URL to a .raw.xz file and registers it as an image
         in each Rackspace region. """
 
-        cls = get_driver(Provider.HPCLOUD)
-        driver = cls(fedimg.HP_USER, fedimg.HP_PASSWORD,
-                     tenant_name=fedimg.HP_TENANT,
-                     region=self.regions[0])
+        driver = PooledDriver(fedimg.drivers.pool, Provider.HPCLOUD,
+                              self.regions[0], fedimg.HP_USER,
+                              fedimg.HP_PASSWORD,
+                              tenant_name=fedimg.HP_TENANT)
 
         # create image from official Fedora image on HP
 
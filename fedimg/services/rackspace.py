@@ -25,10 +25,11 @@ import subprocess
 from libcloud.compute.base import NodeImage
 from libcloud.compute.deployment import MultiStepDeployment
 from libcloud.compute.deployment import ScriptDeployment, SSHKeyDeployment
-from libcloud.compute.providers import get_driver
 from libcloud.compute.types import Provider, DeploymentException
 
 import fedimg
+import fedimg.drivers
+from fedimg.drivers import PooledDriver
 
 
 class RackspaceServiceException(Exception):
@@ -47,9 +48,9 @@ class RackspaceService(object):
         """ Takes a URL to a .raw.xz file and registers it as an image
         in each Rackspace region. """
 
-        cls = get_driver(Provider.RACKSPACE)
-        driver = cls(fedimg.RACKSPACE_USER, fedimg.RACKSPACE_API_KEY,
-                     region=self.regions[0])
+        driver = PooledDriver(fedimg.drivers.pool, Provider.RACKSPACE,
+                              self.regions[0], fedimg.RACKSPACE_USER,
+                              fedimg.RACKSPACE_API_KEY)
 
         # create image from official Fedora image on Rackspace
 
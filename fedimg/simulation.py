@@ -0,0 +1,671 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+"""
+An in-memory stand-in for EC2, and for SSH to its instances, for measuring
+fedimg's own scheduling and concurrency without AWS.
+
+`simulate()` puts the fakes in place of the libcloud drivers and the SSH
+client while the real `EC2Service` and `Uploader` code runs. Resources
+change state after configurable delays, calls can be made to fail at
+configurable rates, and time can be scaled down so that hours of uploads
+take seconds. `run_benchmark()` drives a batch of composes through it.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import collections
+import contextlib
+import functools
+import itertools
+import random
+import socket
+import threading
+import time
+from xml.etree import ElementTree as ET
+
+from libcloud.compute.base import Node, NodeImage, NodeSize
+from libcloud.compute.base import StorageVolume, VolumeSnapshot
+from libcloud.compute.drivers.ec2 import NAMESPACE
+from libcloud.compute.types import NodeState
+
+import fedimg
+import fedimg.catalog
+import fedimg.drivers
+import fedimg.messenger
+import fedimg.ratelimit
+import fedimg.services.ec2
+import fedimg.uploader
+import fedimg.util
+import fedimg.waiters
+from fedimg.catalog import AMICatalog, AMIEntry
+from fedimg.pipeline import PipelineEngine
+
+# How long things take, in simulated seconds
+LATENCIES = {
+    'api': 0.2,  # every API call
+    'boot': 60,  # a node going from pending to running
+    'status': 90,  # a running node passing its status checks
+    'terminate': 30,  # a node terminating
+    'detach': 10,  # a node's volume becoming available once it terminates
+    'attach': 5,  # a volume being created, attached or detached
+    'write': 300,  # writing the image to the utility node's volume
+    'test': 5,  # running the test command
+    'snapshot': 240,  # a snapshot completing
+    'register': 5,  # a registered AMI becoming available
+    'copy': 900,  # a copied AMI becoming available
+}
+
+
+class SimulatedFailure(Exception):
+    """ A failure injected by the simulation. """
+    pass
+
+
+class FakeCloud(object):
+    """ The state of every simulated region. `latencies` override entries
+    of `LATENCIES`, and `failure_rates` map the names of driver methods, or
+    'write' and 'test' for the commands run over SSH, to the chance that
+    they fail. A 'throttle' rate makes any API call be refused with
+    RequestLimitExceeded. Simulated seconds last `time_scale` real
+    seconds. """
+
+    def __init__(self, latencies=None, failure_rates=None, time_scale=1.0,
+                 seed=None):
+        self.latencies = dict(LATENCIES, **(latencies or {}))
+        self.failure_rates = failure_rates or {}
+        self.time_scale = time_scale
+        self.calls = collections.Counter()  # (region, method) -> calls
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        # ID -> (region, list of (time, state) transitions), for every
+        # kind of resource
+        self._timelines = {}
+        self._node_volumes = {}  # node ID -> [(device, volume ID)]
+        self._node_ips = {}  # public IP -> node ID
+
+    def delay(self, name):
+        """ Returns how many real seconds `name` (see `LATENCIES`) takes. """
+        return self.latencies[name] * self.time_scale
+
+    def fails(self, name):
+        """ Decides whether this call of `name` fails. """
+        rate = self.failure_rates.get(name, 0)
+        with self._lock:
+            return rate > 0 and self._random.random() < rate
+
+    def call(self, region, method):
+        """ Accounts for an API call, which may be made to fail. """
+        with self._lock:
+            self.calls[(region, method)] += 1
+        time.sleep(self.delay('api'))
+        if self.fails('throttle'):
+            raise SimulatedFailure('RequestLimitExceeded: Request limit '
+                                   'exceeded in {0}'.format(region))
+        if self.fails(method):
+            raise SimulatedFailure('{0} failed in {1}'.format(method, region))
+
+    def create(self, region, prefix, *transitions):
+        """ Adds a resource that goes through each (state, delay) of
+        `transitions` in turn, and returns its ID. """
+        with self._lock:
+            resource_id = '{0}-{1:08x}'.format(prefix, next(self._ids))
+            self._timelines[resource_id] = (region, [])
+        self.transition(resource_id, *transitions)
+        return resource_id
+
+    def transition(self, resource_id, *transitions):
+        """ Moves a resource through each (state, delay) of `transitions`,
+        counting the delays from now. """
+        now = time.time()
+        with self._lock:
+            timeline = self._timelines[resource_id][1]
+            for state, delay in transitions:
+                timeline.append((now + self.delay(delay)
+                                 if delay else now, state))
+            timeline.sort()
+
+    def state(self, resource_id, region=None):
+        """ Returns the current state of a resource, or None if there is no
+        such resource (in `region`). """
+        now = time.time()
+        with self._lock:
+            if resource_id not in self._timelines:
+                return None
+            where, timeline = self._timelines[resource_id]
+            states = [state for at, state in timeline if at <= now]
+        if region is not None and where != region:
+            return None
+        return states[-1] if states else None
+
+    def since(self, resource_id, state):
+        """ Returns when a resource reached `state`, or None. """
+        with self._lock:
+            for at, reached in self._timelines[resource_id][1]:
+                if reached == state:
+                    return at
+        return None
+
+    def delete(self, resource_id):
+        with self._lock:
+            self._timelines.pop(resource_id, None)
+
+    def add_node(self, region, with_volume):
+        node_id = self.create(region, 'i', ('pending', None),
+                              ('running', 'boot'))
+        volume_id = None
+        if with_volume:
+            volume_id = self.create(region, 'vol', ('in-use', None))
+        with self._lock:
+            n = len(self._node_ips)
+            ip = '10.{0}.{1}.{2}'.format(n >> 16 & 255, n >> 8 & 255,
+                                         n & 255)
+            self._node_ips[ip] = node_id
+            self._node_volumes[node_id] = []
+            if volume_id is not None:
+                self._node_volumes[node_id].append(('/dev/sdb', volume_id))
+        return node_id, ip
+
+    def attach(self, node_id, volume_id, device=None):
+        """ Attaches a volume to a node at `device`, or detaches it if
+        `node_id` is None. """
+        with self._lock:
+            for volumes in self._node_volumes.values():
+                volumes[:] = [(d, v) for d, v in volumes if v != volume_id]
+            if node_id is not None:
+                self._node_volumes[node_id].append((device, volume_id))
+        if node_id is None:
+            self.transition(volume_id, ('detaching', None),
+                            ('available', 'attach'))
+        else:
+            self.transition(volume_id, ('attaching', None),
+                            ('in-use', 'attach'))
+
+    def node_status(self, node_id):
+        """ Rolls a node's state and status checks into one, as the
+        waiters do. """
+        state = self.state(node_id)
+        if state != 'running':
+            return state
+        if time.time() - self.since(node_id, 'running') < \
+                self.delay('status'):
+            return 'initializing'
+        return 'ok'
+
+    def node_at(self, ip):
+        with self._lock:
+            return self._node_ips.get(ip)
+
+    def reachable(self, ip):
+        """ Whether the node at `ip` answers on port 22. """
+        node_id = self.node_at(ip)
+        return node_id is not None and self.node_status(node_id) == 'ok'
+
+
+class _Response(object):
+    def __init__(self, obj):
+        self.object = obj
+
+
+class _Connection(object):
+    """ Answers the raw Describe calls the waiters make. """
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    def request(self, path, params):
+        action = params['Action']
+        self.driver._call(action)
+        if action == 'DescribeSnapshots':
+            return _Response(self.driver._lookup(
+                params.get('filters', {}).get('snapshot-id'),
+                params.get('ids'), 'InvalidSnapshot'))
+        if action == 'DescribeInstanceStatus':
+            self.driver._lookup(None, params['ids'], 'InvalidInstanceID')
+            root = ET.Element('DescribeInstanceStatusResponse',
+                              xmlns=NAMESPACE)
+            items = ET.SubElement(root, 'instanceStatusSet')
+            for node_id in params['ids']:
+                status = self.driver.cloud.node_status(node_id)
+                if status is None:
+                    continue
+                item = ET.SubElement(items, 'item')
+                ET.SubElement(item, 'instanceId').text = node_id
+                state = ET.SubElement(item, 'instanceState')
+                checks = {'ok': 'ok', 'initializing': 'initializing'}
+                ET.SubElement(state, 'name').text = (
+                    'running' if status in checks else status)
+                for name in ('systemStatus', 'instanceStatus'):
+                    check = ET.SubElement(item, name)
+                    ET.SubElement(check, 'status').text = checks.get(
+                        status, 'not-applicable')
+            # Parsed back, so it carries the namespace like a response
+            return _Response(ET.fromstring(ET.tostring(root)))
+        raise NotImplementedError(action)
+
+
+class FakeEC2Driver(object):
+    """ A libcloud EC2 driver for a region of a `FakeCloud`, covering the
+    calls that fedimg makes. """
+
+    name = 'Simulated EC2'
+    path = '/'
+
+    def __init__(self, cloud, key, secret, region=None, **kwargs):
+        self.cloud = cloud
+        self.region = region
+        self.connection = _Connection(self)
+
+    def _call(self, method):
+        self.cloud.call(self.region, method)
+
+    def _lookup(self, filtered, ids, error):
+        """ Returns which of the IDs asked for exist. As on EC2, IDs that
+        are filtered for are left out if unknown, while IDs that are asked
+        for by name fail the whole call. """
+        if ids is not None:
+            unknown = [i for i in ids
+                       if self.cloud.state(i, self.region) is None]
+            if unknown:
+                raise Exception("{0}.NotFound: The IDs '{1}' do not "
+                                "exist".format(error, ', '.join(unknown)))
+            return ids
+        return [i for i in filtered or []
+                if self.cloud.state(i, self.region) is not None]
+
+    def _node(self, node_id, ip=None):
+        state = self.cloud.state(node_id)
+        mapping = [{'device_name': device, 'ebs': {'volume_id': volume_id}}
+                   for device, volume_id
+                   in self.cloud._node_volumes.get(node_id, [])]
+        if ip is None:
+            ip = [i for i, n in self.cloud._node_ips.items()
+                  if n == node_id][0]
+        return Node(id=node_id, name=node_id,
+                    state=NodeState.RUNNING if state == 'running'
+                    else NodeState.PENDING,
+                    public_ips=[ip], private_ips=[], driver=self,
+                    extra={'status': state,
+                           'availability': '{0}a'.format(self.region),
+                           'block_device_mapping': mapping})
+
+    def list_sizes(self):
+        self._call('list_sizes')
+        return [NodeSize(id=size, name=size, ram=None, disk=None,
+                         bandwidth=None, price=None, driver=self)
+                for size in ('m1.xlarge', 'm3.2xlarge')]
+
+    def create_node(self, **kwargs):
+        self._call('create_node')
+        node_id, ip = self.cloud.add_node(
+            self.region, 'ex_blockdevicemappings' in kwargs)
+        return self._node(node_id, ip)
+
+    def list_nodes(self, ex_node_ids=None, ex_filters=None):
+        self._call('list_nodes')
+        return [self._node(i) for i in self._lookup(
+            (ex_filters or {}).get('instance-id'), ex_node_ids,
+            'InvalidInstanceID')]
+
+    def destroy_node(self, node):
+        self._call('destroy_node')
+        self.cloud.transition(node.id, ('shutting-down', None),
+                              ('terminated', 'terminate'))
+        for _, volume_id in self.cloud._node_volumes.get(node.id, []):
+            self.cloud.transition(volume_id, ('available', 'detach'))
+        return True
+
+    def list_volumes(self, ex_filters):
+        self._call('list_volumes')
+        return [StorageVolume(id=i, name=i, size=None, driver=self,
+                              extra={'state': self.cloud.state(i)})
+                for i in ex_filters['volume-id']
+                if self.cloud.state(i, self.region) is not None]
+
+    def create_volume(self, size, name, location=None, snapshot=None,
+                      ex_volume_type='standard', **kwargs):
+        self._call('create_volume')
+        volume_id = self.cloud.create(self.region, 'vol',
+                                      ('creating', None),
+                                      ('available', 'attach'))
+        return StorageVolume(id=volume_id, name=name, size=size, driver=self,
+                             extra={'state': 'creating'})
+
+    def attach_volume(self, node, volume, device):
+        self._call('attach_volume')
+        self.cloud.attach(node.id, volume.id, device)
+        return True
+
+    def detach_volume(self, volume, ex_force=False):
+        self._call('detach_volume')
+        self.cloud.attach(None, volume.id)
+        return True
+
+    def destroy_volume(self, volume):
+        self._call('destroy_volume')
+        self.cloud.delete(volume.id)
+        return True
+
+    def create_volume_snapshot(self, volume, name=None):
+        self._call('create_volume_snapshot')
+        snap_id = self.cloud.create(self.region, 'snap', ('pending', None),
+                                    ('completed', 'snapshot'))
+        return VolumeSnapshot(id=snap_id, driver=self,
+                              extra={'state': 'pending'})
+
+    def destroy_volume_snapshot(self, snapshot):
+        self._call('destroy_volume_snapshot')
+        self.cloud.delete(snapshot.id)
+        return True
+
+    def _pathlist(self, key, ids):
+        return {'ids': ids}
+
+    def _build_filters(self, filters):
+        return {'filters': filters}
+
+    def _to_snapshots(self, ids):
+        return [VolumeSnapshot(id=i, driver=self,
+                               extra={'state': self.cloud.state(i)})
+                for i in ids if self.cloud.state(i, self.region) is not None]
+
+    def _image(self, image_id, name=None):
+        return NodeImage(id=image_id, name=name, driver=self,
+                         extra={'state': self.cloud.state(image_id)})
+
+    def ex_register_image(self, name, **kwargs):
+        self._call('ex_register_image')
+        return self._image(self.cloud.create(
+            self.region, 'ami', ('pending', None), ('available', 'register')),
+            name)
+
+    def copy_image(self, image, source_region, name=None, **kwargs):
+        self._call('copy_image')
+        return self._image(self.cloud.create(
+            self.region, 'ami', ('pending', None), ('available', 'copy')),
+            name)
+
+    def list_images(self, ex_image_ids=None, ex_filters=None):
+        self._call('list_images')
+        return [self._image(i) for i in self._lookup(
+            (ex_filters or {}).get('image-id'), ex_image_ids,
+            'InvalidAMIID')]
+
+    def ex_modify_image_attribute(self, image, attributes):
+        self._call('ex_modify_image_attribute')
+        return True
+
+    def delete_image(self, image):
+        self._call('delete_image')
+        self.cloud.delete(image.id)
+        return True
+
+    def ex_import_keypair(self, name, keyfile):
+        self._call('ex_import_keypair')
+
+    def ex_create_security_group(self, name, description):
+        self._call('ex_create_security_group')
+
+    def ex_authorize_security_group(self, *args):
+        self._call('ex_authorize_security_group')
+
+
+class _FakeChannel(object):
+    """ A session running one command on a simulated node. """
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+        self._done_at = None
+        self._status = 0
+        self._output = ''
+
+    def get_pty(self):
+        pass
+
+    def exec_command(self, cmd):
+        kind = 'write' if 'dd of=' in cmd else 'test'
+        self._done_at = time.time() + self.cloud.delay(kind)
+        self._status = 1 if self.cloud.fails(kind) else 0
+        if kind == 'write':
+            size = int(fedimg.AWS_UTIL_VOL_SIZE) * 2 ** 30
+            seconds = self.cloud.latencies['write']
+            self._output = '{0} bytes copied, {1} s, {2} MB/s'.format(
+                size, seconds, size // 10 ** 6 // max(seconds, 1))
+
+    def exit_status_ready(self):
+        return time.time() >= self._done_at
+
+    def recv_exit_status(self):
+        return self._status
+
+    def recv_ready(self):
+        # the command's summary comes at the end
+        return self.exit_status_ready() and bool(self._output)
+
+    def recv(self, size):
+        data, self._output = self._output[:size], self._output[size:]
+        return data
+
+    def close(self):
+        pass
+
+
+class _FakeSFTP(object):
+    def putfo(self, fileobj, remote_path):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeSSHClient(object):
+    """ Stands in for `paramiko.SSHClient`, connecting to simulated
+    nodes. It is its own transport. """
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def set_missing_host_key_policy(self, policy):
+        pass
+
+    def connect(self, ip, **kwargs):
+        if not self.cloud.reachable(ip):
+            raise socket.error('Connection refused')
+
+    def get_transport(self):
+        return self
+
+    def is_active(self):
+        return True
+
+    def set_keepalive(self, interval):
+        pass
+
+    def open_session(self):
+        return _FakeChannel(self.cloud)
+
+    def open_sftp_client(self):
+        return _FakeSFTP()
+
+    def close(self):
+        pass
+
+
+class ScaledEngine(PipelineEngine):
+    """ A `PipelineEngine` whose sleeps are scaled by `time_scale`. """
+
+    def __init__(self, time_scale, **kwargs):
+        super(ScaledEngine, self).__init__(**kwargs)
+        self.time_scale = time_scale
+
+    def sleep(self, seconds):
+        return super(ScaledEngine, self).sleep(seconds * self.time_scale)
+
+
+def region_names(count):
+    """ Returns the names of `count` simulated regions. """
+    return ['sim-region-{0}'.format(i + 1) for i in range(count)]
+
+
+@contextlib.contextmanager
+def patched(replacements):
+    """ Sets each (object, attribute name, value) of `replacements` for
+    the duration of a `with` block. """
+    originals = [(obj, name, getattr(obj, name))
+                 for obj, name, _ in replacements]
+    for obj, name, value in replacements:
+        setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        for obj, name, value in originals:
+            setattr(obj, name, value)
+
+
+@contextlib.contextmanager
+def simulate(cloud, regions, util_pool=0, util_volumes=1):
+    """ Runs fedimg against `cloud` for the duration of a `with` block,
+    with AMIs in each of `regions` (the first being the origin), a pool of
+    up to `util_pool` utility nodes, and up to `util_volumes` images
+    written at once on each utility node. Messages are counted rather than
+    sent, journaling and caching are off, and the waiters, API rate limits
+    and utility node pool run on the cloud's time scale. Yields a Counter
+    of the messages that would have been sent, by topic and status. """
+    messages = collections.Counter()
+
+    def message(topic, image_url, dest, status, compose, extra=None):
+        messages[(topic, status)] += 1
+
+    catalog = AMICatalog(AMIEntry(region, 'x86_64', 'ami-{0}'.format(i),
+                                  'aki-{0}'.format(i))
+                         for i, region in enumerate(regions))
+    scale = cloud.time_scale
+    waiters = dict((region, fedimg.waiters.RegionWaiter(
+        region, base_delay=2 * scale, max_delay=60 * scale))
+        for region in regions)
+
+    # API rate limits are per simulated second too
+    limiter = fedimg.ratelimit.RateLimiter(
+        dict((family, (rate / scale, burst)) for family, (rate, burst)
+             in fedimg.ratelimit.default_rates().items()),
+        base_backoff=scale, max_backoff=30 * scale)
+
+    pool_engine = ScaledEngine(scale, workers=1, name='fedimg-sim-pool')
+
+    ec2 = fedimg.services.ec2
+    replaced = [
+        (fedimg.drivers, 'get_driver',
+         lambda provider: functools.partial(FakeEC2Driver, cloud)),
+        (fedimg.util, '_ssh_sessions', fedimg.util.SSHSessions(
+            None, client_factory=functools.partial(FakeSSHClient, cloud))),
+        (ec2, 'port_is_open', lambda ip, *args: cloud.reachable(ip)),
+        (ec2, 'get_cache', lambda: None),
+        (fedimg.messenger, 'message', message),
+        (fedimg.uploader, 'get_journal', lambda: None),
+        (fedimg.catalog, '_catalog', catalog),
+        (fedimg.waiters, '_waiters', waiters),
+        (fedimg.ratelimit, 'limiter', limiter),
+        (ec2, '_util_pools', {}),
+        (ec2, '_util_pool_engine', [pool_engine]),
+        (fedimg, 'AWS_INGESTION', 'utility'),
+        (fedimg, 'AWS_UTIL_POOL_SIZE', util_pool),
+        (fedimg, 'AWS_UTIL_NODE_VOLUMES', util_volumes),
+    ]
+    fedimg.drivers.pool.clear()
+    try:
+        with patched(replaced):
+            try:
+                yield messages
+            finally:
+                ec2.drain_utility_pools()
+    finally:
+        pool_engine.shutdown(wait=True)
+        fedimg.drivers.pool.clear()
+
+
+def run_benchmark(composes=10, images=2, regions=8, time_scale=0.001,
+                  workers=4, max_jobs=8, latencies=None, failure_rates=None,
+                  seed=None, util_pool=0, util_volumes=1):
+    """ Uploads `images` images from each of `composes` composes into
+    `regions` simulated regions, with a pool of up to `util_pool` utility
+    nodes warmed up at the start and up to `util_volumes` images written at
+    once on each, and returns a dict of figures on how it went: jobs run,
+    completed and failed, real and simulated seconds taken, jobs completed
+    per simulated hour, the most threads alive at once, SSH connections set
+    up, and API calls by method. """
+    cloud = FakeCloud(latencies, failure_rates, time_scale, seed)
+    engine = ScaledEngine(time_scale, workers=workers,
+                          name='fedimg-benchmark')
+    peak_threads = [threading.active_count()]
+    finished = threading.Event()
+
+    def sample_threads():
+        while not finished.wait(0.01):
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+
+    sampler = threading.Thread(target=sample_threads,
+                               name='fedimg-benchmark-sampler')
+    sampler.daemon = True
+    sampler.start()
+
+    start = time.time()
+    try:
+        with simulate(cloud, region_names(regions),
+                      util_pool, util_volumes) as messages:
+            fedimg.services.ec2.prewarm_utility_nodes()
+            uploader = fedimg.uploader.Uploader(
+                engine, max_running=max_jobs,
+                max_queued=composes * images)
+            jobs = []
+            for c in range(composes):
+                compose_id = 'Fedora-{0}-20170705.0'.format(c + 1)
+                urls = ['https://sim.example/{0}/Fedora-Cloud-{1}-{2}.'
+                        'x86_64.raw.xz'.format(compose_id, n, c + 1)
+                        for n in range(images)]
+                jobs.extend(uploader.submit(urls,
+                                            {'compose_id': compose_id}))
+            results = [job.result() for job in jobs]
+            elapsed = time.time() - start
+            handshakes = fedimg.util.get_ssh_sessions().handshakes
+    finally:
+        finished.set()
+        sampler.join()
+        engine.shutdown(wait=True)
+
+    simulated = elapsed / time_scale
+    calls = collections.Counter()
+    for (_, method), count in cloud.calls.items():
+        calls[method] += count
+    return {
+        'jobs': len(results),
+        'completed': results.count(0),
+        'failed': len(results) - results.count(0),
+        'seconds': elapsed,
+        'simulated_seconds': simulated,
+        'jobs_per_hour': results.count(0) * 3600.0 / simulated,
+        'peak_threads': peak_threads[0],
+        'ssh_handshakes': handshakes,
+        'api_calls': dict(calls),
+        'messages': dict(messages),
+    }
@@ -22,26 +22,347 @@
 import logging
 log = logging.getLogger("fedmsg")
 
+import heapq
+import itertools
+import threading
+import time
+
+import fedimg.journal
+import fedimg.metrics
+from fedimg.journal import Journal, get_journal
+from fedimg.pipeline import Future
 from fedimg.services.ec2 import EC2Service
-from fedimg.util import virt_types_from_url
+from fedimg.util import parse_compose_id
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+SUPERSEDED = 'superseded'
+
+# Job priorities, most urgent first
+RELEASE = 0  # production composes, such as release candidates
+BRANCHED = 1  # nightlies of a branched release, and manual uploads
+RAWHIDE = 2
+
+
+def compose_priority(compose_id):
+    """ Returns the priority that uploads from the compose `compose_id`
+    are queued with. """
+    parsed = parse_compose_id(compose_id)
+    if parsed is None:
+        return BRANCHED
+    release, kind, _ = parsed
+    if release.lower().endswith('rawhide'):
+        return RAWHIDE
+    if kind == 'production':
+        return RELEASE
+    return BRANCHED
+
+
+class UploadQueueFull(Exception):
+    """ The uploader has too many jobs waiting to take on any more. """
+    pass
+
+
+class UploadSuperseded(Exception):
+    """ A newer compose of the same release and kind came along before the
+    upload ran. """
+    pass
+
+
+def _is_stale(job, latest):
+    """ Whether `job` is from an older compose than the newest of its
+    release and kind in `latest`. """
+    return (job.compose is not None and
+            job.compose[1] < latest.get(job.compose[0], job.compose[1]))
+
+
+class UploadJob(Future):
+    """ A handle on the upload of one image. It is a `Future` for the
+    result of the upload: 0 on success and 1 on failure. If the upload is
+    superseded before it starts, `UploadSuperseded` is raised instead. """
+
+    def __init__(self, service, compose_meta):
+        super(UploadJob, self).__init__()
+        self.service = service
+        self.url = service.raw_url
+        self.compose_meta = compose_meta
+        compose_id = compose_meta.get('compose_id')
+        self.priority = compose_priority(compose_id)
+        # ((release, kind), (date, respin)), for composes that newer ones
+        # replace; a nightly doesn't replace a release candidate
+        parsed = parse_compose_id(compose_id)
+        self.compose = (parsed[:2], parsed[2]) if parsed else None
+        self.state = QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.task = None  # the engine's task, once the job is running
+
+    def __repr__(self):
+        return '<UploadJob {0} {1}>'.format(self.service.build_name,
+                                            self.state)
+
+
+class Uploader(object):
+    """ Runs upload jobs on a `fedimg.pipeline.PipelineEngine`, at most
+    `max_running` at a time. Jobs beyond that wait in a queue of at most
+    `max_queued` jobs, release composes ahead of branched ones and those
+    ahead of rawhide. Submitting never waits for jobs to run; a full queue
+    is refused with `UploadQueueFull` instead.
+
+    Uploads from a compose are superseded by a newer compose of the same
+    release and kind (production, nightly or test): queued ones are
+    dropped, and running ones are cancelled unless they are already
+    publishing their AMIs.
+
+    Each AMI variant of an image from a compose is only uploaded once: a
+    variant that is being or has been uploaded is skipped if the compose is
+    submitted again. This is recorded in the journal, so it holds across
+    restarts; without one, it only holds for the life of the uploader. """
 
+    def __init__(self, engine, max_running=8, max_queued=100):
+        self.engine = engine
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self._lock = threading.Lock()
+        self._queue = []  # heap of (priority, seq, job)
+        self._seq = itertools.count()
+        self._running = set()
+        # (release, kind) -> (date, respin) of its newest compose
+        self._latest = {}
+        self._index = get_journal() or Journal(':memory:')
+        # For stats()
+        self._counts = {'submitted': 0, 'rejected': 0,
+                        'completed': 0, 'failed': 0, 'superseded': 0}
+        self._max_depth = 0
+        self._total_wait = 0.0
+        self._started = 0
 
-def upload(pool, urls, compose_meta):
+    def submit(self, urls, compose_meta, checksums=None):
+        """ Queues an upload job for each of the .raw.xz image files in
+        `urls` with variants still to upload, and returns their `UploadJob`s
+        straight away. `checksums` may map URLs to the files' sha256
+        checksums. If the queue can't take all of the jobs, none of them are
+        queued and `UploadQueueFull` is raised. """
+        checksums = checksums or {}
+        compose_id = compose_meta.get('compose_id')
+        jobs = []
+        for url in urls:
+            # EC2 upload. A single service downloads and snapshots the
+            # image once, then registers every virt_type/vol_type variant
+            # from it.
+            service = EC2Service(url, journal=get_journal(),
+                                 checksum=checksums.get(url))
+            if compose_id is not None:
+                service.variants = self._index.claim(compose_id, url,
+                                                     service.variants)
+                if not service.variants:
+                    log.info("  Skipping %r, already uploaded or in "
+                             "progress" % url)
+                    continue
+            log.info("  Preparing to upload %r" % url)
+            # Queued jobs are journaled too, so that they are resumed
+            # along with running ones after a restart
+            self._index.queue(url, url, compose_meta)
+            jobs.append(UploadJob(service, compose_meta))
+        return self._enqueue(jobs)
+
+    def resume(self):
+        """ Queues every upload job that the journal says was cut short or
+        never got to start, to carry on from its last checkpoint. These
+        jobs are queued even if the queue is full. Returns their
+        `UploadJob`s. """
+        journal = get_journal()
+        if journal is None:
+            return []
+
+        jobs = []
+        for url, compose_meta in journal.unfinished():
+            log.info("  Resuming upload of %r" % url)
+            service = EC2Service(url, journal=journal)
+            compose_id = compose_meta.get('compose_id')
+            if compose_id is not None:
+                service.variants = (journal.claimed(compose_id, url) or
+                                    service.variants)
+            jobs.append(UploadJob(service, compose_meta))
+        return self._enqueue(jobs, force=True)
+
+    def stats(self):
+        """ Returns a dict of figures on the queue: how many jobs are
+        queued and running now, the most that have been queued at once, how
+        many have been submitted, refused, completed, failed or superseded
+        so far, and the average time jobs spent queued, in seconds. """
+        with self._lock:
+            stats = dict(self._counts)
+            stats.update({
+                'queued': len(self._queue),
+                'running': len(self._running),
+                'max_queued': self._max_depth,
+                'average_wait': (self._total_wait / self._started
+                                 if self._started else 0.0),
+            })
+        return stats
+
+    def _enqueue(self, jobs, force=False):
+        with self._lock:
+            latest = self._newest(jobs)
+            jobs_to_queue = [job for job in jobs
+                             if not _is_stale(job, latest)]
+            # Queued jobs that these would supersede make room for them,
+            # and jobs that can start straight away don't need to queue
+            kept = [entry for entry in self._queue
+                    if not _is_stale(entry[2], latest)]
+            free = max(self.max_running - len(self._running), 0)
+            waiting = len(kept) + len(jobs_to_queue) - free
+            full = not force and waiting > self.max_queued
+            if full:
+                # Composes that are turned away supersede nothing
+                stale = set(job for job in jobs
+                            if _is_stale(job, self._latest))
+                for job in stale:
+                    job.state = SUPERSEDED
+                jobs_to_queue = [job for job in jobs if job not in stale]
+                self._counts['rejected'] += len(jobs_to_queue)
+            else:
+                self._latest = latest
+                stale = self._supersede(jobs)
+                for job in jobs_to_queue:
+                    heapq.heappush(self._queue,
+                                   (job.priority, next(self._seq), job))
+                self._counts['submitted'] += len(jobs)
+            self._counts['superseded'] += len(stale)
+            queued = len(self._queue)
+
+        if stale:
+            fedimg.metrics.inc('fedimg_jobs_total', len(stale),
+                               state=SUPERSEDED)
+        for job in stale:
+            self._settle(job, fedimg.journal.FAILED)
+            self._index.unqueue(job.url)
+            job.set_exception(UploadSuperseded(
+                "{0} is superseded by a newer compose".format(
+                    job.compose_meta['compose_id'])))
+        if full:
+            fedimg.metrics.inc('fedimg_jobs_total', len(jobs_to_queue),
+                               state='rejected')
+            for job in jobs_to_queue:
+                self._settle(job, fedimg.journal.FAILED)
+                self._index.unqueue(job.url)
+            raise UploadQueueFull(
+                "{0} jobs queued already; refusing {1} more".format(
+                    queued, len(jobs_to_queue)))
+
+        self._dispatch()
+        log.info('Upload queue: {queued} queued, {running} running'.format(
+            **self.stats()))
+        return jobs
+
+    def _newest(self, jobs):
+        """ Returns the newest compose of each release and kind, counting
+        the composes of `jobs` along with those seen before. Called with
+        the lock held. """
+        latest = dict(self._latest)
+        for job in jobs:
+            if job.compose is not None:
+                series, version = job.compose
+                latest[series] = max(latest.get(series, version), version)
+        return latest
+
+    def _supersede(self, jobs):
+        """ Drops queued jobs from composes older than the newest ones
+        recorded, and cancels running ones. Returns the jobs that are no
+        longer to be run, including any of `jobs` that come from older
+        composes than ones seen before. Called with the lock held, once
+        the composes of `jobs` have been recorded. """
+
+        def is_stale(job):
+            return _is_stale(job, self._latest)
+
+        stale = set(job for job in jobs if is_stale(job))
+        queued = [entry for entry in self._queue if is_stale(entry[2])]
+        if queued:
+            self._queue = [entry for entry in self._queue
+                           if not is_stale(entry[2])]
+            heapq.heapify(self._queue)
+            stale.update(entry[2] for entry in queued)
+        for job in stale:
+            job.state = SUPERSEDED
+
+        for job in self._running:
+            if is_stale(job) and not job.service.cancelled:
+                log.info('Cancelling superseded upload of %r' % job.url)
+                job.service.cancel()
+        return stale
+
+    def _settle(self, job, state):
+        """ Records in the index whether the job's variants are DONE or,
+        having FAILED, are to be uploaded again if asked. """
+        compose_id = job.compose_meta.get('compose_id')
+        if compose_id is not None:
+            self._index.settle(compose_id, job.url, job.service.variants,
+                               state)
+
+    def _dispatch(self):
+        """ Starts queued jobs while there is room for them to run. """
+        starting = []
+        with self._lock:
+            while self._queue and len(self._running) < self.max_running:
+                job = heapq.heappop(self._queue)[2]
+                job.state = RUNNING
+                job.started = time.time()
+                self._total_wait += job.started - job.submitted
+                self._started += 1
+                self._running.add(job)
+                starting.append(job)
+            self._max_depth = max(self._max_depth, len(self._queue))
+            queued, running = len(self._queue), len(self._running)
+        fedimg.metrics.gauge('fedimg_jobs_queued', queued)
+        fedimg.metrics.gauge('fedimg_jobs_running', running)
+
+        for job in starting:
+            fedimg.metrics.observe('fedimg_job_queued_seconds',
+                                   job.started - job.submitted)
+            job.task = self.engine.submit(
+                job.service.pipeline(job.compose_meta),
+                name=job.service.build_name)
+            job.task.add_done_callback(
+                lambda task, job=job: self._finished(job, task))
+
+    def _finished(self, job, task):
+        failed = task.exception() is not None or task.result() != 0
+        if job.service.cancelled and failed:
+            job.state = SUPERSEDED
+        else:
+            job.state = FAILED if failed else COMPLETED
+        with self._lock:
+            self._running.discard(job)
+            self._counts[job.state] += 1
+        fedimg.metrics.inc('fedimg_jobs_total', state=job.state)
+        fedimg.metrics.observe('fedimg_job_seconds',
+                               time.time() - job.started, state=job.state)
+        self._settle(job, fedimg.journal.FAILED if failed
+                     else fedimg.journal.DONE)
+        self._dispatch()
+        if task.exception() is not None:
+            job.set_exception(task.exception())
+        else:
+            job.set_result(task.result())
+
+
+def upload(engine, urls, compose_meta, checksums=None):
     """ Takes a list (urls) of one or more .raw.xz image files and
     sends them off to cloud services for registration. The upload
-    jobs threadpool must be passed as `pool`."""
+    jobs are run by the `fedimg.pipeline.PipelineEngine` passed as
+    `engine`; this blocks until all of them are done and returns their
+    results. `checksums` may map URLs to the files' sha256 checksums,
+    which the downloads are checked against. Long-running callers should
+    use an `Uploader`, which doesn't block. """
 
     log.info('Starting upload process')
 
-    services = []
-
-    for url in urls:
-        # EC2 upload
-        log.info("  Preparing to upload %r" % url)
-        for vt in virt_types_from_url(url):
-            services.append(EC2Service(url, virt_type=vt,
-                                       vol_type='standard'))
-            services.append(EC2Service(url, virt_type=vt,
-                                       vol_type='gp2'))
-
-    results = pool.map(lambda s: s.upload(compose_meta), services)
+    uploader = Uploader(engine, max_running=max(len(urls), 1),
+                        max_queued=len(urls))
+    jobs = uploader.submit(urls, compose_meta, checksums)
+    return [job.result() for job in jobs]
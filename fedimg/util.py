@@ -24,13 +24,14 @@
 Utility functions for fedimg.
 """
 
-import functools
+import contextlib
+import re
 import socket
 import subprocess
+import threading
+import time
 
 import paramiko
-from libcloud.compute.types import Provider
-from libcloud.compute.providers import get_driver
 
 import fedimg
 
@@ -58,6 +59,15 @@ def get_rawxz_urls(location, images):
     return map((lambda path: '{}/{}'.format(location, path)), rawxz_list)
 
 
+def get_rawxz_checksums(location, images):
+    """ Returns the sha256 checksums that the images metadata gives for
+    the .raw.xz files, keyed by the files' URLs. """
+    return dict(('{}/{}'.format(location, f['path']),
+                 f['checksums']['sha256'])
+                for f in images if f['path'].endswith('.raw.xz')
+                and 'sha256' in f.get('checksums', {}))
+
+
 def virt_types_from_url(url):
     """ Takes a URL to a .raw.xz image file) and returns the suspected
         virtualization type that the image file should be registered as. """
@@ -70,28 +80,245 @@ def virt_types_from_url(url):
         return ['hvm', 'paravirtual']
 
 
-def region_to_driver(region):
-    """ Takes a region name (ex. 'eu-west-1') and returns
-    the appropriate libcloud provider value. """
-    cls = get_driver(Provider.EC2)
-    return functools.partial(cls, region=region)
+def port_is_open(ip, port=22, timeout=5):
+    """ Returns True if a TCP connection can be made to `port` on `ip`. This
+    is far cheaper than an SSH handshake, so probe with it first. """
+    try:
+        sock = socket.create_connection((ip, port), timeout)
+    except (socket.error, socket.timeout):
+        return False
+    sock.close()
+    return True
 
 
-def ssh_connection_works(username, ip, keypath):
-    """ Returns True if an SSH connection can me made to `username`@`ip`. """
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    works = False
-    try:
-        ssh.connect(ip, username=username,
-                    key_filename=keypath)
-        works = True
-    except (paramiko.BadHostKeyException,
-            paramiko.AuthenticationException,
-            paramiko.SSHException, socket.error) as e:
+def parse_dd_stats(output):
+    """ Returns the bytes copied, seconds taken and rate in bytes per
+    second from the summary `dd` prints at the end of `output`, or None if
+    there isn't one. """
+    match = None
+    for match in re.finditer(r'(\d+) bytes .*copied, ([\d.,]+) s', output):
         pass
-    ssh.close()
-    return works
+    if match is None:
+        return None
+    copied = int(match.group(1))
+    seconds = float(match.group(2).replace(',', '.'))
+    return {'bytes': copied,
+            'seconds': seconds,
+            'rate': copied / seconds if seconds else 0.0}
+
+
+def parse_decoder(output):
+    """ Returns the name and version of the decompressor the utility
+    instance's write script says it uses in `output`, such as
+    ('xz', (5, 2, 5)), or None if it doesn't say. The version is empty if
+    the decompressor didn't give one. """
+    match = re.search(r'^fedimg decoder: (\w+)\D*([\d.]*)', output, re.M)
+    if match is None:
+        return None
+    name, version = match.groups()
+    return name, tuple(int(n) for n in version.split('.') if n)
+
+
+def parse_compose_id(compose_id):
+    """ Splits a Pungi compose ID such as 'Fedora-26-20170705.n.0' into
+    the release it is a compose of ('Fedora-26'), the kind of compose
+    ('production', 'nightly' or 'test') and a (date, respin) tuple that
+    orders composes of the same release. Returns None if `compose_id`
+    isn't a compose ID. """
+    match = re.match(r'^(.+)-(\d{8})\.(?:([nt])\.)?(\d+)$',
+                     compose_id or '')
+    if match is None:
+        return None
+    release, date, kind, respin = match.groups()
+    kind = {'n': 'nightly', 't': 'test'}.get(kind, 'production')
+    return release, kind, (date, int(respin))
+
+
+class _SSHConnection(object):
+    """ An SSH connection kept by `SSHSessions`. """
+
+    def __init__(self, client):
+        self.client = client
+        self.last_used = time.time()
+        self.in_use = 0  # sessions open on it
+
+    def transport(self):
+        """ Returns the connection's transport, or None if it has died. """
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            return None
+        return transport
+
+
+class SSHSessions(object):
+    """ Keeps one authenticated SSH connection to each host, for every
+    readiness probe, command and file transfer to it to share. Each
+    connection is a single paramiko `Transport`, which carries any number
+    of sessions at once. Since the key exchange is costly, at most
+    `max_handshakes` connections are set up at a time. Connections that go
+    unused for `idle_timeout` seconds are closed. """
+
+    def __init__(self, keypath, max_handshakes=4, idle_timeout=300,
+                 client_factory=None):
+        self.keypath = keypath
+        self.idle_timeout = idle_timeout
+        self.client_factory = client_factory or paramiko.SSHClient
+        self.handshakes = 0  # connections set up so far, for the curious
+        self._handshake_slots = threading.BoundedSemaphore(max_handshakes)
+        self._lock = threading.Lock()
+        self._connections = {}  # (username, ip) -> _SSHConnection
+        # (username, ip) -> [lock held to connect, threads using it]
+        self._connecting = {}
+
+    def transport(self, username, ip):
+        """ Returns the transport of the connection to `username`@`ip`,
+        connecting first if there is none or it has died. This blocks
+        while connecting, so pipeline jobs run it with `run_in_thread`. It
+        raises paramiko's or socket's errors if the connection can't be
+        made. """
+        self._close_idle()
+        key = (username, ip)
+        with self._lock:
+            connecting = self._connecting.get(key)
+            if connecting is None:
+                connecting = self._connecting[key] = [threading.Lock(), 0]
+            connecting[1] += 1
+        try:
+            with connecting[0]:
+                return self._connect(key)
+        finally:
+            # The last thread through forgets the lock, so that hosts long
+            # gone don't pile up
+            with self._lock:
+                connecting[1] -= 1
+                if not connecting[1]:
+                    del self._connecting[key]
+
+    def _connect(self, key):
+        """ Returns the transport of the live connection for `key`, making
+        a new one if need be. Only call this holding the key's lock. """
+        username, ip = key
+        with self._lock:
+            connection = self._connections.get(key)
+        if connection is not None:
+            transport = connection.transport()
+            if transport is not None:
+                connection.last_used = time.time()
+                return transport
+            self._drop(key, connection)
+
+        client = self.client_factory()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        with self._handshake_slots:
+            try:
+                client.connect(ip, username=username,
+                               key_filename=self.keypath, timeout=30)
+            except Exception:
+                client.close()
+                raise
+        self.handshakes += 1
+        transport = client.get_transport()
+        transport.set_keepalive(30)
+        with self._lock:
+            self._connections[key] = _SSHConnection(client)
+        return transport
+
+    def probe(self, username, ip):
+        """ Returns True if an SSH connection can be made to
+        `username`@`ip`. The connection is kept for what comes next. """
+        try:
+            self.transport(username, ip)
+        except (paramiko.SSHException, socket.error, EOFError):
+            return False
+        return True
+
+    @contextlib.contextmanager
+    def session(self, username, ip):
+        """ Opens a session on the connection to `username`@`ip` for the
+        duration of a `with` block, yielding its channel. """
+        with self._using(username, ip) as transport:
+            channel = transport.open_session()
+            try:
+                yield channel
+            finally:
+                channel.close()
+
+    @contextlib.contextmanager
+    def sftp(self, username, ip):
+        """ Opens an SFTP session on the connection to `username`@`ip` for
+        the duration of a `with` block, yielding its client. """
+        with self._using(username, ip) as transport:
+            sftp = transport.open_sftp_client()
+            try:
+                yield sftp
+            finally:
+                sftp.close()
+
+    def close(self, ip):
+        """ Closes every connection to `ip`, such as once the node is
+        going away. """
+        with self._lock:
+            doomed = [(key, connection) for key, connection
+                      in self._connections.items() if key[1] == ip]
+        for key, connection in doomed:
+            self._drop(key, connection)
+
+    def close_all(self):
+        """ Closes every connection. """
+        with self._lock:
+            ips = set(ip for _, ip in self._connections)
+        for ip in ips:
+            self.close(ip)
+
+    @contextlib.contextmanager
+    def _using(self, username, ip):
+        """ Yields the transport to `username`@`ip`, keeping it from being
+        closed as idle until the `with` block ends. """
+        key = (username, ip)
+        transport = self.transport(username, ip)
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is not None:
+                connection.in_use += 1
+        try:
+            yield transport
+        finally:
+            if connection is not None:
+                with self._lock:
+                    connection.in_use -= 1
+                    connection.last_used = time.time()
+
+    def _drop(self, key, connection):
+        with self._lock:
+            if self._connections.get(key) is connection:
+                del self._connections[key]
+        connection.client.close()
+
+    def _close_idle(self):
+        cutoff = time.time() - self.idle_timeout
+        with self._lock:
+            idle = [(key, connection) for key, connection
+                    in self._connections.items()
+                    if not connection.in_use and
+                    connection.last_used < cutoff]
+        for key, connection in idle:
+            self._drop(key, connection)
+
+
+_ssh_sessions = None
+_ssh_sessions_lock = threading.Lock()
+
+
+def get_ssh_sessions():
+    """ Returns the process-wide `SSHSessions`, which connects with the
+    AWS keypair. """
+    global _ssh_sessions
+    with _ssh_sessions_lock:
+        if _ssh_sessions is None:
+            _ssh_sessions = SSHSessions(fedimg.AWS_KEYPATH,
+                                        fedimg.SSH_MAX_HANDSHAKES,
+                                        fedimg.SSH_IDLE_TIMEOUT)
+        return _ssh_sessions
 
 
 def safeget(dct, *keys):
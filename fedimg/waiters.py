@@ -0,0 +1,287 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+"""
+Waiting on EC2 resources to reach a state.
+
+A single `RegionWaiter` per region polls on behalf of every job in the
+process. All resource IDs of one kind that are due for a poll go into a
+single Describe call filtered by ID, rather than each job listing every
+snapshot or volume in the account. Each wait backs off exponentially, with
+jitter, from the moment it was registered, and fails once it has gone on for
+longer than `wait_timeout`.
+
+Describe calls that take a list of IDs fail as a whole if EC2 doesn't know
+one of them, which it doesn't for a while after a resource is created, nor
+a while after it is deleted. So resources are looked up with filters, which
+just leave unknown IDs out.
+"""
+
+import logging
+log = logging.getLogger("fedmsg")
+
+import random
+import re
+import threading
+import time
+
+from libcloud.compute.drivers.ec2 import NAMESPACE
+from libcloud.utils.xml import findall, findtext
+
+import fedimg
+import fedimg.metrics
+from fedimg.drivers import ec2_driver
+from fedimg.pipeline import Future
+
+# Most IDs sent in one Describe call
+BATCH_SIZE = 100
+
+
+class WaiterException(Exception):
+    """ A resource ended up in a state it will never leave. """
+    pass
+
+
+def _describe_nodes(driver, ids):
+    return [(n.id, n.extra.get('status'), n)
+            for n in driver.list_nodes(ex_filters={'instance-id': ids})]
+
+
+def _describe_volumes(driver, ids):
+    return [(v.id, v.extra.get('state'), v)
+            for v in driver.list_volumes(ex_filters={'volume-id': ids})]
+
+
+def _describe_snapshots(driver, ids):
+    # libcloud's list_snapshots() only filters by a single snapshot
+    params = {'Action': 'DescribeSnapshots'}
+    params.update(driver._build_filters({'snapshot-id': ids}))
+    response = driver.connection.request(driver.path, params=params).object
+    return [(s.id, s.extra.get('state'), s)
+            for s in driver._to_snapshots(response)]
+
+
+def _describe_statuses(driver, ids):
+    # Rolls the instance state and both status checks into one state: 'ok'
+    # once the instance is running and passes both checks, 'impaired' if it
+    # fails either, and otherwise 'initializing' or the instance state.
+    # DescribeInstanceStatus can't filter by instance ID, so the instances
+    # its error names as unknown are left out, and the call made again.
+    ids = list(ids)
+    while ids:
+        params = {'Action': 'DescribeInstanceStatus',
+                  'IncludeAllInstances': 'true'}
+        params.update(driver._pathlist('InstanceId', ids))
+        try:
+            response = driver.connection.request(driver.path,
+                                                 params=params).object
+        except Exception as e:
+            unknown = set(_INSTANCE_ID.findall(str(e)))
+            if 'NotFound' not in str(e) or not unknown & set(ids):
+                raise
+            ids = [i for i in ids if i not in unknown]
+        else:
+            return _to_statuses(response)
+    return []
+
+
+_INSTANCE_ID = re.compile(r'i-[0-9a-zA-Z]+')
+
+
+def _to_statuses(response):
+    statuses = []
+    for item in findall(response, 'instanceStatusSet/item', NAMESPACE):
+        state = findtext(item, 'instanceState/name', NAMESPACE)
+        checks = (findtext(item, 'systemStatus/status', NAMESPACE),
+                  findtext(item, 'instanceStatus/status', NAMESPACE))
+        if state == 'running':
+            if 'impaired' in checks:
+                state = 'impaired'
+            elif checks == ('ok', 'ok'):
+                state = 'ok'
+            else:
+                state = 'initializing'
+        statuses.append((findtext(item, 'instanceId', NAMESPACE), state,
+                         None))
+    return statuses
+
+
+def _describe_images(driver, ids):
+    return [(i.id, i.extra.get('state'), i)
+            for i in driver.list_images(ex_filters={'image-id': ids})]
+
+
+# Resource kind -> (describe function, states that can never change)
+KINDS = {
+    'node': (_describe_nodes, ('terminated',)),
+    'status': (_describe_statuses, ('terminated', 'impaired')),
+    'volume': (_describe_volumes, ('error',)),
+    'snapshot': (_describe_snapshots, ('error',)),
+    'image': (_describe_images, ('failed', 'deregistered')),
+}
+
+
+class _Wait(object):
+    """ One pending wait for a resource to reach one of `states`. """
+
+    __slots__ = ('kind', 'resource_id', 'states', 'future', 'attempts',
+                 'due', 'started', 'deadline')
+
+    def __init__(self, kind, resource_id, states, due, timeout):
+        self.kind = kind
+        self.resource_id = resource_id
+        self.states = states
+        self.future = Future()
+        self.attempts = 0
+        self.due = due
+        self.started = time.time()
+        self.deadline = self.started + timeout
+
+
+class RegionWaiter(object):
+    """ Polls all the resources that jobs are waiting on in one region,
+    from one background thread. """
+
+    def __init__(self, region, base_delay=2, max_delay=60, timeout=None):
+        self.region = region
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        if timeout is None:
+            timeout = fedimg.AWS_WAIT_TIMEOUT
+        self.timeout = timeout
+        self.polls = 0  # Describe calls made, for the curious
+        self._driver = ec2_driver(region)
+        self._cond = threading.Condition()
+        self._waits = []
+        self._thread = None
+
+    def wait_for(self, kind, resource_id, states):
+        """ Returns a future for the resource `resource_id` of the given
+        kind ('node', 'status', 'volume', 'snapshot' or 'image') that is
+        done, with the refreshed libcloud object, once its state is one of
+        `states`. Waits on a node's 'status' hand back None. The future
+        fails with a `WaiterException` if the resource doesn't get there
+        within the waiter's timeout. """
+        wait = _Wait(kind, resource_id, tuple(states),
+                     time.time() + self._backoff(0), self.timeout)
+        with self._cond:
+            self._waits.append(wait)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._poll_forever,
+                    name='fedimg-waiter-{0}'.format(self.region))
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return wait.future
+
+    def _backoff(self, attempts):
+        """ Exponential backoff with 'equal jitter'. """
+        delay = min(self.max_delay, self.base_delay * 2 ** attempts)
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def _poll_forever(self):
+        while True:
+            with self._cond:
+                while True:
+                    # Also take waits that are due shortly, so that they
+                    # share this Describe call rather than needing their own
+                    now = time.time()
+                    due = [w for w in self._waits
+                           if w.due <= now + self.base_delay]
+                    if due:
+                        break
+                    timeout = None
+                    if self._waits:
+                        timeout = (min(w.due for w in self._waits) - now -
+                                   self.base_delay)
+                    self._cond.wait(timeout)
+            try:
+                self._poll(due)
+            except Exception:
+                log.exception('Polling {0} failed'.format(self.region))
+                for wait in due:
+                    if not wait.future.done():
+                        self._reschedule(wait)
+
+    def _poll(self, due):
+        for kind, (describe, final_states) in KINDS.items():
+            waits = [w for w in due if w.kind == kind]
+            for i in range(0, len(waits), BATCH_SIZE):
+                batch = waits[i:i + BATCH_SIZE]
+                ids = list(set(w.resource_id for w in batch))
+                self.polls += 1
+                fedimg.metrics.inc('fedimg_waiter_polls_total',
+                                   region=self.region, kind=kind)
+                results = self._driver.limited_call(
+                    'describe_' + kind,
+                    lambda driver: describe(driver, ids))
+                found = dict((rid, (state, obj))
+                             for rid, state, obj in results)
+
+                for wait in batch:
+                    state, obj = found.get(wait.resource_id, (None, None))
+                    if state in wait.states:
+                        self._finish(wait, obj)
+                    elif state in final_states:
+                        self._finish(wait, None, WaiterException(
+                            "{0} {1} is {2}".format(kind, wait.resource_id,
+                                                    state)))
+                    else:
+                        # Not there yet, or not visible yet (EC2 is only
+                        # eventually consistent about new resources)
+                        self._reschedule(wait)
+
+    def _reschedule(self, wait):
+        if time.time() >= wait.deadline:
+            self._finish(wait, None, WaiterException(
+                "{0} {1} did not become {2} within {3}s".format(
+                    wait.kind, wait.resource_id, '/'.join(wait.states),
+                    self.timeout)))
+            return
+        with self._cond:
+            wait.attempts += 1
+            wait.due = time.time() + self._backoff(wait.attempts)
+
+    def _finish(self, wait, obj, exception=None):
+        with self._cond:
+            if wait not in self._waits:
+                return  # finished already
+            self._waits.remove(wait)
+        fedimg.metrics.observe('fedimg_wait_seconds',
+                               time.time() - wait.started,
+                               region=self.region, kind=wait.kind)
+        if exception is not None:
+            wait.future.set_exception(exception)
+        else:
+            wait.future.set_result(obj)
+
+
+_waiters = {}
+_waiters_lock = threading.Lock()
+
+
+def get_waiter(region):
+    """ Returns the process-wide waiter for `region`. """
+    with _waiters_lock:
+        if region not in _waiters:
+            _waiters[region] = RegionWaiter(region)
+        return _waiters[region]
@@ -22,9 +22,9 @@
 import socket
 hostname = socket.gethostname()
 
-NUM_BASE_THREADS = 4
-NUM_ATOMIC_THREADS = 2
-NUM_PORTS = 2 * ((NUM_BASE_THREADS + NUM_ATOMIC_THREADS) + 1)
+# Fedimg publishes from a single thread; the second endpoint leaves room for
+# a manual trigger_upload.py run alongside the consumer.
+NUM_PORTS = 2
 
 config = dict(
     fedimgconsumer=True,
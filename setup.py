@@ -39,7 +39,8 @@ setup(
     zip_safe=False,
     install_requires=["fedmsg",
                       "apache-libcloud",
-                      "paramiko"],
+                      "paramiko",
+                      "requests"],
     tests_require=['nose',
                    'mock'],
     packages=find_packages(),
@@ -0,0 +1,120 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import BaseHTTPServer
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import fedimg.cache
+
+
+class FileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves the server's `files` dict, counting requests. """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests += 1
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestImageCache(unittest.TestCase):
+    """ This tests fedimg/cache.py. """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                FileHandler)
+        self.server.files = {}
+        self.server.requests = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.cache = fedimg.cache.ImageCache(self.tmpdir, 2500)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def _serve(self, name, body):
+        """ Serves `body` as `name`, returning its URL and sha256. """
+        self.server.files['/' + name] = body
+        url = 'http://127.0.0.1:{0}/{1}'.format(self.server.server_port,
+                                                 name)
+        return url, hashlib.sha256(body).hexdigest()
+
+    def _read(self, url, sha256=None):
+        with self.cache.open(url, sha256) as image:
+            return image.read()
+
+    def test_downloads_once(self):
+        url, sha256 = self._serve('a.raw.xz', 'a' * 1000)
+        self.assertEqual(self._read(url, sha256), 'a' * 1000)
+        self.assertEqual(self._read(url, sha256), 'a' * 1000)
+        self.assertEqual(self.server.requests, 1)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tmpdir, sha256 + '.raw.xz')))
+
+    def test_found_by_url_without_checksum(self):
+        url, sha256 = self._serve('a.raw.xz', 'a' * 1000)
+        self.assertEqual(self._read(url), 'a' * 1000)
+        self.assertEqual(self._read(url), 'a' * 1000)
+        # and by checksum, once it's known
+        self.assertEqual(self._read(url, sha256), 'a' * 1000)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_checksum_mismatch(self):
+        url, _ = self._serve('a.raw.xz', 'a' * 1000)
+        self.assertRaises(fedimg.cache.ImageCacheException,
+                          self._read, url, 'f' * 64)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_evicts_least_recently_used(self):
+        a, a_sum = self._serve('a.raw.xz', 'a' * 1000)
+        b, b_sum = self._serve('b.raw.xz', 'b' * 1000)
+        c, c_sum = self._serve('c.raw.xz', 'c' * 1000)
+        self._read(a, a_sum)
+        self._read(b, b_sum)
+        # make a the older of the two, then use it again
+        os.utime(os.path.join(self.tmpdir, a_sum + '.raw.xz'), (1, 1))
+        os.utime(os.path.join(self.tmpdir, b_sum + '.raw.xz'), (2, 2))
+        self._read(a, a_sum)
+        self._read(c, c_sum)
+
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         sorted([a_sum + '.raw.xz', c_sum + '.raw.xz']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import unittest
+
+import fedimg.catalog
+
+AMIS = """
+us-east-1|x86_64|ami-a1|aki-a1
+us-east-1|i386|ami-a2|aki-a2
+us-west-1|Fedora|21|x86_64|ami-b1|aki-b1
+not an AMI line
+"""
+
+
+class TestAMICatalog(unittest.TestCase):
+    """ This tests fedimg/catalog.py. """
+
+    def setUp(self):
+        self.catalog = fedimg.catalog.AMICatalog.parse(AMIS)
+
+    def tearDown(self):
+        pass
+
+    def test_parse_both_formats(self):
+        entries = self.catalog.entries
+        self.assertEqual([e.ami for e in entries],
+                         ['ami-a1', 'ami-a2', 'ami-b1'])
+        self.assertEqual(entries[2].os, 'Fedora')
+        self.assertEqual(entries[2].ver, '21')
+        self.assertEqual(entries[0].os, None)
+
+    def test_indexes(self):
+        self.assertEqual([e.region for e in self.catalog.utility_amis()],
+                         ['us-east-1', 'us-west-1'])
+        self.assertEqual([e.ami for e in self.catalog.test_amis('i386')],
+                         ['ami-a2'])
+        self.assertEqual(self.catalog.test_amis('armhfp'), ())
+        self.assertEqual(self.catalog.aki('us-west-1', 'x86_64'), 'aki-b1')
+        self.assertEqual(self.catalog.get('us-west-1', 'i386'), None)
+
+    def test_entries_are_immutable(self):
+        entry = self.catalog.entries[0]
+        self.assertRaises(AttributeError, setattr, entry, 'ami', 'ami-x')
+        self.assertRaises(AttributeError, setattr, entry, 'foo', 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import fedimg.checks
+from fedimg.checks import Check, CheckOutput
+
+
+def run_suite(checks):
+    """ Runs `checks` here, handing back the exit status and output. """
+    proc = subprocess.Popen(fedimg.checks.suite_command(checks), shell=True,
+                            stdout=subprocess.PIPE, preexec_fn=os.setsid)
+    output = proc.communicate()[0]
+    return proc.returncode, output
+
+
+class TestChecks(unittest.TestCase):
+    """ This tests fedimg/checks.py. """
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_parse_checks(self):
+        checks = fedimg.checks.parse_checks("""
+            cloud-init|hard|cloud-init status --wait
+            selinux|soft|getenforce | grep -q Enforcing
+            """, '/bin/true')
+        self.assertEqual([(c.name, c.hard, c.command) for c in checks],
+                         [('cloud-init', True, 'cloud-init status --wait'),
+                          ('selinux', False,
+                           'getenforce | grep -q Enforcing')])
+
+        # The `test` option is the check when none are given
+        checks = fedimg.checks.parse_checks('', '/bin/true')
+        self.assertEqual([(c.name, c.hard, c.command) for c in checks],
+                         [('test', True, '/bin/true')])
+
+        for text in ('network|curl x', 'a b|hard|true', 'a|hard|true\n'
+                     'a|soft|false'):
+            with self.assertRaises(fedimg.checks.CheckException):
+                fedimg.checks.parse_checks(text)
+
+    def test_suite_runs_checks_at_once(self):
+        # `one` only finishes once `two` has started
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        flag = os.path.join(tmpdir, 'two')
+        checks = [Check('one', 'until [ -e {0} ]; do sleep 0.1; done; '
+                               'echo "it\'s done"'.format(flag)),
+                  Check('two', 'touch {0}; echo done'.format(flag)),
+                  Check('soft', 'echo oops; exit 2', hard=False)]
+        status, output = run_suite(checks)
+
+        self.assertEqual(status, 0)
+        self.assertIn("one: it's done\n", output)
+        self.assertIn('two: done\n', output)
+        self.assertIn('soft: oops\n', output)
+
+        result = CheckOutput('hvm', checks)
+        for n in range(0, len(output), 7):
+            result.feed(output[n:n + 7])
+        result.close()
+        self.assertEqual(dict((name, status) for name, (status, _)
+                              in result.results.items()),
+                         {'one': 0, 'two': 0, 'soft': 2})
+        self.assertRegexpMatches(result.summary(),
+                                 r'soft: failed \(exit status 2\) in \d+s')
+
+    def test_hard_failure_aborts_the_rest(self):
+        checks = [Check('slow', 'sleep 30'),
+                  Check('broken', 'exit 3')]
+        status, output = run_suite(checks)
+
+        self.assertNotEqual(status, 0)
+
+        result = CheckOutput('hvm', checks)
+        result.feed(output)
+        result.close()
+        self.assertRegexpMatches(result.summary(),
+                                 r'^slow: aborted\n'
+                                 r'broken: failed \(exit status 3\) in \d+s$')
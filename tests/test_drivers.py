@@ -0,0 +1,109 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import mock
+import unittest
+
+import fedimg.drivers
+
+
+class TestDriverPool(unittest.TestCase):
+    """ This tests fedimg/drivers.py. """
+
+    def setUp(self):
+        self.pool = fedimg.drivers.DriverPool(max_idle=2, idle_timeout=60)
+
+    def tearDown(self):
+        pass
+
+    @mock.patch('fedimg.drivers.get_driver')
+    def test_reuses_drivers_per_key(self, get_driver):
+        get_driver.return_value.side_effect = lambda *a, **kw: mock.Mock()
+        driver = fedimg.drivers.PooledDriver(self.pool, 'ec2', 'us-east-1',
+                                             'id', 'secret')
+        other = fedimg.drivers.PooledDriver(self.pool, 'ec2', 'eu-west-1',
+                                            'id', 'secret')
+
+        for i in range(3):
+            driver.list_sizes()
+        other.list_sizes()
+
+        self.assertEqual(self.pool.created, 2)
+        get_driver.return_value.assert_any_call('id', 'secret',
+                                                region='eu-west-1')
+
+    @mock.patch('fedimg.drivers.get_driver')
+    def test_driver_classes_are_pooled(self, get_driver):
+        class StandInDriver(object):
+            def __init__(self, key, secret, region, endpoint=None):
+                self.endpoint = endpoint
+
+            def start_snapshot(self):
+                return self.endpoint
+
+        driver = fedimg.drivers.PooledDriver(self.pool, StandInDriver,
+                                             'us-east-1', 'id', 'secret',
+                                             endpoint='http://localhost')
+
+        self.assertEqual(driver.start_snapshot(), 'http://localhost')
+        self.assertFalse(get_driver.called)
+
+    @mock.patch('fedimg.drivers.get_driver')
+    def test_leases_are_exclusive(self, get_driver):
+        get_driver.return_value.side_effect = lambda *a, **kw: mock.Mock()
+
+        with self.pool.lease('ec2', 'us-east-1', 'id', 'secret') as one:
+            with self.pool.lease('ec2', 'us-east-1', 'id', 'secret') as two:
+                self.assertNotEqual(one, two)
+        with self.pool.lease('ec2', 'us-east-1', 'id', 'secret') as three:
+            self.assertTrue(three in (one, two))
+
+    @mock.patch('fedimg.drivers.time')
+    @mock.patch('fedimg.drivers.get_driver')
+    def test_idle_drivers_are_evicted(self, get_driver, time):
+        get_driver.return_value.side_effect = lambda *a, **kw: mock.Mock()
+        time.time.return_value = 1000
+
+        with self.pool.lease('ec2', 'us-east-1', 'id', 'secret'):
+            pass
+        time.time.return_value = 1061
+        with self.pool.lease('ec2', 'us-east-1', 'id', 'secret'):
+            pass
+
+        self.assertEqual(self.pool.created, 2)
+
+    @mock.patch('fedimg.ratelimit.limiter')
+    @mock.patch('fedimg.drivers.get_driver')
+    def test_calls_are_rate_limited(self, get_driver, limiter):
+        limiter.call.side_effect = lambda account, region, method, fn: fn()
+        driver = fedimg.drivers.PooledDriver(self.pool, 'ec2', 'us-east-1',
+                                             'id', 'secret')
+
+        driver.list_images(ex_image_ids=['ami-1'])
+
+        limiter.call.assert_called_once_with('id', 'us-east-1',
+                                             'list_images', mock.ANY)
+        get_driver.return_value.return_value.list_images \
+            .assert_called_once_with(ex_image_ids=['ami-1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
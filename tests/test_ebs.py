@@ -0,0 +1,185 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import base64
+import BaseHTTPServer
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+
+import mock
+
+import fedimg.ebs
+
+BLOCK_SIZE = 4096
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Just enough of the EBS direct APIs for one snapshot. """
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_POST(self):
+        server = self.server
+        assert self.headers['Authorization'].startswith('AWS4-HMAC-SHA256')
+        body = self._body()
+        if self.path == '/snapshots':
+            server.starts.append(json.loads(body))
+            if len(server.starts) <= server.failed_starts:
+                self._reply(500, {'Message': 'Internal error'})
+                return
+            self._reply(201, {'SnapshotId': 'snap-1', 'BlockSize': BLOCK_SIZE,
+                              'Status': 'pending'})
+        else:
+            server.completion = dict(self.headers)
+            self._reply(202, {'Status': 'completed'})
+
+    def do_PUT(self):
+        index = int(self.path.split('/')[-1])
+        data = self._body()
+        checksum = base64.b64encode(hashlib.sha256(data).digest())
+        if index in self.server.bad_blocks:
+            self._reply(400, {'Message': 'Bad block'})
+            return
+        if self.headers['x-amz-checksum'] != checksum:
+            self._reply(400, {'Message': 'Bad checksum'})
+            return
+        with self.server.lock:
+            self.server.blocks[index] = data
+        self._reply(201, {'Checksum': checksum})
+
+
+class TestSnapshotUploader(unittest.TestCase):
+    """ This tests fedimg/ebs.py against a local stand-in endpoint. """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                StandInHandler)
+        self.server.blocks = {}
+        self.server.lock = threading.Lock()
+        self.server.starts = []
+        self.server.failed_starts = 0
+        self.server.bad_blocks = set()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.endpoint = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        patcher = mock.patch('fedimg.ebs.ec2_driver')
+        self.ec2_driver = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def _image(self, blocks):
+        """ Writes `blocks` as a .raw.xz file and returns its URL. """
+        path = os.path.join(self.tmpdir, 'image.raw')
+        with open(path, 'wb') as f:
+            f.write(''.join(blocks))
+        subprocess.check_call(['xz', path])
+        return 'file://' + path + '.xz'
+
+    def test_upload_skips_zero_blocks(self):
+        zeros = '\0' * BLOCK_SIZE
+        blocks = [os.urandom(BLOCK_SIZE), zeros, os.urandom(BLOCK_SIZE),
+                  zeros, 'tail']
+        uploader = fedimg.ebs.SnapshotUploader('us-east-1', workers=3,
+                                               endpoint=self.endpoint)
+
+        snapshot_id = uploader.upload(self._image(blocks), 1, 'test')
+
+        self.assertEqual(snapshot_id, 'snap-1')
+        written = self.server.blocks
+        self.assertEqual(sorted(written), [0, 2, 4])
+        self.assertEqual(written[0], blocks[0])
+        self.assertEqual(written[4], 'tail'.ljust(BLOCK_SIZE, '\0'))
+
+        digests = ''.join(hashlib.sha256(written[i]).digest()
+                          for i in sorted(written))
+        completion = self.server.completion
+        self.assertEqual(completion['x-amz-changedblockscount'], '3')
+        self.assertEqual(completion['x-amz-checksum'],
+                         base64.b64encode(hashlib.sha256(digests).digest()))
+
+    def test_download_failure_raises(self):
+        uploader = fedimg.ebs.SnapshotUploader('us-east-1', workers=2,
+                                               endpoint=self.endpoint)
+        url = 'file://' + os.path.join(self.tmpdir, 'missing.raw.xz')
+        self.assertRaises(fedimg.ebs.EBSUploadException,
+                          uploader.upload, url, 1, 'test')
+
+        # the snapshot that was started is deleted
+        snapshot = self.ec2_driver.return_value.destroy_volume_snapshot \
+            .call_args[0][0]
+        self.assertEqual(snapshot.id, 'snap-1')
+
+    def test_retried_start_is_idempotent(self):
+        self.server.failed_starts = 1
+        uploader = fedimg.ebs.SnapshotUploader('us-east-1', workers=1,
+                                               endpoint=self.endpoint)
+
+        uploader.upload(self._image(['data']), 1, 'test')
+
+        tokens = [start['ClientToken'] for start in self.server.starts]
+        self.assertEqual(len(tokens), 2)
+        self.assertEqual(tokens[0], tokens[1])
+        self.assertFalse(
+            self.ec2_driver.return_value.destroy_volume_snapshot.called)
+
+    @mock.patch('fedimg.ebs.ATTEMPTS', 1)
+    def test_failed_block_deletes_snapshot(self):
+        self.server.bad_blocks.add(1)
+        uploader = fedimg.ebs.SnapshotUploader('us-east-1', workers=2,
+                                               endpoint=self.endpoint)
+        blocks = [os.urandom(BLOCK_SIZE) for i in range(3)]
+
+        self.assertRaises(Exception, uploader.upload, self._image(blocks),
+                          1, 'test')
+
+        self.assertFalse(hasattr(self.server, 'completion'))
+        snapshot = self.ec2_driver.return_value.destroy_volume_snapshot \
+            .call_args[0][0]
+        self.assertEqual(snapshot.id, 'snap-1')
+        self.ec2_driver.assert_called_with('us-east-1')
+
+
+if __name__ == '__main__':
+    unittest.main()
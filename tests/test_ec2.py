@@ -0,0 +1,609 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import mock
+import time
+import unittest
+
+from libcloud.compute.base import NodeImage
+
+import fedimg.pipeline
+import fedimg.services.ec2
+from fedimg.services.ec2 import EC2Service
+from fedimg.waiters import WaiterException
+
+BASE_URL = 'https://somepage.org/fedora-cloud-base-20140915-21.x86_64.raw.xz'
+ATOMIC_URL = ('https://somepage.org/'
+              'fedora-cloud-atomic-20140915-21.x86_64.raw.xz')
+
+
+def mock_driver():
+    """ Returns a mock pooled driver, whose jobs call its mock methods. """
+    def job(method, *args, **kwargs):
+        raise fedimg.pipeline.Return(
+            getattr(driver, method)(*args, **kwargs))
+        yield
+
+    driver = mock.Mock()
+    driver.job.side_effect = job
+    return driver
+
+
+def done(result):
+    """ Returns a future that is already done, with `result`. """
+    future = fedimg.pipeline.Future()
+    future.set_result(result)
+    return future
+
+
+def eventually(check):
+    """ Waits a little for `check()` to come true, and returns it. """
+    for i in range(100):
+        if check():
+            break
+        time.sleep(0.01)
+    return check()
+
+
+class TestEC2Service(unittest.TestCase):
+    """ This tests fedimg/services/ec2.py. """
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_variants(self):
+        service = EC2Service(BASE_URL)
+        self.assertEqual(service.variants, [('hvm', 'standard'),
+                                            ('hvm', 'gp2'),
+                                            ('paravirtual', 'standard'),
+                                            ('paravirtual', 'gp2')])
+
+        service = EC2Service(ATOMIC_URL)
+        self.assertEqual(service.variants, [('hvm', 'standard'),
+                                            ('hvm', 'gp2')])
+
+    @mock.patch('fedimg.services.ec2.get_cache')
+    @mock.patch('fedimg.services.ec2.SnapshotUploader')
+    @mock.patch('fedimg.services.ec2.get_waiter')
+    def test_direct_ingestion(self, get_waiter, SnapshotUploader,
+                              get_cache):
+        service = EC2Service(BASE_URL, ingestion='direct')
+        self.assertEqual(service.build_stages, ('upload', 'register', 'test'))
+
+        SnapshotUploader.return_value.upload.return_value = 'snap-1'
+        snapshot = fedimg.pipeline.Future()
+        snapshot.set_result(mock.Mock(id='snap-1'))
+        get_waiter.return_value.wait_for.return_value = snapshot
+        service.region = 'us-east-1'
+
+        fedimg.pipeline.run_sync(service._upload({}))
+
+        self.assertEqual(service.snapshot.id, 'snap-1')
+        image = get_cache.return_value.open.return_value
+        get_cache.return_value.open.assert_called_with(BASE_URL, None)
+        self.assertEqual(SnapshotUploader.return_value.upload.call_args[0][0],
+                         image)
+        image.close.assert_called_with()
+        get_waiter.return_value.wait_for.assert_called_with(
+            'snapshot', 'snap-1', ['completed'])
+
+    def test_register_from_shared_snapshot(self):
+        service = EC2Service(BASE_URL)
+        service.snapshot = mock.Mock(id='snap-1234')
+        service.region = service.util_amis[0].region
+
+        driver = service.driver = mock_driver()
+        driver.ex_register_image.side_effect = [
+            NodeImage(id='ami-%i' % i, name=None, driver=driver)
+            for i in range(len(service.variants))]
+
+        with mock.patch('fedimg.messenger.message'):
+            fedimg.pipeline.run_sync(service._register({}))
+
+        self.assertEqual(len(service.images), 4)
+        snapshots = set(
+            c[1]['block_device_mapping'][0]['Ebs']['SnapshotId']
+            for c in driver.ex_register_image.call_args_list)
+        self.assertEqual(snapshots, set(['snap-1234']))
+        self.assertEqual(service._variant_extra(service.images[3]),
+                         {'id': 'ami-3',
+                          'virt_type': 'paravirtual',
+                          'vol_type': 'gp2'})
+
+    @mock.patch('fedimg.services.ec2.ec2_driver')
+    @mock.patch('fedimg.services.ec2.get_waiter')
+    @mock.patch('fedimg.messenger.message')
+    def test_copy_fans_out_to_every_region(self, message, get_waiter,
+                                           ec2_driver):
+        available = fedimg.pipeline.Future()
+        available.set_result(None)
+        get_waiter.return_value.wait_for.return_value = available
+        service = EC2Service(BASE_URL)
+        driver = ec2_driver.return_value = mock_driver()
+        driver.copy_image.side_effect = lambda image, region, **kw: \
+            NodeImage(id=kw['name'], name=kw['name'], driver=driver)
+        image = NodeImage(id='ami-1', name=None, driver=driver)
+        service.images = [image]
+        service.image_variants = {'ami-1': ('hvm', 'gp2')}
+
+        fedimg.pipeline.run_sync(service._copy({}))
+
+        regions = [a.region for a in service.test_amis[1:]]
+        self.assertEqual(service.region_status,
+                         dict((r, 'completed') for r in regions))
+        self.assertEqual(len(service.copied_images), len(regions))
+
+    @mock.patch('fedimg.services.ec2.ec2_driver')
+    @mock.patch('fedimg.services.ec2.get_waiter')
+    @mock.patch('fedimg.messenger.message')
+    def test_copy_failure_is_per_region(self, message, get_waiter,
+                                        ec2_driver):
+        def wait_for(kind, resource_id, states):
+            future = fedimg.pipeline.Future()
+            if resource_id.startswith('ami-c'):
+                future.set_exception(WaiterException(
+                    'image {0} is failed'.format(resource_id)))
+            else:
+                future.set_result(None)
+            return future
+
+        get_waiter.return_value.wait_for.side_effect = wait_for
+        service = EC2Service(BASE_URL)
+        regions = [a.region for a in service.test_amis[1:]]
+        drivers = dict((region, mock_driver()) for region in regions)
+        ec2_driver.side_effect = lambda region: drivers[region]
+        for region, driver in drivers.items():
+            # the copy into the first region never becomes available
+            copy_id = 'ami-c' if region == regions[0] else 'ami-ok'
+            driver.copy_image.return_value = NodeImage(
+                id=copy_id, name=None, driver=driver)
+        image = NodeImage(id='ami-1', name=None, driver=mock_driver())
+        service.images = [image]
+        service.image_variants = {'ami-1': ('hvm', 'gp2')}
+
+        fedimg.pipeline.run_sync(service._copy({}))
+
+        self.assertEqual(service.region_status[regions[0]], 'failed')
+        self.assertEqual(set(service.region_status[r] for r in regions[1:]),
+                         set(['completed']))
+        self.assertFalse(
+            drivers[regions[0]].ex_modify_image_attribute.called)
+        failed = [c[0][2] for c in message.call_args_list
+                  if c[0][3] == 'failed']
+        self.assertEqual(failed, ['EC2 ({0})'.format(regions[0])])
+
+    def test_restore_from_journal(self):
+        outputs = {'util_node': 'i-1', 'util_volume': 'vol-1',
+                   'snapshot': None, 'images': [], 'test_nodes': [],
+                   'test_success': False, 'copies': [],
+                   'region_status': {}, 'dup_count': 0}
+        journal = mock.Mock()
+        journal.checkpoints.return_value = [
+            ('deploy', True, outputs), ('ssh_ready', True, outputs),
+            ('write', True, outputs)]
+        service = EC2Service(BASE_URL, journal=journal)
+        driver = service.driver = mock_driver()
+        node = mock.Mock(id='i-1', extra={'status': 'running'})
+        driver.list_nodes.return_value = [node]
+
+        fedimg.pipeline.run_sync(service._restore())
+
+        self.assertEqual(service.completed_stages,
+                         ['deploy', 'ssh_ready', 'write'])
+        self.assertEqual(service.util_node, node)
+        self.assertEqual(service.util_volume_id, 'vol-1')
+
+        # Once the utility node is gone, its stages have to be run again
+        service = EC2Service(BASE_URL, journal=journal)
+        service.driver = driver
+        node.extra['status'] = 'terminated'
+
+        fedimg.pipeline.run_sync(service._restore())
+
+        self.assertEqual(service.completed_stages, [])
+        self.assertEqual(service.util_node, None)
+
+    def test_restore_registered_images(self):
+        region = 'eu-west-1'
+        outputs = {'util_node': 'i-1', 'util_volume': 'vol-1',
+                   'snapshot': 'snap-1',
+                   'images': [['ami-1', 'hvm', 'gp2']], 'test_nodes': [],
+                   'test_results': {'snap-1/hvm': True},
+                   'test_success': True,
+                   'copies': [[region, 'ami-1', 'ami-2']],
+                   'region_status': {region: 'completed'}, 'dup_count': 0}
+        journal = mock.Mock()
+        journal.checkpoints.return_value = [
+            (stage, True, outputs) for stage in EC2Service.BUILD_STAGES]
+        service = EC2Service(BASE_URL, journal=journal)
+        service.driver = mock_driver()
+
+        fedimg.pipeline.run_sync(service._restore())
+
+        self.assertEqual(service.util_node, None)
+        self.assertEqual(service.snapshot.id, 'snap-1')
+        self.assertEqual(service._variant_extra(service.images[0]),
+                         {'id': 'ami-1', 'virt_type': 'hvm',
+                          'vol_type': 'gp2'})
+        self.assertTrue(service.test_success)
+        self.assertEqual(service.test_results, {'snap-1/hvm': True})
+        self.assertEqual([(ami.region, copy.id) for ami, _, copy
+                          in service.copied_images], [(region, 'ami-2')])
+        self.assertFalse(service.driver.list_nodes.called)
+
+    @mock.patch('fedimg.messenger.message')
+    def test_tests_each_virt_type_at_once(self, message):
+        def make_service(test_results):
+            service = EC2Service(BASE_URL)
+            service.driver = mock_driver()
+            service.sizes = [mock.Mock(id='m1.xlarge'),
+                             mock.Mock(id='m3.2xlarge')]
+            service.snapshot = mock.Mock(id='snap-1')
+            service.test_results = test_results
+            for n, variant in enumerate(service.variants):
+                image = NodeImage(id='ami-{0}'.format(n), name=None,
+                                  driver=service.driver)
+                service.images.append(image)
+                service.image_variants[image.id] = variant
+            service._registration_aki = mock.Mock(return_value=None)
+            service._create_node = mock.Mock(
+                side_effect=lambda **kwargs: done(mock.Mock(
+                    id='i-' + kwargs['image'].id, public_ips=[])))
+            service._wait_until_running = done
+            service._wait_for_ssh = mock.Mock(return_value=done(None))
+            return service
+
+        # One AMI of each virt_type is tested, and the paravirtual one fails
+        service = make_service({})
+        service._run_command = mock.Mock(
+            side_effect=lambda user, node, cmd, on_output: done(
+                (0, 'ok') if node.id == 'i-ami-0' else (1, 'no')))
+        with self.assertRaises(fedimg.services.ec2.EC2AMITestException) as e:
+            fedimg.pipeline.run_sync(service._test({}))
+        # the configured checks are run, and how each went is reported
+        self.assertIn("fedimg_check test hard /bin/true",
+                      service._run_command.call_args[0][2])
+        self.assertIn('paravirtual AMIs failed.\noutput: test: aborted\nno',
+                      str(e.exception))
+        self.assertEqual(
+            sorted(kwargs['image'].id for _, kwargs
+                   in service._create_node.call_args_list),
+            ['ami-0', 'ami-2'])
+        self.assertEqual(service.test_results,
+                         {'snap-1/hvm': True, 'snap-1/paravirtual': False})
+        self.assertFalse(service.test_success)
+        # the failed node is left to clean up
+        self.assertEqual(list(service.test_nodes), ['paravirtual'])
+        self.assertEqual([args[0].id for args, _
+                          in service.driver.destroy_node.call_args_list],
+                         ['i-ami-0'])
+
+        # What passed for the snapshot before isn't tested again
+        service = make_service({'snap-1/hvm': True})
+        service._run_command = mock.Mock(return_value=done((0, 'ok')))
+        fedimg.pipeline.run_sync(service._test({}))
+        self.assertEqual(service._create_node.call_count, 1)
+        self.assertEqual(service._create_node.call_args[1]['image'].id,
+                         'ami-2')
+        self.assertTrue(service.test_success)
+        self.assertEqual(service.test_nodes, {})
+
+    def test_cancel_stops_before_publishing(self):
+        service = EC2Service(BASE_URL)
+        service.completed_stages = ['deploy', 'ssh_ready']
+        service._write = mock.Mock()
+
+        service.cancel()
+
+        with self.assertRaises(fedimg.services.ec2.EC2CancelledException):
+            fedimg.pipeline.run_sync(
+                service._run_stages(service.build_stages, {}))
+        self.assertFalse(service._write.called)
+
+        # Publishing carries on regardless
+        service._publicize = mock.Mock(return_value=None)
+        service._copy = mock.Mock(return_value=None)
+        fedimg.pipeline.run_sync(
+            service._run_stages(service.DISTRIBUTE_STAGES, {}))
+        self.assertEqual(service.completed_stages[-2:],
+                         ['publicize', 'copy'])
+
+
+    @mock.patch('fedimg.services.ec2.get_waiter')
+    def test_pooled_utility_node(self, get_waiter):
+        service = EC2Service(BASE_URL)
+        service.region = 'us-east-1'
+        driver = service.driver = mock_driver()
+        node = mock.Mock(id='i-1', extra={'availability': 'us-east-1a'})
+        pool = service.util_pool = mock.Mock()
+        pool.acquire.return_value = done((node, '/dev/sdc'))
+        volume = driver.create_volume.return_value
+        volume.extra = {'state': 'available'}
+        get_waiter.return_value.wait_for.side_effect = \
+            lambda kind, resource_id, states: done(volume)
+
+        fedimg.pipeline.run_sync(service._deploy({}))
+
+        self.assertEqual(service.util_node, node)
+        self.assertEqual(driver.create_volume.call_args[1]['location']
+                         .availability_zone.name, 'us-east-1a')
+        driver.attach_volume.assert_called_with(node, volume, '/dev/sdc')
+        self.assertFalse(driver.create_node.called)
+
+        # the image goes to the device of this upload's volume
+        service._open_image = mock.Mock(return_value=done(None))
+        service._run_command = mock.Mock(return_value=done((0, '')))
+        fedimg.pipeline.run_sync(service._write({}))
+        self.assertIn('dd of=/dev/xvdc ',
+                      service._run_command.call_args[0][2])
+
+        fedimg.pipeline.run_sync(service._snapshot({}))
+
+        driver.detach_volume.assert_called_with(volume)
+        pool.release.assert_called_with(node, '/dev/sdc')
+        self.assertFalse(driver.destroy_node.called)
+        driver.destroy_volume.assert_called_with(volume)
+        self.assertEqual(service.util_node, None)
+
+    @mock.patch('fedimg.services.ec2.get_waiter')
+    def test_resumed_volume_is_attached(self, get_waiter):
+        # The job was interrupted between creating the volume and
+        # attaching it
+        service = EC2Service(BASE_URL)
+        service.region = 'us-east-1'
+        driver = service.driver = mock_driver()
+        service.util_pool = mock.Mock()
+        node = service.util_node = mock.Mock(id='i-1')
+        service.util_device = '/dev/sdc'
+        service.util_volume_id = 'vol-1'
+        volume = mock.Mock(id='vol-1', extra={'state': 'available'})
+        get_waiter.return_value.wait_for.side_effect = \
+            lambda kind, resource_id, states: done(volume)
+
+        fedimg.pipeline.run_sync(service._deploy({}))
+
+        self.assertFalse(driver.create_volume.called)
+        driver.attach_volume.assert_called_once_with(node, volume,
+                                                     '/dev/sdc')
+
+        # Once it is attached, it is left as it is
+        driver.attach_volume.reset_mock()
+        volume.extra['state'] = 'in-use'
+        fedimg.pipeline.run_sync(service._deploy({}))
+        self.assertFalse(driver.attach_volume.called)
+
+    def test_cached_image_is_removed(self):
+        service = EC2Service(BASE_URL)
+        service.util_node = mock.Mock(id='i-1')
+        service.util_device = '/dev/sdc'
+        image = mock.Mock()
+        service._open_image = mock.Mock(return_value=done(image))
+        service._send_file = mock.Mock()
+        service._run_command = mock.Mock(return_value=done((0, '')))
+        remote_path = '/tmp/fedora-cloud-base-20140915-21.x86_64.raw.xz'
+
+        # the write pipeline deletes the copy it reads when it exits
+        fedimg.pipeline.run_sync(service._write({}))
+        self.assertIn('trap "rm -f {0}" EXIT; cat {0} |'.format(remote_path),
+                      service._run_command.call_args[0][2])
+        image.close.assert_called_once_with()
+
+        # a copy only partly sent is deleted there and then
+        service._send_file.side_effect = IOError('Connection lost')
+        service._run_command.reset_mock()
+        with self.assertRaises(IOError):
+            fedimg.pipeline.run_sync(service._write({}))
+        self.assertEqual(service._run_command.call_args[0][2],
+                         'rm -f {0}'.format(remote_path))
+
+    @mock.patch('fedimg.services.ec2.time')
+    @mock.patch('fedimg.services.ec2.port_is_open', return_value=False)
+    @mock.patch('fedimg.services.ec2.get_waiter')
+    def test_wait_for_ssh_gives_up(self, get_waiter, port_is_open, time):
+        get_waiter.return_value.wait_for.return_value = \
+            fedimg.pipeline.Future()
+        time.time.side_effect = [1000, 1000, 1300, 1601]
+        node = mock.Mock(id='i-1', public_ips=['10.0.0.1'])
+
+        engine = fedimg.pipeline.PipelineEngine(workers=1)
+        engine.sleep = lambda seconds, sleep=engine.sleep: sleep(0)
+        try:
+            task = engine.submit(fedimg.services.ec2.wait_for_ssh(
+                'us-east-1', 'fedora', node, timeout=600))
+            with self.assertRaisesRegexp(WaiterException, 'within 600s'):
+                task.result(5)
+        finally:
+            engine.shutdown()
+        # the port was tried until the deadline passed
+        self.assertEqual(port_is_open.call_count, 2)
+
+    @mock.patch('fedimg.services.ec2.get_ssh_sessions')
+    def test_run_command_streams_output(self, get_ssh_sessions):
+        chan = get_ssh_sessions.return_value.session.return_value \
+            .__enter__.return_value
+        chunks = ['a' * 20000, 'b' * 20000, '']
+        chan.exit_status_ready.side_effect = [False, True]
+        chan.recv_ready.side_effect = [True, False, True, True]
+        chan.recv.side_effect = chunks
+        chan.recv_exit_status.return_value = 3
+        node = mock.Mock(public_ips=['10.0.0.1'])
+        streamed = []
+
+        engine = fedimg.pipeline.PipelineEngine(workers=1)
+        engine.sleep = lambda seconds, sleep=engine.sleep: sleep(0)
+        try:
+            status, data = engine.submit(
+                EC2Service(BASE_URL)._run_command('fedora', node, 'true',
+                                                  streamed.append)).result(5)
+        finally:
+            engine.shutdown()
+
+        # any handshake is done in a thread before the session opens
+        get_ssh_sessions.return_value.transport.assert_called_with(
+            'fedora', '10.0.0.1')
+        get_ssh_sessions.return_value.session.assert_called_with(
+            'fedora', '10.0.0.1')
+        self.assertEqual(status, 3)
+        self.assertEqual(streamed, chunks[:2])
+        # only the end of the output is kept
+        self.assertEqual(data, ('a' * 20000 + 'b' * 20000)[-32 * 1024:])
+
+
+    @mock.patch('fedimg.services.ec2.log')
+    def test_single_core_xz_is_reported(self, log):
+        service = EC2Service(BASE_URL)
+        service.util_node = mock.Mock(id='i-1')
+        service.util_device = '/dev/sdc'
+        service._open_image = mock.Mock(return_value=done(None))
+        output = 'fedimg decoder: xz (XZ Utils) {0}\r\n'
+        service._run_command = mock.Mock(
+            return_value=done((0, output.format('5.2.5'))))
+
+        fedimg.pipeline.run_sync(service._write({}))
+        self.assertIn('pixz -d', service._run_command.call_args[0][2])
+        self.assertIn('xz is 5.2.5', log.warning.call_args[0][0])
+
+        log.warning.reset_mock()
+        service._run_command.return_value = done((0, output.format('5.4.1')))
+        fedimg.pipeline.run_sync(service._write({}))
+        self.assertFalse(log.warning.called)
+
+        # so is a dd too old to skip zero blocks
+        self.assertIn('conv=sparse', service._run_command.call_args[0][2])
+        service._run_command.return_value = done(
+            (0, output.format('5.4.1') + 'fedimg dd: not sparse\r\n'))
+        fedimg.pipeline.run_sync(service._write({}))
+        self.assertIn('coreutils 8.16', log.warning.call_args[0][0])
+
+
+class TestUtilityPool(unittest.TestCase):
+    """ This tests the pool of utility nodes in fedimg/services/ec2.py. """
+
+    def setUp(self):
+        self.engine = fedimg.pipeline.PipelineEngine(workers=1)
+        self.pool = fedimg.services.ec2.UtilityPool('us-east-1', 2, 60,
+                                                    self.engine)
+        self.gates = []
+
+        def boot(gate, node):
+            yield gate
+            raise fedimg.pipeline.Return(node)
+
+        def boot_node():
+            gate = fedimg.pipeline.Future()
+            self.gates.append(gate)
+            return boot(gate, mock.Mock(id='i-{0}'.format(len(self.gates)),
+                                        public_ips=[]))
+
+        self.boot_node = self.pool._boot_node = boot_node
+
+    def tearDown(self):
+        self.engine.shutdown()
+
+    def open_gates(self):
+        for gate in self.gates:
+            gate.set_result(None)
+
+    def test_reuses_nodes(self):
+        future = self.pool.acquire()
+        self.open_gates()
+        node, device = future.result(5)
+        self.assertEqual(device, '/dev/sdb')
+
+        self.pool.release(node, device)
+
+        again = self.pool.acquire()
+        self.assertTrue(again.done())
+        self.assertEqual(again.result(), (node, device))
+        self.assertEqual(len(self.gates), 1)
+
+    def test_waits_for_warming_nodes(self):
+        self.pool.warm()
+        self.assertEqual(len(self.gates), 2)
+
+        future = self.pool.acquire()
+        self.assertEqual(len(self.gates), 2)
+        self.open_gates()
+        future.result(5)
+
+        # the other node is left for the next job, once it is up, and
+        # warming up again only tops up the spare nodes
+        for i in range(100):
+            if len(self.pool._nodes) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(self.pool._nodes), 2)
+        self.pool.warm()
+        self.assertEqual(len(self.gates), 3)
+
+    @mock.patch('fedimg.services.ec2.ec2_driver')
+    def test_idle_nodes_are_terminated(self, ec2_driver):
+        driver = ec2_driver.return_value = mock_driver()
+        self.pool.idle_timeout = 0.01
+        futures = [self.pool.acquire() for i in range(3)]
+        self.open_gates()
+        slots = [future.result(5) for future in futures]
+
+        for node, device in slots:
+            self.pool.release(node, device)
+        # one more than the pool holds goes first
+        self.assertTrue(eventually(lambda: driver.destroy_node.called))
+        self.assertEqual(driver.destroy_node.call_args_list[0],
+                         mock.call(slots[2][0]))
+
+        self.assertTrue(eventually(
+            lambda: driver.destroy_node.call_count == 3))
+        self.assertEqual(self.pool._nodes, {})
+
+    @mock.patch('fedimg.services.ec2.ec2_driver')
+    def test_shares_nodes(self, ec2_driver):
+        driver = ec2_driver.return_value = mock_driver()
+        self.pool = fedimg.services.ec2.UtilityPool('us-east-1', 0, 60,
+                                                    self.engine, slots=3)
+        self.pool._boot_node = self.boot_node
+        futures = [self.pool.acquire() for i in range(4)]
+        # three jobs fit on the first node, and the fourth needs another
+        self.assertEqual(len(self.gates), 2)
+        self.gates[0].set_result(None)
+        slots = [future.result(5) for future in futures[:3]]
+        self.gates[1].set_result(None)
+        slots.append(futures[3].result(5))
+        self.assertEqual([node.id for node, _ in slots],
+                         ['i-1', 'i-1', 'i-1', 'i-2'])
+        self.assertEqual([device for _, device in slots],
+                         ['/dev/sdb', '/dev/sdc', '/dev/sdd', '/dev/sdb'])
+
+        # a failed job retires its node, which is terminated once the
+        # others on it are done
+        self.pool.discard(*slots[0])
+        self.pool.release(*slots[1])
+        self.assertEqual(self.pool.acquire().result(0),
+                         (slots[3][0], '/dev/sdc'))
+        self.assertFalse(driver.destroy_node.called)
+        self.pool.release(*slots[2])
+        self.assertTrue(eventually(lambda: driver.destroy_node.called))
+        driver.destroy_node.assert_called_once_with(slots[0][0])
+
+if __name__ == '__main__':
+    unittest.main()
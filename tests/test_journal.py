@@ -0,0 +1,115 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import fedimg.journal
+from fedimg.journal import DONE, FAILED
+
+URL = 'https://somepage.org/fedora-cloud-base-26.x86_64.raw.xz'
+
+
+class TestJournal(unittest.TestCase):
+    """ This tests fedimg/journal.py. """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'fedimg', 'journal.sqlite')
+        self.journal = fedimg.journal.Journal(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_checkpoints_survive_a_restart(self):
+        self.assertFalse(self.journal.start(URL, URL, {'compose_id': 'c'}))
+        self.journal.checkpoint(URL, 'deploy', {'util_node': 'i-1'})
+        self.journal.checkpoint(URL, 'register', {'images': ['ami-1']},
+                                completed=False)
+
+        journal = fedimg.journal.Journal(self.path)
+        self.assertEqual(journal.unfinished(), [(URL, {'compose_id': 'c'})])
+        self.assertTrue(journal.start(URL, URL, {'compose_id': 'c'}))
+        self.assertEqual(journal.checkpoints(URL), [
+            ('deploy', True, {'util_node': 'i-1'}),
+            ('register', False, {'images': ['ami-1']})])
+
+    def test_checkpoints_stay_in_write_order(self):
+        self.journal.start(URL, URL, {})
+        self.journal.checkpoint(URL, 'register', {'n': 1}, completed=False)
+        self.journal.checkpoint(URL, 'deploy', {'n': 2})
+        self.journal.checkpoint(URL, 'register', {'n': 3})
+        self.assertEqual([(s, o['n']) for s, _, o in
+                          self.journal.checkpoints(URL)],
+                         [('deploy', 2), ('register', 3)])
+
+    def test_finished_jobs_start_over(self):
+        self.journal.start(URL, URL, {})
+        self.journal.checkpoint(URL, 'deploy', {'util_node': 'i-1'})
+        self.journal.finish(URL, DONE)
+        self.assertEqual(self.journal.unfinished(), [])
+        self.assertFalse(self.journal.start(URL, URL, {}))
+        self.assertEqual(self.journal.checkpoints(URL), [])
+
+    def test_queued_jobs_are_unfinished(self):
+        self.journal.queue(URL, URL, {'compose_id': 'c'})
+        other = URL.replace('base', 'atomic')
+        self.journal.queue(other, other, {'compose_id': 'c'})
+        self.journal.unqueue(other)
+
+        journal = fedimg.journal.Journal(self.path)
+        self.assertEqual(journal.unfinished(), [(URL, {'compose_id': 'c'})])
+        # a queued job has nothing to pick up from
+        self.assertFalse(journal.start(URL, URL, {'compose_id': 'c'}))
+
+        # a running job is neither queued again nor forgotten
+        journal.queue(URL, URL, {'compose_id': 'd'})
+        journal.unqueue(URL)
+        self.assertEqual(journal.unfinished(), [(URL, {'compose_id': 'c'})])
+        self.assertTrue(journal.start(URL, URL, {'compose_id': 'c'}))
+
+    def test_failed_jobs_drop_checkpoints(self):
+        self.journal.start(URL, URL, {})
+        self.journal.checkpoint(URL, 'deploy', {'util_node': 'i-1'})
+        self.journal.finish(URL, FAILED)
+        self.assertEqual(self.journal.checkpoints(URL), [])
+
+    def test_claim_variants(self):
+        variants = [('hvm', 'standard'), ('hvm', 'gp2')]
+
+        self.assertEqual(self.journal.claim('c', URL, variants), variants)
+        self.assertEqual(self.journal.claim('c', URL, variants), [])
+        self.assertEqual(self.journal.claimed('c', URL), variants)
+        # Other composes of the same image are separate
+        self.assertEqual(self.journal.claim('d', URL, variants[:1]),
+                         variants[:1])
+
+        self.journal.settle('c', URL, variants[:1], DONE)
+        self.journal.settle('c', URL, variants[1:], FAILED)
+
+        journal = fedimg.journal.Journal(self.path)
+        self.assertEqual(journal.claimed('c', URL), [])
+        self.assertEqual(journal.claim('c', URL, variants), variants[1:])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+import json
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import fedimg.messenger
+
+URL = 'https://somepage.org/Fedora-Cloud-Base-26-1.5.x86_64.raw.xz'
+
+
+class TestMessenger(unittest.TestCase):
+    """ This tests fedimg/messenger.py. """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.published = []
+        self.threads = set()
+        self.unblocked = threading.Event()
+        self.unblocked.set()
+        self.publishing = threading.Event()
+
+        def publish(topic, modname, msg):
+            self.publishing.set()
+            self.unblocked.wait()
+            self.threads.add(threading.current_thread())
+            self.published.append((topic, msg))
+
+        patcher = mock.patch('fedimg.messenger.fedmsg.publish',
+                             side_effect=publish)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.unblocked.set()
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch('fedimg.messenger.get_publisher')
+    def test_message(self, get_publisher):
+        fedimg.messenger.message('image.upload', URL, 'EC2 (eu-west-1)',
+                                 'started', {'compose_id': 'Fedora-26'})
+
+        get_publisher.return_value.publish.assert_called_once_with(
+            'image.upload', {
+                'image_url': URL,
+                'image_name': 'Fedora-Cloud-Base-26-1.5.x86_64',
+                'destination': 'EC2 (eu-west-1)',
+                'status': 'started',
+                'extra': {},
+                'compose': {'compose_id': 'Fedora-26'}})
+
+    def test_publishes_from_one_thread(self):
+        publisher = fedimg.messenger.Publisher()
+        threads = [threading.Thread(target=publisher.publish,
+                                    args=('image.upload', {'n': i}))
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(publisher.flush(5))
+        self.assertEqual(sorted(msg['n'] for _, msg in self.published),
+                         range(10))
+        self.assertEqual(self.threads, set([publisher._thread]))
+
+    def test_full_queue_drops(self):
+        self.unblocked.clear()
+        publisher = fedimg.messenger.Publisher(max_queued=2)
+        publisher.publish('image.upload', {'n': 0})
+        self.publishing.wait(5)
+        for i in range(1, 5):
+            publisher.publish('image.upload', {'n': i})
+
+        # One is being published, two are queued, two are dropped
+        self.assertEqual(publisher.dropped, 2)
+        self.unblocked.set()
+        publisher.flush(5)
+        self.assertEqual([msg['n'] for _, msg in self.published], [0, 1, 2])
+
+    def test_full_queue_spills(self):
+        self.unblocked.clear()
+        spill_path = os.path.join(self.tmpdir, 'messages.spill')
+        publisher = fedimg.messenger.Publisher(max_queued=2,
+                                               spill_path=spill_path)
+        publisher.publish('image.upload', {'n': 0})
+        self.publishing.wait(5)
+        for i in range(1, 6):
+            publisher.publish('image.upload', {'n': i})
+        self.assertEqual(publisher.dropped, 0)
+
+        self.assertEqual(publisher._queue.qsize(), 2)
+        self.unblocked.set()
+        self.assertTrue(publisher.flush(5))
+        self.assertEqual([msg['n'] for _, msg in self.published],
+                         range(6))
+        self.assertFalse(os.path.exists(spill_path))
+
+        # and once they are out, messages are queued again
+        publisher.publish('image.upload', {'n': 6})
+        self.assertTrue(publisher.flush(5))
+        self.assertEqual(self.published[-1][1], {'n': 6})
+        self.assertFalse(os.path.exists(spill_path))
+
+    def test_unencodable_spill_drops(self):
+        self.unblocked.clear()
+        spill_path = os.path.join(self.tmpdir, 'messages.spill')
+        publisher = fedimg.messenger.Publisher(max_queued=1,
+                                               spill_path=spill_path)
+        publisher.publish('image.upload', {'n': 0})
+        self.publishing.wait(5)
+        publisher.publish('image.upload', {'n': 1})
+        publisher.publish('image.test', {'output': '\xff\xfe'})
+        publisher.publish('image.upload', {'n': 2})
+
+        self.assertEqual(publisher.dropped, 1)
+        self.unblocked.set()
+        self.assertTrue(publisher.flush(5))
+        self.assertEqual([msg['n'] for _, msg in self.published],
+                         range(3))
+
+    def test_earlier_spill_goes_first(self):
+        spill_path = os.path.join(self.tmpdir, 'messages.spill')
+        with open(spill_path + '.replay', 'w') as f:
+            f.write(json.dumps({'topic': 'image.upload',
+                                'msg': {'n': 0}}) + '\n')
+        with open(spill_path, 'w') as f:
+            f.write(json.dumps({'topic': 'image.upload',
+                                'msg': {'n': 1}}) + '\n')
+            f.write('{"topic": "image.up\n')  # cut short by a crash
+
+        self.unblocked.clear()
+        publisher = fedimg.messenger.Publisher(spill_path=spill_path)
+        for i in range(2, 4):
+            publisher.publish('image.upload', {'n': i})
+        self.unblocked.set()
+
+        self.assertTrue(publisher.flush(5))
+        self.assertEqual([msg['n'] for _, msg in self.published],
+                         range(4))
+        self.assertFalse(os.path.exists(spill_path))
+        self.assertFalse(os.path.exists(spill_path + '.replay'))
+
+    def test_spill_size_is_capped(self):
+        self.unblocked.clear()
+        spill_path = os.path.join(self.tmpdir, 'messages.spill')
+        line = json.dumps({'topic': 'image.upload', 'msg': {'n': 1}}) + '\n'
+        publisher = fedimg.messenger.Publisher(
+            max_queued=1, spill_path=spill_path, max_spilled=len(line) * 2)
+        publisher.publish('image.upload', {'n': 0})
+        self.publishing.wait(5)
+        for i in range(1, 6):
+            publisher.publish('image.upload', {'n': i})
+
+        # One is being published, one is queued, two are spilled
+        self.assertEqual(publisher.dropped, 2)
+        self.assertEqual(os.path.getsize(spill_path), len(line) * 2)
+        self.unblocked.set()
+        self.assertTrue(publisher.flush(5))
+        self.assertEqual([msg['n'] for _, msg in self.published],
+                         range(4))
+
+if __name__ == '__main__':
+    unittest.main()
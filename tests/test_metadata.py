@@ -0,0 +1,129 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+import json
+import mock
+import requests
+import unittest
+from StringIO import StringIO
+
+import fedimg.metadata
+from fedimg.pipeline import Future
+
+IMAGES = {'payload': {'images': {
+    'CloudImages': {
+        'x86_64': [{'path': 'CloudImages/x86_64/images/base.raw.xz'}],
+        'i386': [{'path': 'CloudImages/i386/images/base.raw.xz'}]},
+    'Server': {
+        'x86_64': [{'path': 'Server/x86_64/iso/server.iso'}]}}}}
+LOCATION = 'https://kojipkgs.fedoraproject.org/compose/Fedora-26/compose'
+
+
+class TestMetadata(unittest.TestCase):
+    """ This tests fedimg/metadata.py. """
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_extract_images(self):
+        images = fedimg.metadata.extract_images(StringIO(json.dumps(IMAGES)))
+        self.assertEqual(images,
+                         [{'path': 'CloudImages/x86_64/images/base.raw.xz'}])
+
+        images = fedimg.metadata.extract_images(
+            StringIO(json.dumps(IMAGES)), arch='ppc64le')
+        self.assertEqual(images, [])
+
+    @mock.patch('fedimg.metadata.ijson', None)
+    def test_extract_images_without_ijson(self):
+        self.test_extract_images()
+
+    @mock.patch('fedimg.metadata.fedfind')
+    @mock.patch('fedimg.metadata.requests.get')
+    def test_fetch_images(self, get, fedfind):
+        get.return_value.raw = StringIO(json.dumps(IMAGES))
+
+        images = fedimg.metadata.fetch_images('Fedora-26', LOCATION)
+
+        get.assert_called_once_with(LOCATION + '/metadata/images.json',
+                                    stream=True, timeout=60)
+        self.assertEqual(len(images), 1)
+        self.assertFalse(fedfind.release.get_release_cid.called)
+
+        # Falls back to fedfind
+        get.side_effect = requests.ConnectionError()
+        fedfind.release.get_release_cid.return_value.metadata = {
+            'images': IMAGES}
+
+        images = fedimg.metadata.fetch_images('Fedora-26', LOCATION)
+
+        fedfind.release.get_release_cid.assert_called_once_with('Fedora-26')
+        self.assertEqual(len(images), 1)
+
+    @mock.patch('fedimg.metadata.time.time')
+    @mock.patch('fedimg.metadata.run_in_thread')
+    def test_cache(self, run_in_thread, now):
+        def fetch(fn, compose_id, location):
+            future = Future()
+            future.set_result([compose_id])
+            return future
+        run_in_thread.side_effect = fetch
+        now.return_value = 1000
+        cache = fedimg.metadata.MetadataCache(60, max_entries=2)
+
+        self.assertEqual(cache.get('a', LOCATION), ['a'])
+        self.assertEqual(cache.get('a', LOCATION), ['a'])
+        self.assertEqual(run_in_thread.call_count, 1)
+
+        # 'b' is pushed out by 'c', having been used less recently than 'a'
+        cache.get('b', LOCATION)
+        cache.get('a', LOCATION)
+        cache.get('c', LOCATION)
+        self.assertEqual(run_in_thread.call_count, 3)
+        cache.get('a', LOCATION)
+        self.assertEqual(run_in_thread.call_count, 3)
+        cache.get('b', LOCATION)
+        self.assertEqual(run_in_thread.call_count, 4)
+
+        # Entries expire
+        now.return_value = 1061
+        cache.get('b', LOCATION)
+        self.assertEqual(run_in_thread.call_count, 5)
+
+    @mock.patch('fedimg.metadata.run_in_thread')
+    def test_failed_fetches_are_retried(self, run_in_thread):
+        failed = Future()
+        failed.set_exception(IOError('no route to host'))
+        run_in_thread.return_value = failed
+        cache = fedimg.metadata.MetadataCache(60)
+
+        with self.assertRaises(IOError):
+            cache.get('a', LOCATION)
+        with self.assertRaises(IOError):
+            cache.get('a', LOCATION)
+        self.assertEqual(run_in_thread.call_count, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+import mock
+import socket
+import unittest
+import urllib2
+
+import fedimg.metrics
+
+
+class TestMetrics(unittest.TestCase):
+    """ This tests fedimg/metrics.py. """
+
+    def setUp(self):
+        self.registry = fedimg.metrics.Registry(buckets=(1, 10))
+
+    def tearDown(self):
+        pass
+
+    def test_render(self):
+        self.registry.inc('fedimg_api_calls_total', region='us-east-1',
+                          method='list_nodes')
+        self.registry.inc('fedimg_api_calls_total', 2, region='us-east-1',
+                          method='list_nodes')
+        self.registry.gauge('fedimg_jobs_queued', 4)
+        self.registry.observe('fedimg_stage_seconds', 0.5, stage='deploy')
+        self.registry.observe('fedimg_stage_seconds', 5, stage='deploy')
+        self.registry.observe('fedimg_stage_seconds', 50, stage='deploy')
+
+        self.assertEqual(self.registry.render().splitlines(), [
+            '# TYPE fedimg_api_calls_total counter',
+            'fedimg_api_calls_total{method="list_nodes",region="us-east-1"}'
+            ' 3',
+            '# TYPE fedimg_jobs_queued gauge',
+            'fedimg_jobs_queued 4',
+            '# TYPE fedimg_stage_seconds histogram',
+            'fedimg_stage_seconds_bucket{stage="deploy",le="1"} 1',
+            'fedimg_stage_seconds_bucket{stage="deploy",le="10"} 2',
+            'fedimg_stage_seconds_bucket{stage="deploy",le="+Inf"} 3',
+            'fedimg_stage_seconds_sum{stage="deploy"} 55.5',
+            'fedimg_stage_seconds_count{stage="deploy"} 3',
+        ])
+
+    @mock.patch('fedimg.metrics.time.time')
+    def test_timer(self, now):
+        now.side_effect = [100, 103]
+
+        with self.assertRaises(ValueError):
+            with self.registry.timer('fedimg_stage_seconds', stage='write'):
+                raise ValueError()
+
+        self.assertEqual(self.registry.value('fedimg_stage_seconds',
+                                             stage='write'), 1)
+        self.assertIn('fedimg_stage_seconds_sum{stage="write"} 3',
+                      self.registry.render())
+
+    def test_statsd(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(5)
+        self.addCleanup(receiver.close)
+        self.registry.sinks.append(fedimg.metrics.StatsdSink(
+            '127.0.0.1', receiver.getsockname()[1]))
+
+        self.registry.inc('fedimg_jobs_total', state='completed')
+        self.registry.observe('fedimg_copy_seconds', 1.5,
+                              region='eu-west-1')
+
+        self.assertEqual(receiver.recv(1024),
+                         'fedimg.fedimg_jobs_total.completed:1|c')
+        self.assertEqual(receiver.recv(1024),
+                         'fedimg.fedimg_copy_seconds.eu-west-1:1500|ms')
+
+    @mock.patch('fedimg.metrics.registry')
+    def test_endpoint(self, registry):
+        registry.render.return_value = 'fedimg_jobs_queued 0\n'
+        server = fedimg.metrics.serve(0)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+
+        self.assertEqual(urllib2.urlopen(url + '/metrics').read(),
+                         'fedimg_jobs_queued 0\n')
+        with self.assertRaises(urllib2.HTTPError):
+            urllib2.urlopen(url + '/')
+
+    @mock.patch('fedimg.metrics._started', False)
+    @mock.patch('fedimg.metrics.registry')
+    def test_statsd_without_endpoint(self, registry):
+        registry.sinks = []
+        taken = fedimg.metrics.serve(0)
+        self.addCleanup(taken.shutdown)
+
+        with mock.patch('fedimg.METRICS_PORT', taken.server_address[1]), \
+                mock.patch('fedimg.STATSD_HOST', '127.0.0.1'):
+            self.assertRaises(socket.error, fedimg.metrics.start)
+        # the statsd sink is set up all the same
+        self.assertEqual(len(registry.sinks), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import threading
+import unittest
+
+from fedimg.pipeline import Future, PipelineEngine, Return, Semaphore
+from fedimg.pipeline import ThreadPool, run_sync
+
+
+class TestPipeline(unittest.TestCase):
+    """ This tests fedimg/pipeline.py. """
+
+    def setUp(self):
+        self.engine = PipelineEngine(workers=2)
+
+    def tearDown(self):
+        self.engine.shutdown()
+
+    def test_sub_steps_hand_back_values(self):
+        def double(x):
+            yield 0.01
+            raise Return(x * 2)
+
+        def job():
+            a = yield double(2)
+            b = yield double(a)
+            raise Return(b)
+
+        self.assertEqual(self.engine.submit(job()).result(5), 8)
+
+    def test_exceptions_reach_the_caller(self):
+        def broken():
+            yield 0
+            raise ValueError("nope")
+
+        def job():
+            try:
+                yield broken()
+            except ValueError:
+                raise Return('caught')
+
+        self.assertEqual(self.engine.submit(job()).result(5), 'caught')
+
+    def test_many_waiting_jobs_few_threads(self):
+        def job(i):
+            yield 0.2
+            raise Return(i)
+
+        tasks = [self.engine.submit(job(i)) for i in range(200)]
+        self.assertEqual([t.result(5) for t in tasks], range(200))
+
+    def test_wait_on_futures_and_lists(self):
+        future = Future()
+
+        def job():
+            results = yield [future, 0.01]
+            raise Return(results[0])
+
+        task = self.engine.submit(job())
+        future.set_result('done')
+        self.assertEqual(task.result(5), 'done')
+
+    def test_semaphore_bounds_concurrency(self):
+        slots = Semaphore(2)
+        active = []
+        peak = [0]
+
+        def job():
+            yield slots.acquire()
+            active.append(1)
+            peak[0] = max(peak[0], len(active))
+            yield 0.01
+            active.pop()
+            slots.release()
+
+        tasks = [self.engine.submit(job()) for i in range(10)]
+        [t.result(5) for t in tasks]
+        self.assertEqual(peak[0], 2)
+
+    def test_run_sync(self):
+        def job():
+            yield 0
+            raise Return(0)
+
+        self.assertEqual(run_sync(job()), 0)
+
+    def test_thread_pool_is_bounded(self):
+        pool = ThreadPool(2)
+        release = threading.Event()
+        threads = set()
+
+        def call(i):
+            threads.add(threading.current_thread())
+            release.wait(5)
+            return i
+
+        futures = [pool.submit(call, i) for i in range(10)]
+        release.set()
+        self.assertEqual([f.result(5) for f in futures], range(10))
+        self.assertEqual(len(threads), 2)
+
+    def test_thread_pool_reports_errors(self):
+        def broken():
+            raise ValueError("nope")
+
+        future = ThreadPool(1).submit(broken)
+        self.assertRaises(ValueError, future.result, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
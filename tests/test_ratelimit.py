@@ -0,0 +1,170 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+import mock
+import threading
+import unittest
+
+import fedimg.ratelimit
+from fedimg.pipeline import Future, Return
+
+
+def drive(job, waits):
+    """ Runs the generator job `job` until it hands back its result, sending
+    it the results of the futures it yields, and appends the other waits it
+    yields to `waits`. """
+    value = exception = None
+    while True:
+        if exception is not None:
+            yielded = job.throw(exception)
+        else:
+            yielded = job.send(value)
+        value = exception = None
+        if not isinstance(yielded, Future):
+            waits.append(yielded)
+            continue
+        try:
+            value = yielded.result(5)
+        except Exception as e:
+            exception = e
+
+
+class TestRateLimit(unittest.TestCase):
+    """ This tests fedimg/ratelimit.py. """
+
+    def setUp(self):
+        self.limiter = fedimg.ratelimit.RateLimiter(
+            {'describe': (1000, 10), 'mutate': (100, 1),
+             'intensive': (100, 1)},
+            base_backoff=0, max_backoff=0)
+
+    def tearDown(self):
+        pass
+
+    def test_family_of(self):
+        self.assertEqual(fedimg.ratelimit.family_of('list_images'),
+                         'describe')
+        self.assertEqual(fedimg.ratelimit.family_of('describe_snapshot'),
+                         'describe')
+        self.assertEqual(
+            fedimg.ratelimit.family_of('ex_modify_image_attribute'),
+            'mutate')
+        self.assertEqual(fedimg.ratelimit.family_of('create_node'),
+                         'intensive')
+        self.assertEqual(fedimg.ratelimit.family_of('put_snapshot_block'),
+                         'blocks')
+
+    def test_is_throttling(self):
+        self.assertTrue(fedimg.ratelimit.is_throttling(Exception(
+            'RequestLimitExceeded: Request limit exceeded.')))
+        self.assertTrue(fedimg.ratelimit.is_throttling(Exception(
+            'RequestThrottledException: Too many blocks')))
+        self.assertFalse(fedimg.ratelimit.is_throttling(Exception(
+            'InvalidAMIName.Duplicate: AMI name is already in use')))
+
+    @mock.patch('fedimg.ratelimit.time')
+    def test_bucket(self, time):
+        time.time.return_value = 1000
+        bucket = fedimg.ratelimit.TokenBucket(10, 2)
+
+        # the burst goes straight through, then callers queue up
+        self.assertEqual([bucket.reserve() for i in range(4)],
+                         [0, 0, 0.1, 0.2])
+        time.time.return_value = 1001
+        self.assertEqual(bucket.reserve(), 0)
+
+    def test_bucket_adapts(self):
+        bucket = fedimg.ratelimit.TokenBucket(10, 2)
+        bucket.throttled()
+        bucket.throttled()
+        self.assertEqual(bucket.rate, 2.5)
+        self.assertTrue(bucket.reserve() > 0)
+        for i in range(20):
+            bucket.succeeded()
+        self.assertEqual(bucket.rate, 10)
+        for i in range(10):
+            bucket.throttled()
+        self.assertEqual(bucket.rate, 10 / 16.0)
+
+    def test_retries_throttled_calls(self):
+        fn = mock.Mock(side_effect=[
+            Exception('RequestLimitExceeded: Request limit exceeded.'),
+            'copied'])
+
+        self.assertEqual(self.limiter.call('id', 'us-east-1', 'copy_image',
+                                           fn, 'ami-1'), 'copied')
+        fn.assert_called_with('ami-1')
+        bucket = self.limiter.bucket('id', 'us-east-1', 'intensive')
+        # halved, then won back a little
+        self.assertEqual(bucket.rate, 55)
+        self.assertEqual(self.limiter.bucket('id', 'eu-west-1',
+                                             'intensive').rate, 100)
+
+    @mock.patch('fedimg.ratelimit.time.sleep')
+    def test_job_yields_its_waits(self, sleep):
+        limiter = fedimg.ratelimit.RateLimiter(
+            {'describe': (1, 1), 'mutate': (1, 1), 'intensive': (1, 1)},
+            base_backoff=4, max_backoff=4)
+        fn = mock.Mock(side_effect=[
+            Exception('RequestLimitExceeded: Request limit exceeded.'),
+            'copied'])
+
+        job = limiter.job('id', 'us-east-1', 'copy_image', fn, 'ami-1')
+        waits = []
+        with self.assertRaises(Return) as r:
+            drive(job, waits)
+
+        self.assertEqual(r.exception.value, 'copied')
+        fn.assert_called_with('ami-1')
+        # the backoff, then the wait for a token at the halved rate
+        self.assertEqual(len(waits), 2)
+        self.assertTrue(2 <= waits[0] <= 4)
+        self.assertTrue(waits[1] > 0)
+        self.assertFalse(sleep.called)
+
+    def test_job_calls_in_a_thread(self):
+        threads = []
+        fn = mock.Mock(side_effect=lambda: threads.append(
+            threading.current_thread()))
+
+        job = self.limiter.job('id', 'us-east-1', 'list_images', fn)
+        self.assertRaises(Return, drive, job, [])
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], threading.current_thread())
+
+    def test_other_errors_are_raised(self):
+        fn = mock.Mock(side_effect=ValueError('InvalidAMIID.NotFound'))
+
+        self.assertRaises(ValueError, self.limiter.call, 'id', 'us-east-1',
+                          'list_images', fn)
+        self.assertEqual(fn.call_count, 1)
+
+    def test_gives_up_eventually(self):
+        fn = mock.Mock(side_effect=Exception('Throttling'))
+
+        self.assertRaises(Exception, self.limiter.call, 'id', 'us-east-1',
+                          'list_images', fn)
+        self.assertEqual(fn.call_count, fedimg.ratelimit.ATTEMPTS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+import StringIO
+import unittest
+
+import fedimg.replay
+from fedimg.util import get_rawxz_urls
+
+
+class TestReplay(unittest.TestCase):
+    """ This tests fedimg/replay.py. """
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_synthetic_messages(self):
+        messages = fedimg.replay.synthetic_messages(7, seed=1)
+        self.assertEqual(messages, fedimg.replay.synthetic_messages(7, seed=1))
+        timestamps = [message['timestamp'] for message in messages]
+        self.assertEqual(timestamps, sorted(timestamps))
+        compose_ids = set(message['msg']['compose_id']
+                          for message in messages)
+        # two nightlies a day and a release candidate, plus respins
+        self.assertTrue(len(compose_ids) >= 15)
+        self.assertIn('Fedora-27-20170707.0', compose_ids)
+
+    def test_record_and_load(self):
+        messages = fedimg.replay.synthetic_messages(2, seed=1)
+        f = StringIO.StringIO()
+        self.assertEqual(fedimg.replay.record(f, reversed(messages)),
+                         len(messages))
+        f.seek(0)
+        self.assertEqual(fedimg.replay.load(f), messages)
+
+    def test_images_for(self):
+        images = fedimg.replay.images_for('Fedora-27-20170707.0', 3)
+        self.assertEqual(len(get_rawxz_urls('https://x', images)), 3)
+
+    def test_replay(self):
+        messages = fedimg.replay.synthetic_messages(3, seed=1)
+        finished = set(message['msg']['compose_id'] for message in messages
+                       if message['msg']['status'].startswith('FINISHED'))
+        report = fedimg.replay.replay(messages, speed=1000000.0, images=2)
+        self.assertEqual(report['messages'], len(messages))
+        self.assertEqual(report['jobs']['submitted'], 2 * len(finished))
+        self.assertEqual(report['jobs']['completed'], 2 * len(finished))
+        self.assertEqual(report['jobs']['queued'], 0)
+        self.assertTrue(report['consume_ms']['max'] >=
+                        report['consume_ms']['p50'])
+        self.assertTrue(report['rss_peak'] >= report['rss_start'])
+
+
+if __name__ == '__main__':
+    unittest.main()
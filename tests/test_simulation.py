@@ -0,0 +1,88 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+
+import unittest
+
+import libcloud.compute.providers
+
+import fedimg.drivers
+import fedimg.simulation
+
+
+class TestSimulation(unittest.TestCase):
+    """ This tests fedimg/simulation.py. """
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_benchmark(self):
+        report = fedimg.simulation.run_benchmark(
+            composes=1, images=2, regions=2, time_scale=0.0002, seed=1)
+        self.assertEqual(report['jobs'], 2)
+        self.assertEqual(report['completed'], 2)
+        self.assertTrue(report['jobs_per_hour'] > 0)
+        # a utility node per image, and a test node per virt_type of each
+        self.assertEqual(report['api_calls']['create_node'], 6)
+        # four variants of each image, copied into the other region
+        self.assertEqual(report['api_calls']['ex_register_image'], 8)
+        self.assertEqual(report['api_calls']['copy_image'], 8)
+        self.assertEqual(
+            report['messages'][('image.test', 'completed')], 4)
+        # the real driver lookup is back in place afterwards
+        self.assertIs(fedimg.drivers.get_driver,
+                      libcloud.compute.providers.get_driver)
+
+    def test_benchmark_util_pool(self):
+        report = fedimg.simulation.run_benchmark(
+            composes=2, images=1, regions=2, time_scale=0.0002,
+            max_jobs=1, seed=1, util_pool=1)
+        self.assertEqual(report['completed'], 2)
+        # one pooled utility node, and two test nodes per image
+        self.assertEqual(report['api_calls']['create_node'], 5)
+        self.assertEqual(report['api_calls']['attach_volume'], 2)
+
+    def test_benchmark_util_volumes(self):
+        report = fedimg.simulation.run_benchmark(
+            composes=1, images=3, regions=2, time_scale=0.0002, seed=1,
+            util_volumes=3)
+        self.assertEqual(report['completed'], 3)
+        # the images share one utility node, and each has two test nodes
+        self.assertEqual(report['api_calls']['create_node'], 7)
+        self.assertEqual(report['api_calls']['attach_volume'], 3)
+        self.assertEqual(report['api_calls']['destroy_node'], 7)
+
+    def test_benchmark_failures(self):
+        report = fedimg.simulation.run_benchmark(
+            composes=1, images=2, regions=2, time_scale=0.0002,
+            failure_rates={'test': 1.0}, seed=1)
+        self.assertEqual(report['failed'], 2)
+        self.assertEqual(report['jobs_per_hour'], 0)
+        self.assertNotIn('copy_image', report['api_calls'])
+        self.assertEqual(
+            report['messages'][('image.test', 'failed')], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
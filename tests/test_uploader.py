@@ -20,19 +20,332 @@
 #
 
 import mock
+import os
+import shutil
+import tempfile
 import unittest
 
+import fedimg.journal
+import fedimg.pipeline
 import fedimg.uploader
+from fedimg.pipeline import Future, Return
+
+
+def fake_service(url, **kwargs):
+    """ Stands in for an EC2Service whose upload waits on a future. """
+    service = mock.Mock(raw_url=url, build_name=url.split('/')[-1])
+    service.done = Future()
+    service.cancelled = False
+    service.variants = [('hvm', 'standard'), ('hvm', 'gp2')]
+
+    def cancel():
+        service.cancelled = True
+        service.done.set_result(1)
+
+    service.cancel.side_effect = cancel
+
+    def pipeline(compose_meta):
+        result = yield service.done
+        raise Return(result)
+
+    service.pipeline.side_effect = pipeline
+    return service
 
 
 class TestUploader(unittest.TestCase):
     """ This tests fedimg/uploader.py. """
 
     def setUp(self):
-        pass
+        self.engine = fedimg.pipeline.PipelineEngine(workers=2)
+        self.urls = ['https://somepage.org/fedora-cloud-{0}.raw.xz'.format(i)
+                     for i in range(4)]
 
     def tearDown(self):
-        pass
+        self.engine.shutdown()
+
+    @mock.patch('fedimg.uploader.get_journal')
+    @mock.patch('fedimg.uploader.EC2Service')
+    def test_one_service_per_url(self, EC2Service, get_journal):
+        urls = self.urls[:2]
+        EC2Service.side_effect = fake_service
+
+        uploader = fedimg.uploader.Uploader(self.engine)
+        jobs = uploader.submit(urls, {'compose_id': 'Fedora-26'},
+                               {urls[0]: 'abc123'})
+
+        self.assertEqual(EC2Service.call_args_list,
+                         [mock.call(urls[0], journal=get_journal(),
+                                    checksum='abc123'),
+                          mock.call(urls[1], journal=get_journal(),
+                                    checksum=None)])
+        for job in jobs:
+            job.service.pipeline.assert_called_with(
+                {'compose_id': 'Fedora-26'})
+
+    @mock.patch('fedimg.uploader.get_journal')
+    @mock.patch('fedimg.uploader.EC2Service')
+    def test_submit_does_not_wait(self, EC2Service, get_journal):
+        EC2Service.side_effect = fake_service
+
+        uploader = fedimg.uploader.Uploader(self.engine, max_running=2)
+        jobs = uploader.submit(self.urls, {'compose_id': 'Fedora-26'})
+
+        self.assertFalse(any(job.done() for job in jobs))
+        self.assertEqual([job.state for job in jobs],
+                         ['running', 'running', 'queued', 'queued'])
+
+        # As running jobs finish, queued ones take their place
+        jobs[0].service.done.set_result(0)
+        self.assertEqual(jobs[0].result(timeout=5), 0)
+        self.assertEqual(jobs[2].state, 'running')
+        jobs[1].service.done.set_result(1)
+        self.assertEqual(jobs[1].result(timeout=5), 1)
+        for job in jobs[2:]:
+            job.service.done.set_result(0)
+            job.result(timeout=5)
+
+        stats = uploader.stats()
+        self.assertEqual(stats['submitted'], 4)
+        self.assertEqual(stats['completed'], 3)
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(stats['max_queued'], 2)
+        self.assertEqual((stats['queued'], stats['running']), (0, 0))
+
+    @mock.patch('fedimg.uploader.get_journal')
+    @mock.patch('fedimg.uploader.EC2Service')
+    def test_full_queue(self, EC2Service, get_journal):
+        EC2Service.side_effect = fake_service
+
+        uploader = fedimg.uploader.Uploader(self.engine, max_running=1,
+                                            max_queued=2)
+        jobs = uploader.submit(self.urls[:3], {})
+
+        with self.assertRaises(fedimg.uploader.UploadQueueFull):
+            uploader.submit(self.urls[3:], {})
+        self.assertEqual(uploader.stats()['rejected'], 1)
+        self.assertEqual(uploader.stats()['queued'], 2)
+
+        for job in jobs:
+            job.service.done.set_result(0)
+            job.result(timeout=5)
+
+    def test_compose_priority(self):
+        priority = fedimg.uploader.compose_priority
+        self.assertEqual(priority('Fedora-26-20170705.0'),
+                         fedimg.uploader.RELEASE)
+        self.assertEqual(priority('Fedora-26-20170707.n.0'),
+                         fedimg.uploader.BRANCHED)
+        self.assertEqual(priority('Fedora-Rawhide-20170707.n.1'),
+                         fedimg.uploader.RAWHIDE)
+        self.assertEqual(priority(None), fedimg.uploader.BRANCHED)
+
+    @mock.patch('fedimg.uploader.get_journal')
+    @mock.patch('fedimg.uploader.EC2Service')
+    def test_release_jumps_the_queue(self, EC2Service, get_journal):
+        EC2Service.side_effect = fake_service
+
+        uploader = fedimg.uploader.Uploader(self.engine, max_running=1)
+        first, = uploader.submit(self.urls[:1], {})
+        rawhide, = uploader.submit(
+            self.urls[1:2], {'compose_id': 'Fedora-Rawhide-20170707.n.0'})
+        release, = uploader.submit(
+            self.urls[2:3], {'compose_id': 'Fedora-26-20170705.0'})
+
+        first.service.done.set_result(0)
+        first.result(timeout=5)
+        self.assertEqual(release.state, 'running')
+        self.assertEqual(rawhide.state, 'queued')
+
+        release.service.done.set_result(0)
+        release.result(timeout=5)
+        rawhide.service.done.set_result(0)
+        rawhide.result(timeout=5)
+
+    @mock.patch('fedimg.uploader.get_journal')
+    @mock.patch('fedimg.uploader.EC2Service')
+    def test_newer_compose_supersedes(self, EC2Service, get_journal):
+        EC2Service.side_effect = fake_service
+
+        uploader = fedimg.uploader.Uploader(self.engine, max_running=1)
+        old = uploader.submit(self.urls[:2],
+                              {'compose_id': 'Fedora-Rawhide-20170706.n.0'})
+        other = uploader.submit(self.urls[2:3],
+                                {'compose_id': 'Fedora-26-20170706.n.0'})
+        new = uploader.submit(self.urls[3:],
+                              {'compose_id': 'Fedora-Rawhide-20170707.n.0'})
+
+        # The running job is cancelled, the queued one dropped
+        old[0].service.cancel.assert_called_once_with()
+        self.assertEqual(old[0].result(timeout=5), 1)
+        with self.assertRaises(fedimg.uploader.UploadSuperseded):
+            old[1].result(timeout=5)
+        self.assertEqual(old[1].state, 'superseded')
+
+        # Composes of other releases are left alone
+        self.assertEqual(other[0].state, 'running')
+        other[0].service.done.set_result(0)
+        other[0].result(timeout=5)
+
+        # An older compose turning up late isn't uploaded at all
+        late, = uploader.submit(
+            self.urls[:1], {'compose_id': 'Fedora-Rawhide-20170706.n.1'})
+        self.assertEqual(late.state, 'superseded')
+
+        new[0].service.done.set_result(0)
+        self.assertEqual(new[0].result(timeout=5), 0)
+        self.assertEqual(uploader.stats()['superseded'], 3)
+
+    @mock.patch('fedimg.uploader.get_journal')
+    @mock.patch('fedimg.uploader.EC2Service')
+    def test_refused_compose_supersedes_nothing(self, EC2Service,
+                                                get_journal):
+        EC2Service.side_effect = fake_service
+
+        uploader = fedimg.uploader.Uploader(self.engine, max_running=1,
+                                            max_queued=2)
+        old, = uploader.submit(self.urls[:1],
+                               {'compose_id': 'Fedora-Rawhide-20170706.n.0'})
+        other, = uploader.submit(self.urls[1:2],
+                                 {'compose_id': 'Fedora-26-20170706.n.0'})
+        with self.assertRaisesRegexp(fedimg.uploader.UploadQueueFull,
+                                     '^1 jobs queued already; '
+                                     'refusing 2 more'):
+            uploader.submit(self.urls[2:],
+                            {'compose_id': 'Fedora-Rawhide-20170707.n.0'})
+
+        self.assertFalse(old.service.cancel.called)
+        self.assertEqual((old.state, other.state), ('running', 'queued'))
+        self.assertEqual(uploader.stats()['superseded'], 0)
+        # the refused compose isn't taken as the newest either
+        again, = uploader.submit(
+            self.urls[2:3], {'compose_id': 'Fedora-Rawhide-20170706.n.1'})
+        self.assertEqual(again.state, 'queued')
+
+        for job in (old, other, again):
+            job.service.done.set_result(0)
+            job.result(timeout=5)
+
+    @mock.patch('fedimg.uploader.get_journal')
+    @mock.patch('fedimg.uploader.EC2Service')
+    def test_nightly_leaves_release_candidate(self, EC2Service, get_journal):
+        EC2Service.side_effect = fake_service
+
+        uploader = fedimg.uploader.Uploader(self.engine, max_running=1)
+        rc = uploader.submit(self.urls[:2],
+                             {'compose_id': 'Fedora-26-20170705.0'})
+        nightly = uploader.submit(self.urls[2:],
+                                  {'compose_id': 'Fedora-26-20170706.n.0'})
+
+        self.assertFalse(rc[0].service.cancel.called)
+        self.assertEqual([job.state for job in rc], ['running', 'queued'])
+        for job in rc + nightly:
+            job.service.done.set_result(0)
+            self.assertEqual(job.result(timeout=5), 0)
+        self.assertEqual(uploader.stats()['superseded'], 0)
+
+    @mock.patch('fedimg.uploader.get_journal', return_value=None)
+    @mock.patch('fedimg.uploader.EC2Service')
+    def test_compose_uploaded_once(self, EC2Service, get_journal):
+        EC2Service.side_effect = fake_service
+        compose_meta = {'compose_id': 'Fedora-26-20170705.0'}
+
+        uploader = fedimg.uploader.Uploader(self.engine)
+        first = uploader.submit(self.urls[:1], compose_meta)
+
+        # In flight
+        self.assertEqual(uploader.submit(self.urls[:1], compose_meta), [])
+        # Done
+        first[0].service.done.set_result(0)
+        first[0].result(timeout=5)
+        self.assertEqual(uploader.submit(self.urls[:1], compose_meta), [])
+
+        # Only the images that haven't been uploaded are
+        jobs = uploader.submit(self.urls[:2], compose_meta)
+        self.assertEqual([job.url for job in jobs], self.urls[1:2])
+        self.assertEqual(jobs[0].service.variants,
+                         [('hvm', 'standard'), ('hvm', 'gp2')])
+
+        # Failed uploads can be tried again
+        jobs[0].service.done.set_result(1)
+        jobs[0].result(timeout=5)
+        jobs = uploader.submit(self.urls[1:2], compose_meta)
+        self.assertEqual(len(jobs), 1)
+        jobs[0].service.done.set_result(0)
+        jobs[0].result(timeout=5)
+
+    @mock.patch('fedimg.uploader.get_journal')
+    @mock.patch('fedimg.uploader.EC2Service')
+    def test_upload_blocks(self, EC2Service, get_journal):
+        def finished_service(url, **kwargs):
+            service = fake_service(url)
+            service.done.set_result(0)
+            return service
+        EC2Service.side_effect = finished_service
+
+        self.assertEqual(fedimg.uploader.upload(self.engine, self.urls, {}),
+                         [0, 0, 0, 0])
+
+    @mock.patch('fedimg.uploader.get_journal')
+    @mock.patch('fedimg.uploader.EC2Service')
+    def test_resume_unfinished(self, EC2Service, get_journal):
+        url = self.urls[0]
+        get_journal.return_value.unfinished.return_value = [
+            (url, {'compose_id': 'Fedora-26'})]
+        EC2Service.side_effect = fake_service
+
+        uploader = fedimg.uploader.Uploader(self.engine, max_queued=0)
+        jobs = uploader.resume()
+
+        EC2Service.assert_called_once_with(url,
+                                           journal=get_journal.return_value)
+        jobs[0].service.pipeline.assert_called_with(
+            {'compose_id': 'Fedora-26'})
+        jobs[0].service.done.set_result(0)
+        self.assertEqual(jobs[0].result(timeout=5), 0)
+
+    @mock.patch('fedimg.uploader.get_journal')
+    @mock.patch('fedimg.uploader.EC2Service')
+    def test_queued_jobs_survive_a_restart(self, EC2Service, get_journal):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'journal.sqlite')
+        get_journal.return_value = fedimg.journal.Journal(path)
+        EC2Service.side_effect = fake_service
+        compose_meta = {'compose_id': 'Fedora-26-20170705.0'}
+
+        uploader = fedimg.uploader.Uploader(self.engine, max_running=1)
+        jobs = uploader.submit(self.urls[:2], compose_meta)
+        self.assertEqual([job.state for job in jobs], ['running', 'queued'])
+
+        # The process restarts before the second job starts
+        get_journal.return_value = fedimg.journal.Journal(path)
+        uploader = fedimg.uploader.Uploader(self.engine, max_running=2)
+        resumed = uploader.resume()
+        self.assertEqual(sorted(job.url for job in resumed), self.urls[:2])
+        self.assertEqual(uploader.submit(self.urls[:2], compose_meta), [])
+
+        for job in jobs + resumed:
+            job.service.done.set_result(0)
+            job.result(timeout=5)
+
+    @mock.patch('fedimg.uploader.get_journal')
+    @mock.patch('fedimg.uploader.EC2Service')
+    def test_refused_jobs_are_not_resumed(self, EC2Service, get_journal):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        journal = fedimg.journal.Journal(os.path.join(tmpdir, 'j.sqlite'))
+        get_journal.return_value = journal
+        EC2Service.side_effect = fake_service
+
+        uploader = fedimg.uploader.Uploader(self.engine, max_running=1,
+                                            max_queued=0)
+        jobs = uploader.submit(self.urls[:1], {})
+        with self.assertRaises(fedimg.uploader.UploadQueueFull):
+            uploader.submit(self.urls[1:2], {})
+        self.assertEqual(journal.unfinished(), [(self.urls[0], {})])
+
+        jobs[0].service.done.set_result(0)
+        jobs[0].result(timeout=5)
 
 if __name__ == '__main__':
     unittest.main()
@@ -20,6 +20,9 @@
 #
 
 import mock
+import socket
+import threading
+import time
 import unittest
 
 import fedimg
@@ -100,6 +103,157 @@ class TestUtil(unittest.TestCase):
         vtypes = fedimg.util.virt_types_from_url(url)
         self.assertEqual(vtypes, ['hvm'])
 
+    def test_get_rawxz_checksums(self):
+        images = [{'path': 'Cloud/x86_64/images/a.raw.xz',
+                   'checksums': {'sha256': 'abc'}},
+                  {'path': 'Cloud/x86_64/images/a.qcow2',
+                   'checksums': {'sha256': 'def'}},
+                  {'path': 'Cloud/x86_64/images/b.raw.xz'}]
+        checksums = fedimg.util.get_rawxz_checksums('http://c', images)
+        self.assertEqual(checksums,
+                         {'http://c/Cloud/x86_64/images/a.raw.xz': 'abc'})
+
+    def test_parse_dd_stats(self):
+        output = ("1234+1 records in\r\n1234+1 records out\r\n"
+                  "1294336000 bytes (1.3 GB) copied, 16.1807 s, 80.0 MB/s\r\n")
+        stats = fedimg.util.parse_dd_stats(output)
+        self.assertEqual(stats['bytes'], 1294336000)
+        self.assertEqual(stats['seconds'], 16.1807)
+        self.assertAlmostEqual(stats['rate'], 1294336000 / 16.1807)
+
+        self.assertEqual(fedimg.util.parse_dd_stats('(no data)'), None)
+
+    def test_parse_decoder(self):
+        self.assertEqual(fedimg.util.parse_decoder(
+            'fedimg decoder: xz (XZ Utils) 5.2.5\r\n1 bytes copied, 1 s'),
+            ('xz', (5, 2, 5)))
+        self.assertEqual(fedimg.util.parse_decoder('fedimg decoder: pixz\r\n'),
+                         ('pixz', ()))
+        self.assertEqual(fedimg.util.parse_decoder('(no data)'), None)
+
+    def test_port_is_open(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        port = listener.getsockname()[1]
+        self.assertTrue(fedimg.util.port_is_open('127.0.0.1', port, 1))
+        listener.close()
+        self.assertFalse(fedimg.util.port_is_open('127.0.0.1', port, 1))
+
+
+    def test_parse_compose_id(self):
+        self.assertEqual(
+            fedimg.util.parse_compose_id('Fedora-26-20170705.0'),
+            ('Fedora-26', 'production', ('20170705', 0)))
+        self.assertEqual(
+            fedimg.util.parse_compose_id('Fedora-Atomic-26-20170707.n.12'),
+            ('Fedora-Atomic-26', 'nightly', ('20170707', 12)))
+        self.assertEqual(
+            fedimg.util.parse_compose_id('Fedora-Rawhide-20170707.t.1'),
+            ('Fedora-Rawhide', 'test', ('20170707', 1)))
+        self.assertIsNone(fedimg.util.parse_compose_id('not-a-compose'))
+        self.assertIsNone(fedimg.util.parse_compose_id(None))
+
+
+class TestSSHSessions(unittest.TestCase):
+    """ This tests the SSH connections kept by fedimg/util.py. """
+
+    def setUp(self):
+        self.clients = []
+
+        def client_factory():
+            client = mock.Mock()
+            client.get_transport.return_value.is_active.return_value = True
+            self.clients.append(client)
+            return client
+
+        self.sessions = fedimg.util.SSHSessions('/key', max_handshakes=2,
+                                                client_factory=client_factory)
+
+    def tearDown(self):
+        pass
+
+    def test_connections_are_shared(self):
+        self.assertTrue(self.sessions.probe('fedora', '10.0.0.1'))
+        with self.sessions.session('fedora', '10.0.0.1') as channel:
+            channel.exec_command('true')
+        with self.sessions.sftp('fedora', '10.0.0.1') as sftp:
+            sftp.putfo(None, '/tmp/x')
+
+        self.assertEqual(len(self.clients), 1)
+        self.assertEqual(self.sessions.handshakes, 1)
+        self.clients[0].connect.assert_called_once_with(
+            '10.0.0.1', username='fedora', key_filename='/key', timeout=30)
+        transport = self.clients[0].get_transport.return_value
+        transport.open_session.return_value.close.assert_called_once_with()
+        transport.open_sftp_client.return_value.close.assert_called_once_with()
+
+        # another host gets a connection of its own
+        self.sessions.probe('fedora', '10.0.0.2')
+        self.assertEqual(len(self.clients), 2)
+
+    def test_dead_connections_are_replaced(self):
+        self.sessions.probe('fedora', '10.0.0.1')
+        self.clients[0].get_transport.return_value.is_active.return_value = \
+            False
+        self.sessions.probe('fedora', '10.0.0.1')
+        self.assertEqual(len(self.clients), 2)
+        self.clients[0].close.assert_called_once_with()
+
+    def test_probe_fails(self):
+        def client_factory():
+            client = mock.Mock()
+            client.connect.side_effect = socket.error('Connection refused')
+            self.clients.append(client)
+            return client
+
+        self.sessions.client_factory = client_factory
+        self.assertFalse(self.sessions.probe('fedora', '10.0.0.1'))
+        self.clients[0].close.assert_called_once_with()
+        self.assertEqual(self.sessions.handshakes, 0)
+        self.assertEqual(self.sessions._connecting, {})
+
+    def test_handshakes_are_limited(self):
+        lock = threading.Lock()
+        connecting = [0, 0]  # now, most at once
+
+        def connect(*args, **kwargs):
+            with lock:
+                connecting[0] += 1
+                connecting[1] = max(connecting)
+            time.sleep(0.05)
+            with lock:
+                connecting[0] -= 1
+
+        def client_factory():
+            client = mock.Mock()
+            client.connect.side_effect = connect
+            return client
+
+        self.sessions.client_factory = client_factory
+        threads = [threading.Thread(target=self.sessions.probe,
+                                    args=('fedora', '10.0.0.{0}'.format(i)))
+                   for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.sessions.handshakes, 6)
+        self.assertEqual(connecting[1], 2)
+        # no lock is kept once a host's handshake is over
+        self.assertEqual(self.sessions._connecting, {})
+
+    def test_idle_connections_are_closed(self):
+        self.sessions.idle_timeout = 0
+        with self.sessions.session('fedora', '10.0.0.1'):
+            # a connection with a session open is never idle
+            self.sessions.probe('fedora', '10.0.0.2')
+            self.assertFalse(self.clients[0].close.called)
+        self.sessions.probe('fedora', '10.0.0.2')
+        self.clients[0].close.assert_called_once_with()
+
+        self.sessions.close('10.0.0.2')
+        self.assertTrue(self.clients[-1].close.called)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,172 @@
+# This file is part of fedimg.
+# Copyright (C) 2014-2015 Red Hat, Inc.
+#
+# fedimg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# fedimg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with fedimg; if not, see http://www.gnu.org/licenses,
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Authors:  David Gay <dgay@redhat.com>
+#
+
+import mock
+import unittest
+from xml.etree import ElementTree
+
+from libcloud.compute.drivers.ec2 import NAMESPACE
+
+import fedimg.waiters
+
+STATUS_ITEM = """
+<item>
+  <instanceId>{0}</instanceId>
+  <instanceState><name>running</name></instanceState>
+  <systemStatus><status>ok</status></systemStatus>
+  <instanceStatus><status>{1}</status></instanceStatus>
+</item>"""
+
+
+def status_response(*items):
+    """ Returns a parsed DescribeInstanceStatus response. """
+    xml = '<Response xmlns="{0}"><instanceStatusSet>{1}' \
+          '</instanceStatusSet></Response>'.format(
+              NAMESPACE, ''.join(STATUS_ITEM.format(*i) for i in items))
+    return ElementTree.fromstring(xml)
+
+
+class TestRegionWaiter(unittest.TestCase):
+    """ This tests fedimg/waiters.py. """
+
+    def setUp(self):
+        self.waiter = fedimg.waiters.RegionWaiter('us-east-1',
+                                                  base_delay=0.01,
+                                                  max_delay=0.05)
+        self.waiter._driver = mock.MagicMock()
+        self.driver = mock.MagicMock()
+        self.waiter._driver.limited_call.side_effect = \
+            lambda method, fn: fn(self.driver)
+
+    def tearDown(self):
+        pass
+
+    def test_batches_ids_into_one_call(self):
+        images = dict((i, mock.Mock(id=i, extra={'state': 'available'}))
+                      for i in ('ami-1', 'ami-2', 'ami-3'))
+        self.driver.list_images.side_effect = lambda ex_filters: [
+            images[i] for i in ex_filters['image-id']]
+
+        # Hold the poller back until every wait has been registered
+        with self.waiter._cond:
+            futures = [self.waiter.wait_for('image', i, ['available'])
+                       for i in sorted(images)]
+
+        self.assertEqual([f.result(5) for f in futures],
+                         [images[i] for i in sorted(images)])
+        self.assertEqual(self.driver.list_images.call_count, 1)
+        self.assertEqual(
+            sorted(self.driver.list_images.call_args[1]['ex_filters']
+                   ['image-id']),
+            sorted(images))
+
+    def test_keeps_polling_until_state_reached(self):
+        states = iter(['pending', 'pending', 'completed'])
+        self.driver._build_filters.return_value = {
+            'Filter.1.Name': 'snapshot-id', 'Filter.1.Value.1': 'snap-1'}
+        self.driver._to_snapshots.side_effect = lambda response: [
+            mock.Mock(id='snap-1', extra={'state': next(states)})]
+
+        future = self.waiter.wait_for('snapshot', 'snap-1', ['completed'])
+
+        self.assertEqual(future.result(5).extra['state'], 'completed')
+        self.assertEqual(self.waiter.polls, 3)
+
+    def test_final_state_raises(self):
+        self.driver.list_images.return_value = [
+            mock.Mock(id='ami-1', extra={'state': 'failed'})]
+
+        future = self.waiter.wait_for('image', 'ami-1', ['available'])
+
+        self.assertRaises(fedimg.waiters.WaiterException, future.result, 5)
+
+    def test_status_checks(self):
+        checks = {'i-1': iter(['initializing', 'ok']),
+                  'i-2': iter(['initializing', 'impaired'])}
+        self.driver._pathlist.side_effect = lambda key, ids: {'ids': ids}
+        self.driver.connection.request.side_effect = \
+            lambda path, params: mock.Mock(object=status_response(
+                *[(i, next(checks[i])) for i in params['ids']]))
+
+        ok = self.waiter.wait_for('status', 'i-1', ['ok'])
+        impaired = self.waiter.wait_for('status', 'i-2', ['ok'])
+
+        self.assertEqual(ok.result(5), None)
+        self.assertRaises(fedimg.waiters.WaiterException,
+                          impaired.result, 5)
+
+    def test_failed_poll_after_some_finished(self):
+        waiter = fedimg.waiters.RegionWaiter('us-east-1', base_delay=0.01,
+                                             max_delay=0.05, timeout=0)
+        poll = waiter._poll
+
+        def finish_one_then_fail(due):
+            waiter._poll = poll
+            waiter._finish(due[0], 'found')
+            raise Exception('RequestLimitExceeded')
+        waiter._poll = finish_one_then_fail
+
+        with waiter._cond:
+            futures = [waiter.wait_for('image', i, ['available'])
+                       for i in ('ami-1', 'ami-2')]
+
+        # the rest time out, rather than the poller dying
+        self.assertEqual(futures[0].result(5), 'found')
+        self.assertRaises(fedimg.waiters.WaiterException,
+                          futures[1].result, 5)
+
+    def test_unknown_instances_are_left_out(self):
+        # EC2 fails the whole call for an instance it doesn't know yet
+        visible = set(['i-1'])
+
+        def request(path, params):
+            unknown = [i for i in params['ids'] if i not in visible]
+            if unknown:
+                visible.update(unknown)
+                raise Exception("InvalidInstanceID.NotFound: The instance "
+                                "IDs '{0}' do not exist".format(
+                                    ', '.join(unknown)))
+            return mock.Mock(object=status_response(
+                *[(i, 'ok') for i in params['ids']]))
+        self.driver._pathlist.side_effect = lambda key, ids: {'ids': ids}
+        self.driver.connection.request.side_effect = request
+
+        with self.waiter._cond:
+            futures = [self.waiter.wait_for('status', i, ['ok'])
+                       for i in ('i-1', 'i-2')]
+
+        self.assertEqual([f.result(5) for f in futures], [None, None])
+        self.assertEqual(
+            [sorted(c[1]['params']['ids']) for c
+             in self.driver.connection.request.call_args_list][:2],
+            [['i-1', 'i-2'], ['i-1']])
+
+    def test_gives_up_after_timeout(self):
+        self.waiter.timeout = 0.1
+        self.driver.list_images.return_value = []
+
+        future = self.waiter.wait_for('image', 'ami-1', ['available'])
+
+        self.assertRaises(fedimg.waiters.WaiterException, future.result, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()